@@ -0,0 +1,56 @@
+"""
+CCSDS space packet primary header codec, shifts and masks on the six header bytes.
+Only depends on numpy, so it imports without ait.
+"""
+from enum import Enum
+import numpy as np
+
+
+class HeaderKeys(Enum):
+    PACKET_VERSION_NUMBER = slice(0, 3)
+    PACKET_TYPE = slice(3, 4)
+    SEC_HDR_FLAG = slice(4, 5)
+    APPLICATION_PROCESS_IDENTIFIER = slice(5, 16)
+    SEQUENCE_FLAGS = slice(16, 18)
+    PACKET_SEQUENCE_OR_NAME = slice(18, 32)
+    PACKET_DATA_LENGTH = slice(32, 48)
+
+
+PRIMARY_HEADER_LENGTH = 6
+_PRIMARY_HEADER_BITS = PRIMARY_HEADER_LENGTH * 8
+# (name, shift, mask) for each header field, derived from the HeaderKeys bit slices
+_HEADER_FIELD_MASKS = tuple((key.name,
+                             _PRIMARY_HEADER_BITS - key.value.stop,
+                             (1 << (key.value.stop - key.value.start)) - 1)
+                            for key in HeaderKeys)
+
+
+def decode_primary_header(header_bytes):
+    """Decode the first 6 bytes of header_bytes into a {HeaderKeys.name: int} map."""
+    word = int.from_bytes(header_bytes[:PRIMARY_HEADER_LENGTH], 'big')
+    return {name: (word >> shift) & mask for (name, shift, mask) in _HEADER_FIELD_MASKS}
+
+
+def decode_primary_headers(buffer, offsets=None):
+    """
+    Batch decode primary headers into numpy column arrays keyed by HeaderKeys.name.
+
+    :param buffer: Bytes like object holding the headers.
+    :param offsets: Start index of each header within buffer.
+                    If omitted, buffer is treated as back to back 6 byte headers.
+    :returns: {HeaderKeys.name: np.ndarray}, one row per header.
+    """
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    if offsets is None:
+        if len(raw) % PRIMARY_HEADER_LENGTH:
+            raise ValueError(f"Buffer length {len(raw)} is not a multiple of {PRIMARY_HEADER_LENGTH}")
+        headers = raw.reshape(-1, PRIMARY_HEADER_LENGTH)
+    else:
+        offsets = np.asarray(offsets, dtype=np.intp)
+        headers = raw[offsets[:, None] + np.arange(PRIMARY_HEADER_LENGTH)]
+
+    words = np.zeros(len(headers), dtype=np.uint64)
+    for i in range(PRIMARY_HEADER_LENGTH):
+        words = (words << np.uint64(8)) | headers[:, i].astype(np.uint64)
+    return {name: ((words >> np.uint64(shift)) & np.uint64(mask)).astype(np.uint16)
+            for (name, shift, mask) in _HEADER_FIELD_MASKS}
@@ -2,6 +2,8 @@ from enum import Enum, auto
 from bitstring import BitArray
 from colorama import Fore
 from bifrost.common.loud_exception import with_loud_exception
+from bifrost.common.wire_format import encode_bytes
+from bifrost.common.ccsds_header import HeaderKeys, PRIMARY_HEADER_LENGTH, decode_primary_header, decode_primary_headers
 
 
 class Packet_State(Enum):
@@ -11,16 +13,6 @@ class Packet_State(Enum):
     IDLE = auto()
 
 
-class HeaderKeys(Enum):
-    PACKET_VERSION_NUMBER = slice(0, 3)
-    PACKET_TYPE = slice(3, 4)
-    SEC_HDR_FLAG = slice(4, 5)
-    APPLICATION_PROCESS_IDENTIFIER = slice(5, 16)
-    SEQUENCE_FLAGS = slice(16, 18)
-    PACKET_SEQUENCE_OR_NAME = slice(18, 32)
-    PACKET_DATA_LENGTH = slice(32, 48)
-
-
 class CCSDS_Packet():
 
     @with_loud_exception
@@ -43,21 +35,22 @@ class CCSDS_Packet():
             self.primary_header[HeaderKeys.PACKET_DATA_LENGTH.name] = PACKET_DATA_LENGTH
         self.secondary_header = {}  # TODO Handle secondary header
 
-        self.encoded_packet = bytes().hex()
+        self.encoded_packet = bytes()
         self.secondary_header_encoded = bytes()
         self.error = None
 
     @with_loud_exception
-    def marshall(self):
+    def marshall(self, binary=False):
+        """binary: Ship raw bytes instead of hex strings"""
         s = {
             'data_type': type(self).__name__,
             'primary_header': self.primary_header,
-            'secondary_header_encoded': self.secondary_header_encoded.hex(),
-            'data': self.data.hex(),
+            'secondary_header_encoded': encode_bytes(self.secondary_header_encoded, binary),
+            'data': encode_bytes(self.data, binary),
             'error': self.error,
             'is_idle': self.is_idle(),
             'is_complete': self.is_complete(),
-            'encoded_packet': self.encoded_packet.hex(),
+            'encoded_packet': encode_bytes(self.encoded_packet, binary),
             'missing': self.get_missing(),
             'next_index': self.get_next_index(),
         }
@@ -70,7 +63,7 @@ class CCSDS_Packet():
 
     @staticmethod
     @with_loud_exception
-    def decode(packet_bytes, secondary_header_length=0):
+    def decode(packet_bytes, secondary_header_length=0, binary=False):
         """Generate a packet"""
         data_length = int.from_bytes(packet_bytes[4:6], 'big')
         if not data_length: # regular check is apid 111111....
@@ -82,12 +75,8 @@ class CCSDS_Packet():
             return (Packet_State.IDLE, None)
 
         actual_packet = packet_bytes[:6 + data_length + 1]
-        header_bits = BitArray(actual_packet[0:6]).bin
         data = actual_packet[6:]
-        decoded_header = {}
-        for key in HeaderKeys:
-            decoded_header[key.name] = int(header_bits[key.value], 2)
-
+        decoded_header = decode_primary_header(actual_packet)
         decoded_header['data'] = data
         p = CCSDS_Packet(**decoded_header)
         p.encoded_packet = actual_packet
@@ -98,7 +87,7 @@ class CCSDS_Packet():
             p.secondary_header_encoded = data[:secondary_header_length]
             p.data = data[secondary_header_length:]
 
-        p = p.marshall()
+        p = p.marshall(binary)
         if p['is_complete']:
             #log.debug(f"OK, Packet Complete: {p}")
             return (Packet_State.COMPLETE, p)
@@ -1,52 +1,270 @@
 from bifrost.common.loud_exception import with_loud_exception
+from bifrost.common.time_utility import utc_timestamp_now
 import errno
 import json as json
+import os
+import queue
+import threading
+import time
 from ait.core import log
 from pathlib import Path
+from enum import Enum, auto
+from dataclasses import dataclass
+
+
+class Fsync_Policy(Enum):
+    """
+    Every policy preserves record order, records are appended in the order write_to_disk was called.
+    Records still in the queue or in a write batch are lost if the process dies.
+
+    NEVER:     Batches are written to the OS after each batch, the OS decides when they reach the disk.
+               Survives a process crash once written, may lose recent records on power loss.
+    INTERVAL:  As NEVER, plus fsync at most every fsync_interval_s. Power loss loses at most that window.
+    BYTES:     As NEVER, plus fsync once fsync_bytes have been written since the last fsync.
+    ALWAYS:    fsync after every batch (group commit). A record is on disk before the next batch is taken.
+    """
+    NEVER = auto()
+    INTERVAL = auto()
+    BYTES = auto()
+    ALWAYS = auto()
+
+
+@dataclass
+class Disk_Writer_Metrics():
+    records_written: int = 0
+    bytes_written: int = 0
+    records_dropped: int = 0
+    write_errors: int = 0
+    batches: int = 0
+    write_latency_total_s: float = 0
+    write_latency_max_s: float = 0
+    fsync_count: int = 0
+    fsync_latency_max_s: float = 0
+    rotations: int = 0
+
+    def marshall(self):
+        res = {
+            'records_written': self.records_written,
+            'bytes_written': self.bytes_written,
+            'records_dropped': self.records_dropped,
+            'write_errors': self.write_errors,
+            'batches': self.batches,
+            'write_latency_mean_ms': (1000 * self.write_latency_total_s / self.batches) if self.batches else 0,
+            'write_latency_max_ms': 1000 * self.write_latency_max_s,
+            'fsync_count': self.fsync_count,
+            'fsync_latency_max_ms': 1000 * self.fsync_latency_max_s,
+            'rotations': self.rotations,
+        }
+        return res
+
 
 class Disk_Writer():
     """
-    Allows processors to write a dictionary to disk.
+    Allows processors to write a dictionary to disk, one JSON record per line (NDJSON):
+        {"event_time_gps": "...", "time_processed": "...", "data": {...}}
+    event_time_gps is only present when given.
+    Writers before the I/O thread wrote each record as indent=4 JSON followed by a blank line,
+    set indented_records for readers that still expect that.
+
+    Files are {downlink_path}/{path}/{subpath}/{fname}_{sv_name}_{pass_id}{extension}.ndjson.
+    Earlier writers built that path from a string with spaces around every '/', so their files are under
+    directories named like '{downlink_path} ' and ' {path} '. Move those files to read them next to new ones.
+
+    Records are queued and written by a dedicated I/O thread in batches, so disk latency never blocks the event loop.
+    Records are serialized on the I/O thread, do not mutate data after handing it to write_to_disk.
+    If the queue is full the record is dropped and counted.
+
+    Files are rotated to {name}.1.ndjson, {name}.2.ndjson, ... once they exceed rotate_bytes (0 disables),
+    and with rotate(pass_id) when the pass changes. See Fsync_Policy for durability.
     TODO: Everyone should be requesting that monitor write to disk
     """
-    
+
     @with_loud_exception
-    def __init__(self, path, extension, fname, pass_id, downlink_path, sv_name,subpath="",):
-        self.path = Path(f"{downlink_path} / {path} / {subpath} / {fname}_{sv_name}_{pass_id}{extension}.ndjson")
+    def __init__(self, path, extension, fname, pass_id, downlink_path, sv_name, subpath="",
+                 fsync_policy=Fsync_Policy.INTERVAL, fsync_interval_s=1, fsync_bytes=1 << 22,
+                 rotate_bytes=0, queue_size=65536, batch_bytes=1 << 20, indented_records=False):
+        self.directory = Path(downlink_path) / path / subpath
+        self.extension = extension
+        self.fname = fname
+        self.sv_name = sv_name
+        self.pass_id = pass_id
+        if isinstance(fsync_policy, str):
+            fsync_policy = Fsync_Policy[fsync_policy.upper()]
+        self.fsync_policy = fsync_policy
+        self.fsync_interval_s = fsync_interval_s
+        self.fsync_bytes = fsync_bytes
+        self.rotate_bytes = rotate_bytes
+        self.batch_bytes = batch_bytes
+        self.indented_records = indented_records
+        self.metrics = Disk_Writer_Metrics()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.rotation = 0
+        self.f = None
+        self.open()
+        self.thread = threading.Thread(target=self.run, name=f'Disk_Writer-{fname}', daemon=True)
+        self.thread.start()
+
+    def file_path(self):
+        suffix = f'.{self.rotation}' if self.rotation else ''
+        return self.directory / f"{self.fname}_{self.sv_name}_{self.pass_id}{self.extension}{suffix}.ndjson"
 
+    def open(self):
+        if self.f:
+            self.sync()
+            self.f.close()
+        self.path = self.file_path()
         self.path.parent.mkdir(parents=True, exist_ok=True)
         try:
-            self.f = open(self.path, "a")
-        except Exception as e:
+            self.f = open(self.path, "ab")
+        except OSError as e:
             if e.errno == errno.ENOSPC:
                 log.error("Out of disk space!")
-            self.loop.create_task(self.publish('Bifrost.Messages.Error.Panic.WriteableToDisk', e))
             raise e
-
-        self.first_entry = True
-        self.end_pos = self.f.tell()
+        self.file_bytes = self.f.tell()
+        self.unsynced_bytes = 0
+        self.last_fsync = time.monotonic()
+        self.end_pos = self.file_bytes
 
     @with_loud_exception
-    def write_to_disk(self, data: map, timestamp, event_time_gps=None):
+    def write_to_disk(self, data: map, timestamp=None, event_time_gps=None):
+        """
+        Queue a record.
+        Returns (path, end_pos): the file the record is headed to, and its size after the last batch written
+        before the record was queued. end_pos is not this record's offset, records still queued come first.
+        Rotation may also move the record to the next file.
+        """
+        try:
+            self.queue.put_nowait(('record', (data, timestamp or utc_timestamp_now(), event_time_gps)))
+        except queue.Full:
+            self.metrics.records_dropped += 1
+            log.error(f"Disk writer queue for {self.path} is full, record dropped.")
+        return (self.path, self.end_pos)
+
+    def rotate(self, pass_id=None):
+        """Continue in a new file, for a new pass if pass_id is given. Ordered with respect to queued records."""
+        self.queue.put(('rotate', pass_id))
+
+    def close(self, timeout=None):
+        """Write every queued record, fsync and stop the I/O thread"""
+        if self.thread.is_alive():
+            self.queue.put(('close', None))
+            self.thread.join(timeout)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def marshall(self):
+        res = self.metrics.marshall()
+        res['queue_depth'] = self.queue_depth()
+        res['path'] = str(self.path)
+        return res
+
+    @staticmethod
+    def encode(record, indented=False):
+        (data, timestamp, event_time_gps) = record
         r = {}
         if event_time_gps:
             r['event_time_gps'] = str(event_time_gps)
-
         r['time_processed'] = str(timestamp)
         r['data'] = data
+        if indented:
+            return json.dumps(r, indent=4, default=str).encode() + b'\n\n'
+        return json.dumps(r, default=str).encode() + b'\n'
 
-        r = json.dumps(r, indent=4)
+    def run(self):
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout=self.fsync_interval_s)
+            except queue.Empty:
+                self.sync_if_due()
+                continue
+
+            batch = []
+            batch_bytes = 0
+            while True:
+                (kind, value) = item
+                if kind == 'record':
+                    try:
+                        line = self.encode(value, self.indented_records)
+                    except Exception as e:
+                        log.error(f"Could not serialize record for {self.path}: {e}")
+                        self.metrics.write_errors += 1
+                    else:
+                        batch.append(line)
+                        batch_bytes += len(line)
+                else:
+                    self.write_batch(batch, batch_bytes)
+                    (batch, batch_bytes) = ([], 0)
+                    if kind == 'rotate':
+                        if value is not None:
+                            self.pass_id = value
+                            self.rotation = 0
+                        else:
+                            self.rotation += 1
+                        self.metrics.rotations += 1
+                        self.open()
+                    elif kind == 'close':
+                        running = False
+                        break
+                if batch_bytes >= self.batch_bytes:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.write_batch(batch, batch_bytes)
+
+        self.sync()
+        self.f.close()
+
+    def write_batch(self, batch, batch_bytes):
+        if not batch:
+            return
+        start = time.monotonic()
         try:
-            self.f.write(r)
-            self.f.write("\n\n")
+            self.f.write(b''.join(batch))
             self.f.flush()
-
         except Exception as e:
+            self.metrics.write_errors += 1
             log.error(f"Encountered error while"
                       f" writing {self.path}: {e}")
+            return
+        latency = time.monotonic() - start
+        self.metrics.batches += 1
+        self.metrics.records_written += len(batch)
+        self.metrics.bytes_written += batch_bytes
+        self.metrics.write_latency_total_s += latency
+        self.metrics.write_latency_max_s = max(self.metrics.write_latency_max_s, latency)
+        self.file_bytes += batch_bytes
+        self.unsynced_bytes += batch_bytes
+        self.end_pos = self.file_bytes
+        self.sync_if_due()
+        if self.rotate_bytes and self.file_bytes >= self.rotate_bytes:
+            self.rotation += 1
+            self.metrics.rotations += 1
+            self.open()
 
-        return (self.path, self.end_pos)
+    def sync_if_due(self):
+        if not self.unsynced_bytes:
+            return
+        if ((self.fsync_policy is Fsync_Policy.ALWAYS) or
+           (self.fsync_policy is Fsync_Policy.INTERVAL and time.monotonic() - self.last_fsync >= self.fsync_interval_s) or
+           (self.fsync_policy is Fsync_Policy.BYTES and self.unsynced_bytes >= self.fsync_bytes)):
+            self.sync()
 
-    @with_loud_exception
-    def __del__(self):
-        self.close()
+    def sync(self):
+        if self.fsync_policy is Fsync_Policy.NEVER or not self.unsynced_bytes:
+            return
+        start = time.monotonic()
+        try:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        except OSError as e:
+            self.metrics.write_errors += 1
+            log.error(f"Could not fsync {self.path}: {e}")
+            return
+        self.metrics.fsync_count += 1
+        self.metrics.fsync_latency_max_s = max(self.metrics.fsync_latency_max_s, time.monotonic() - start)
+        self.unsynced_bytes = 0
+        self.last_fsync = time.monotonic()
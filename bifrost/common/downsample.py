@@ -0,0 +1,85 @@
+"""
+Downsampling for plots. Inputs are numpy arrays of times (sorted) and values, outputs are indices into them.
+"""
+import numpy as np
+
+
+def stride(n, max_points):
+    """Evenly spaced indices, for values that can not be compared (strings, enums)"""
+    if n <= max_points:
+        return np.arange(n)
+    return np.linspace(0, n - 1, max_points).astype(np.int64)
+
+
+def latest(n, max_points):
+    """Indices of the last max_points values"""
+    return np.arange(max(n - max_points, 0), n)
+
+
+def min_max(values, max_points):
+    """Indices of the minimum and maximum of max_points // 2 equal buckets, in time order. Keeps every spike."""
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    buckets = max(max_points // 2, 1)
+    size = -(-n // buckets)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = values
+    padded = padded.reshape(buckets, size)
+    valid = ~np.all(np.isnan(padded), axis=1)
+    offsets = np.arange(buckets)[valid] * size
+    lows = np.nanargmin(padded[valid], axis=1) + offsets
+    highs = np.nanargmax(padded[valid], axis=1) + offsets
+    return np.unique(np.concatenate((lows, highs)))
+
+
+def lttb(times, values, max_points):
+    """Largest Triangle Three Buckets: indices of max_points points that best keep the visual shape of the series"""
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    if max_points < 3:
+        return stride(n, max_points)
+    x = times.astype(np.float64)
+    y = values.astype(np.float64)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        (start, stop) = (edges[i], edges[i + 1])
+        if i + 2 < len(edges):
+            (next_start, next_stop) = (edges[i + 1], edges[i + 2])
+        else:
+            (next_start, next_stop) = (n - 1, n)
+        average_x = x[next_start:next_stop].mean()
+        average_y = y[next_start:next_stop].mean()
+        areas = np.abs((x[a] - average_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (average_y - y[a]))
+        a = start + int(np.nanargmax(areas)) if not np.all(np.isnan(areas)) else start
+        selected[i + 1] = a
+    return selected
+
+
+def select(times, values, max_points, method):
+    """
+    Indices chosen by downsamplers[method], and the values at them as JSON types (NaN as None).
+    Values that can not be compared (strings, enums, booleans) are strided, or the latest kept.
+    """
+    if np.issubdtype(values.dtype, np.number) and values.dtype != np.bool_:
+        values = values.astype(np.float64)
+        selected = downsamplers[method](times, values, max_points)
+        return (selected, [None if np.isnan(v) else v for v in values[selected].tolist()])
+    if method == 'latest':
+        selected = latest(len(values), max_points)
+    else:
+        selected = stride(len(values), max_points)
+    return (selected, [None if v is None else v if isinstance(v, (str, bool, int, float)) else str(v)
+                       for v in values[selected].tolist()])
+
+
+downsamplers = {
+    'minmax': lambda times, values, max_points: min_max(values, max_points),
+    'lttb': lttb,
+    'latest': lambda times, values, max_points: latest(len(values), max_points),
+}
@@ -0,0 +1,150 @@
+"""
+Serializers used by Service to put messages on and take messages off the NATS wire.
+Select one per service in services.yaml with ``serializer: <msgpack|msgpack_ext|msgpack_raw>``.
+
+msgpack:      msgpack.packb/unpackb with default options. Every service understands this.
+msgpack_ext:  Reusable Packer, raw bytes as bin, and ext types for astropy Time and CmdMetaData.
+              Consumers must also use msgpack_ext (or msgpack_raw) to get the objects back.
+msgpack_raw:  msgpack_ext, but strings are left undecoded as bytes (keys included).
+              Fast path for services that pass messages through without looking at most fields.
+              Only data path callbacks (topics, streams, batch_streams) get raw messages,
+              control traffic (reconfiguration, request replies) is decoded through ``serializer.control``.
+
+Run ``python -m bifrost.common.serializer`` for a micro-benchmark against tagged packet payloads.
+"""
+from dataclasses import fields
+import msgpack
+import numpy as np
+from astropy.time import Time
+from bifrost.services.core.commanding.cmd_meta_data import CmdMetaData
+
+EXT_ASTROPY_TIME = 1
+EXT_CMD_META_DATA = 2
+
+
+class Msgpack_Serializer():
+    """Default, equivalent to msgpack.packb and msgpack.unpackb"""
+
+    def packb(self, data):
+        return msgpack.packb(data)
+
+    def unpackb(self, data):
+        return msgpack.unpackb(data)
+
+    @property
+    def control(self):
+        """Serializer for control traffic: reconfiguration, requests and replies. Always decodes strings."""
+        return self
+
+
+class Msgpack_Ext_Serializer(Msgpack_Serializer):
+    raw = False
+
+    def __init__(self):
+        self.packer = msgpack.Packer(use_bin_type=True, default=self.default)
+
+    def packb(self, data):
+        return self.packer.pack(data)
+
+    def unpackb(self, data):
+        return msgpack.unpackb(data, raw=self.raw, ext_hook=self.ext_hook)
+
+    def default(self, obj):
+        if isinstance(obj, Time):
+            body = [obj.scale, obj.format, obj.precision, np.asarray(obj.jd1).tolist(), np.asarray(obj.jd2).tolist()]
+            return msgpack.ExtType(EXT_ASTROPY_TIME, self.packer_for_ext().pack(body))
+        if isinstance(obj, CmdMetaData):
+            body = {f.name: getattr(obj, f.name) for f in fields(obj)}
+            body['start_time_gps'] = obj.start_time_gps
+            body['finish_time_gps'] = obj.finish_time_gps
+            return msgpack.ExtType(EXT_CMD_META_DATA, self.packer_for_ext().pack(body))
+        raise TypeError(f"Can not serialize {type(obj)}")
+
+    def packer_for_ext(self):
+        # The shared packer is mid pack when default is called
+        return msgpack.Packer(use_bin_type=True, default=self.default)
+
+    def ext_hook(self, code, data):
+        # Ext bodies are always unpacked with string decoding, regardless of raw
+        body = msgpack.unpackb(data, ext_hook=self.ext_hook)
+        if code == EXT_ASTROPY_TIME:
+            (scale, time_format, precision, jd1, jd2) = body
+            t = Time(jd1, jd2, format='jd', scale=scale, precision=precision)
+            t.format = time_format
+            return t
+        if code == EXT_CMD_META_DATA:
+            start_time_gps = body.pop('start_time_gps')
+            finish_time_gps = body.pop('finish_time_gps')
+            uid = body.pop('uid')
+            cmd = CmdMetaData(**body)
+            cmd.uid = uid
+            cmd.start_time_gps = start_time_gps
+            cmd.finish_time_gps = finish_time_gps
+            return cmd
+        return msgpack.ExtType(code, data)
+
+
+class Msgpack_Raw_Serializer(Msgpack_Ext_Serializer):
+    raw = True
+
+    def __init__(self):
+        super().__init__()
+        self.control_serializer = Msgpack_Ext_Serializer()
+
+    @property
+    def control(self):
+        return self.control_serializer
+
+
+serializers = {
+    'msgpack': Msgpack_Serializer,
+    'msgpack_ext': Msgpack_Ext_Serializer,
+    'msgpack_raw': Msgpack_Raw_Serializer,
+}
+
+
+def get_serializer(name):
+    try:
+        return serializers[name]()
+    except KeyError:
+        raise ValueError(f"Unknown serializer {name}, expected one of <{'|'.join(serializers)}>")
+
+
+if __name__ == '__main__':
+    import os
+    import timeit
+    from bifrost.services.downlink.tagged_packet import TaggedPacket
+
+    def tagged_packet(binary):
+        data = os.urandom(128)
+        ccsds_packet = {
+            'data_type': 'CCSDS_Packet',
+            'primary_header': {'PACKET_VERSION_NUMBER': 0, 'PACKET_TYPE': 0, 'SEC_HDR_FLAG': 1,
+                               'APPLICATION_PROCESS_IDENTIFIER': 100, 'SEQUENCE_FLAGS': 3,
+                               'PACKET_SEQUENCE_OR_NAME': 1234, 'PACKET_DATA_LENGTH': len(data) + 5},
+            'secondary_header_encoded': data[:6] if binary else data[:6].hex(),
+            'data': data if binary else data.hex(),
+            'error': None,
+            'is_idle': False,
+            'is_complete': True,
+            'encoded_packet': data if binary else data.hex(),
+            'missing': 0,
+            'next_index': len(data) + 12,
+        }
+        p = TaggedPacket(ccsds_packet, 'Example_Packet', 100, 1, 'SV-1', 'Example', 1, 'Real Time Telemetry', 42)
+        p.decoded_packet = {f'field_{i}': i * 1.5 for i in range(32)}
+        p.field_alarms = {f'field_{i}': {'state': 'GREEN', 'threshold': False} for i in range(32)}
+        p.packet_time = Time.now()
+        p.time_processed_utc = '2023-01-01_00-00-00'
+        return p.marshall()
+
+    n = 20000
+    for binary in (False, True):
+        payload = tagged_packet(binary)
+        print(f"Tagged packet, {'binary' if binary else 'hex'} wire format")
+        for (name, serializer_type) in serializers.items():
+            s = serializer_type()
+            packed = s.packb(payload)
+            pack_us = 1e6 * timeit.timeit(lambda: s.packb(payload), number=n) / n
+            unpack_us = 1e6 * timeit.timeit(lambda: s.unpackb(packed), number=n) / n
+            print(f"    {name:12} {len(packed):6} B  pack {pack_us:7.2f} us  unpack {unpack_us:7.2f} us")
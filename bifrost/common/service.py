@@ -1,7 +1,7 @@
 from bifrost.common.loud_exception import with_loud_exception
+from bifrost.common.serializer import Msgpack_Serializer, get_serializer
 from abc import abstractmethod
 from ait.core import log
-import msgpack
 import setproctitle
 from colorama import Fore, Back
 import signal
@@ -13,6 +13,67 @@ import traceback
 import uvloop
 import sys
 import time
+import uuid
+from enum import Enum, auto
+from dataclasses import dataclass
+from collections import OrderedDict
+
+
+def durable_token(subject):
+    """Subject as part of a durable consumer name, which may not contain '.', '*' or '>'"""
+    return subject.replace('.', '-').replace('*', 'ANY').replace('>', 'ALL')
+
+
+class Flush_Policy(Enum):
+    IMMEDIATE = auto()  # Flush after every publish
+    INTERVAL = auto()  # Flush every flush_interval_ms
+    SIZE = auto()  # Flush once flush_size_bytes have been published since the last flush
+
+
+@dataclass
+class Publish_Metrics():
+    publish_count: int = 0
+    publish_bytes: int = 0
+    flush_count: int = 0
+    flush_latency_total_s: float = 0
+    flush_latency_max_s: float = 0
+    stream_count: int = 0
+    stream_retry_count: int = 0
+    stream_failure_count: int = 0
+    stream_reorder_count: int = 0
+    stream_in_flight: int = 0
+
+    def record_flush(self, latency_s):
+        self.flush_count += 1
+        self.flush_latency_total_s += latency_s
+        self.flush_latency_max_s = max(self.flush_latency_max_s, latency_s)
+
+    def marshall(self):
+        res = {
+            'publish_count': self.publish_count,
+            'publish_bytes': self.publish_bytes,
+            'flush_count': self.flush_count,
+            'flush_latency_mean_ms': (1000 * self.flush_latency_total_s / self.flush_count) if self.flush_count else 0,
+            'flush_latency_max_ms': 1000 * self.flush_latency_max_s,
+            'stream_count': self.stream_count,
+            'stream_retry_count': self.stream_retry_count,
+            'stream_failure_count': self.stream_failure_count,
+            'stream_reorder_count': self.stream_reorder_count,
+            'stream_in_flight': self.stream_in_flight,
+        }
+        return res
+
+
+class Subject_Stream():
+    """JetStream publishes on one subject that are awaiting acks, in call order"""
+    def __init__(self, subject):
+        self.subject = subject
+        self.pending = OrderedDict()  # {sequence: (payload, future)}
+        self.first_attempts = set()
+        self.last_acked = 0  # Highest sequence acked on this subject
+        self.open = asyncio.Event()  # Cleared while the unacked tail is republished
+        self.open.set()
+        self.recovery = None
 
 
 class Service():
@@ -24,6 +85,27 @@ class Service():
 
         self.reconfig_pattern = f'Bifrost.Plugins.Reconfigure.{self.__class__.__name__}'
         self.running = False
+        self.batch_size = 64  # batch_streams: Max messages per batch
+        self.batch_latency_ms = 50  # batch_streams: Max time to wait for a batch to fill
+        self.batch_tasks = []
+        self.batch_draining = False  # batch_streams consumers stop after the batch in hand once set
+        self.serializer = Msgpack_Serializer()  # services.yaml: serializer: <msgpack|msgpack_ext|msgpack_raw>
+        self.flush_policy = Flush_Policy.IMMEDIATE  # services.yaml: flush_policy: <IMMEDIATE|INTERVAL|SIZE>
+        self.flush_interval_ms = 10
+        self.flush_size_bytes = 65536
+        self.pending_flush_bytes = 0
+        self.flush_task = None  # periodic_flush, only under Flush_Policy.INTERVAL
+        self.publish_metrics = Publish_Metrics()
+        self.publish_report_s = 5
+        self.stream_window = 64  # Max JetStream publishes awaiting acks
+        self.stream_timeout_s = 5
+        self.stream_retries = 2
+        self.stream_window_semaphore = asyncio.Semaphore(self.stream_window)
+        self.stream_window_size = self.stream_window
+        self.stream_tasks = set()
+        self.stream_subjects = {}
+        self.stream_id_prefix = f'{self.name}-{uuid.uuid4().hex[:8]}'
+        self.stream_sequence = 0
 
         signal.signal(signal.SIGINT, self.shutdown)
         signal.signal(signal.SIGTERM, self.shutdown)
@@ -31,6 +113,7 @@ class Service():
         self.loop = asyncio.get_event_loop()
         #try:
         self.loop.run_until_complete(self.nc_connect())
+        self.loop.create_task(self.periodic_publish_report())
         
         #except Exception as e:
          #   print(e)
@@ -95,12 +178,13 @@ class Service():
         os.kill(os.getpid(), signal.SIGKILL)
         # And stay dead.
         
-    @staticmethod
-    def deserialize(f):
+    def deserialize(self, f, control=False):
+        """control: Decode with serializer.control, for reconfiguration and request handlers"""
         async def _deserialized(msg):
             subject = msg.subject
             reply = msg.reply
-            data = msgpack.unpackb(msg.data)
+            serializer = self.serializer.control if control else self.serializer
+            data = serializer.unpackb(msg.data)
             try:
                 await f(subject, data, reply)
             except AttributeError as e:
@@ -132,8 +216,10 @@ class Service():
                 subscribing_function = self.subscribe_topic
             elif t == 'streams':
                 subscribing_function = self.subscribe_jetstream
+            elif t == 'batch_streams':
+                subscribing_function = self.subscribe_jetstream_batch
             else:
-                raise ValueError("Variable t must be  <'topics'|'streams'>")
+                raise ValueError("Variable t must be  <'topics'|'streams'|'batch_streams'>")
             
             if not hasattr(self, t) or not (iterable := getattr(self, t)): # iterablle = self.topics or self.streams
                 log.debug(f'No {t} found for {self}!')
@@ -159,17 +245,30 @@ class Service():
                     log.info(f'{self}: Cannnot bind reserved attribute {attribute=} to {value=}')
                     continue
                 setattr(self, attribute, value)
+            if isinstance(self.serializer, str):
+                self.serializer = get_serializer(self.serializer)
+            if isinstance(self.flush_policy, str):
+                self.flush_policy = Flush_Policy[self.flush_policy.upper()]
+            self.update_flush_task()
+            if self.stream_window != self.stream_window_size:
+                # In flight publishes release the semaphore they acquired
+                self.stream_window_semaphore = asyncio.Semaphore(self.stream_window)
+                self.stream_window_size = self.stream_window
 
         async def unsubscribe():
             if hasattr(self, 'subscription'):
                 await self.subscription.unsubscribe()
             if hasattr(self, 'subscription_stream'):
                 await self.subscription_stream.unsubscribe()
+            for task in self.batch_tasks:
+                task.cancel()
+            self.batch_tasks = []
         try:
             await unsubscribe()
             add_attributes()
             await make_subscription('topics')
             await make_subscription('streams')
+            await make_subscription('batch_streams')
             await self.subscribe_reconfigure()
         except Exception as e:
             log.error(e)
@@ -177,21 +276,22 @@ class Service():
         log.debug(f"{Fore.BLUE}Finished reconfiguration for {self.name} {Fore.RESET}")
         
     async def subscribe_reconfigure(self):
-        await self.subscribe_topic(self.reconfig_pattern, self.reconfigure)
+        await self.subscribe_topic(self.reconfig_pattern, self.reconfigure, control=True)
 
-    async def subscribe_topic(self, topic, callback):
-        f = self.deserialize(callback)
+    async def subscribe_topic(self, topic, callback, control=False):
+        f = self.deserialize(callback, control)
         self.subscription = await self.nc.subscribe(topic, cb=f)
 
-    async def subscribe_jetstream(self, subject, callback):
+    async def subscribe_jetstream(self, subject, callback, durable=None):
         try:
             f = self.deserialize(callback)
-            name = 'Bifrost-' + self.name.split('.')[-1]
+            name = durable or 'Bifrost-' + self.name.split('.')[-1]
             self.subscription_stream = await self.js.subscribe(subject=subject,
                                                                cb=f,
                                                                durable=name,
                                                                ordered_consumer=False,
                                                                flow_control=False)
+            return self.subscription_stream
             #log.debug(f"Subscribed to jetstream: {subject}")
         except TypeError as e:
             log.error(f"{Fore.RED} {self.name}: You most likely did not declare the jetstream stream or subject: {subject}.{Fore.RESET}")
@@ -200,21 +300,237 @@ class Service():
             log.error(e)
             raise e
         
+    async def subscribe_jetstream_batch(self, subject, callback, durable=None):
+        """
+        Pull consumer: Fetch up to batch_size messages, or whatever arrived within batch_latency_ms,
+        then call back once with the whole batch as a list, in stream order.
+        Messages are acked after the callback returns.
+        If it raised, the batch is terminated rather than redelivered: the callback may have advanced its state
+        and published part of the batch, a redelivery would duplicate those and reorder them with later batches.
+        batch_failed is called first, to reset whatever state the batch left behind.
+        Messages that can not be deserialized are terminated, they would never succeed.
+        One durable consumer per subject.
+        """
+        self.batch_tasks.append(asyncio.current_task())
+        name = durable or f"Bifrost-{self.name.split('.')[-1]}-Batch-{durable_token(subject)}"
+        try:
+            psub = await self.js.pull_subscribe(subject, durable=name)
+        except Exception as e:
+            log.error(f"{Fore.RED} {self.name}: Could not create pull consumer for {subject}, is the stream declared?{Fore.RESET}")
+            log.error(e)
+            raise e
+
+        while not self.batch_draining:
+            try:
+                msgs = await psub.fetch(self.batch_size, timeout=self.batch_latency_ms / 1000)
+            except nats.errors.TimeoutError:
+                continue
+            batch = []
+            decoded_msgs = []
+            for msg in msgs:
+                try:
+                    batch.append(self.serializer.unpackb(msg.data))
+                    decoded_msgs.append(msg)
+                except Exception as e:
+                    log.error(f"{self.name}: Dropping message on {msg.subject} that could not be deserialized: {e}")
+                    await msg.term()
+            if not batch:
+                continue
+            try:
+                await callback(subject, batch, None)
+            except Exception as e:
+                log.error(f"Could not execute {callback} for batch of {len(batch)} on {subject=}, dropping it")
+                log.error(e)
+                traceback.print_exc()
+                await self.batch_failed(subject, batch)
+                for msg in decoded_msgs:
+                    await msg.term()
+                continue
+            for msg in decoded_msgs:
+                await msg.ack()
+        await psub.unsubscribe()
+
+    async def batch_failed(self, subject, batch):
+        """Called when a subscribe_jetstream_batch callback raised, before the batch is dropped"""
+        pass
+
     async def stream(self, subject, data):
+        """
+        Pipelined JetStream publish.
+        Returns once the publish is underway, the ack is gathered in the background.
+        Up to stream_window publishes may await acks, after which this blocks until one completes (backpressure).
+
+        Per subject order is preserved: publishes leave in call order on one connection, which JetStream stores in order.
+        When an ack times out, later publishes on the subject wait while every unacked message on it is republished
+        one at a time in call order, up to stream_retries times.
+        Republished messages keep their Nats-Msg-Id, so the ones that were stored but not acked are deduplicated.
+        Publishes on the subject are also held as soon as an ack overtakes an earlier message.
+        The one case this can not repair is the server dropping a message but storing the later ones already in flight,
+        it is logged and counted in stream_reorder_count.
+
+        :returns: Future resolving to True once the message was stored, False if it never was.
+        """
         if not data:
             log.error("No data?!")
             return
-        data = msgpack.packb(data)
+        payload = self.serializer.packb(data)
+        state = self.stream_subjects.get(subject)
+        if state is None:
+            state = self.stream_subjects[subject] = Subject_Stream(subject)
+        window = self.stream_window_semaphore
+        await window.acquire()
+        await state.open.wait()
+        self.stream_sequence += 1
+        future = self.loop.create_future()
+        state.pending[self.stream_sequence] = (payload, future)
+        self.publish_metrics.stream_count += 1
+        self.publish_metrics.stream_in_flight += 1
+
+        def done(_):
+            self.publish_metrics.stream_in_flight -= 1
+            window.release()
+            self.stream_tasks.discard(future)
+        future.add_done_callback(done)
+        self.stream_tasks.add(future)
+        task = self.loop.create_task(self.stream_first_attempt(state, self.stream_sequence, payload))
+        state.first_attempts.add(task)
+        task.add_done_callback(state.first_attempts.discard)
+        return future
+
+    def stream_msg_id(self, sequence):
+        return f'{self.stream_id_prefix}-{sequence}'
+
+    def resolve_stream(self, state, sequence, stored):
+        (_, future) = state.pending.pop(sequence)
+        if stored:
+            state.last_acked = max(state.last_acked, sequence)
+        else:
+            self.publish_metrics.stream_failure_count += 1
+        future.set_result(stored)
+
+    async def stream_first_attempt(self, state, sequence, payload):
         try:
-            await self.js.publish(subject, data)
+            await self.js.publish(state.subject, payload,
+                                  timeout=self.stream_timeout_s,
+                                  headers={'Nats-Msg-Id': self.stream_msg_id(sequence)})
+            self.resolve_stream(state, sequence, True)
+            self.update_stream_gate(state)
         except nats.errors.TimeoutError:
-            log.error(f"{Fore.RED}Either the Jetstream server is down or you attempted to stream to an undeclared stream or subject: {subject=}{Fore.RESET}")
+            log.warn(f"{self.name}: Timed out waiting for ack on subject={state.subject}")
+            if state.recovery is None:
+                state.open.clear()
+                state.recovery = self.loop.create_task(self.stream_recover(state))
+        except Exception as e:
+            log.error(f"{self.name}: Could not stream to subject={state.subject}: {e}")
+            self.resolve_stream(state, sequence, False)
+            self.update_stream_gate(state)
+
+    @staticmethod
+    def update_stream_gate(state):
+        """
+        Acks arrive in publish order, an ack overtaking an earlier message means that message was probably lost:
+        hold later publishes until it is acked, or times out and is republished
+        """
+        if state.recovery is not None:
+            return
+        if state.pending and next(iter(state.pending)) < state.last_acked:
+            state.open.clear()
+        else:
+            state.open.set()
+
+    async def stream_recover(self, state):
+        """Republish the unacked messages of state one at a time in call order, while later publishes wait"""
+        try:
+            for attempt in range(self.stream_retries):
+                while state.first_attempts:
+                    await asyncio.wait(set(state.first_attempts))
+                if not state.pending:
+                    break
+                self.publish_metrics.stream_retry_count += 1
+                log.warn(f"{self.name}: Republishing {len(state.pending)} unacked messages on subject={state.subject}, "
+                         f"attempt {attempt + 1} of {self.stream_retries}")
+                for (sequence, (payload, _)) in list(state.pending.items()):
+                    try:
+                        ack = await self.js.publish(state.subject, payload,
+                                                    timeout=self.stream_timeout_s,
+                                                    headers={'Nats-Msg-Id': self.stream_msg_id(sequence)})
+                    except nats.errors.TimeoutError:
+                        break
+                    except Exception as e:
+                        log.error(f"{self.name}: Could not stream to subject={state.subject}: {e}")
+                        self.resolve_stream(state, sequence, False)
+                        continue
+                    if not ack.duplicate and state.last_acked > sequence:
+                        self.publish_metrics.stream_reorder_count += 1
+                        log.error(f"{Fore.RED}{self.name}: Message {sequence} on subject={state.subject} was stored "
+                                  f"after message {state.last_acked}{Fore.RESET}")
+                    self.resolve_stream(state, sequence, True)
+            if state.pending:
+                log.error(f"{Fore.RED}Either the Jetstream server is down or you attempted to stream to an undeclared stream or subject: subject={state.subject}{Fore.RESET}")
+            for sequence in list(state.pending):
+                self.resolve_stream(state, sequence, False)
+        finally:
+            state.recovery = None
+            state.open.set()
+
+    async def stream_many(self, messages):
+        """Pipeline JetStream publishes for [(subject, data)], and wait until all have been acked. Per subject order is preserved, see stream."""
+        futures = [await self.stream(subject, data) for (subject, data) in messages]
+        await asyncio.gather(*(future for future in futures if future))
+
+    async def flush(self):
+        """Round trip to the NATS server, everything published before this call has been processed once it returns"""
+        start = time.perf_counter()
+        self.pending_flush_bytes = 0
+        await self.nc.flush()
+        self.publish_metrics.record_flush(time.perf_counter() - start)
+
+    def flush_due(self):
+        if self.flush_policy is Flush_Policy.IMMEDIATE:
+            return True
+        if self.flush_policy is Flush_Policy.SIZE:
+            return self.pending_flush_bytes >= self.flush_size_bytes
+        return False  # INTERVAL, see periodic_flush
+
+    def update_flush_task(self):
+        """Start or stop periodic_flush to match flush_policy"""
+        interval = self.flush_policy is Flush_Policy.INTERVAL
+        if interval and not self.flush_task:
+            self.flush_task = self.loop.create_task(self.periodic_flush())
+        elif not interval and self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+    async def periodic_flush(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_ms / 1000)
+            if self.flush_policy is Flush_Policy.INTERVAL and self.pending_flush_bytes:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    log.error(f"{self.name}: Periodic flush failed: {e}")
+
+    async def periodic_publish_report(self):
+        while True:
+            await asyncio.sleep(self.publish_report_s)
+            await self.publish(f'Bifrost.Monitors.Services.{self.name}.Publish', self.publish_metrics.marshall())
 
-    async def publish(self, subject, data, reply=''):
+    async def publish(self, subject, data, reply='', flush=None):
+        """
+        flush=None: Flush according to flush_policy
+        flush=True: Force a flush, use when the message must reach the server before continuing (request/reply)
+        flush=False: Leave the message in the client buffer, caller is responsible for flushing
+        """
         try:
-            data = msgpack.packb(data)
+            data = self.serializer.packb(data)
             await self.nc.publish(subject, data, reply)
-            await self.nc.flush()
+            self.publish_metrics.publish_count += 1
+            self.publish_metrics.publish_bytes += len(data)
+            self.pending_flush_bytes += len(data)
+            if flush is None:
+                flush = self.flush_due()
+            if flush:
+                await self.flush()
         except nats.errors.BadSubjectError:
             log.error(f'The pattern: "{subject}" is an invalid NATS subject')
         except Exception as e:
@@ -227,10 +543,10 @@ class Service():
     async def request(self, subject, data=''):
         inbox = self.nc.new_inbox()
         sub = await self.nc.subscribe(inbox)
-        await self.publish(subject, data, inbox)
+        await self.publish(subject, data, inbox, flush=True)
         try:
             msg = await sub.next_msg(timeout=10)
-            msg = msgpack.unpackb(msg.data)
+            msg = self.serializer.control.unpackb(msg.data)
             return msg
         except nats.errors.TimeoutError:
             msg = f"No response from PUB/SUB network, or the service is taking longer than expected for call {subject} from {self.name}."
@@ -1,6 +1,9 @@
 from astropy.time import Time
-from datetime import datetime
-from ait.core import log
+from datetime import datetime, timezone
+from bisect import bisect_right
+from functools import lru_cache
+import numpy as np
+import time
 
 canonical_astropy_time_from_gps = (lambda gps_time:
                                    Time(gps_time,
@@ -19,13 +22,125 @@ def date_time_from_gps_s_ns(gps_seconds, gps_nano_seconds):
 def packet_time_stamp_from_gps_s_ns(tagged_packet):
     gps_t_s = tagged_packet.decoded_packet['seconds']
     gps_t_ns = tagged_packet.decoded_packet['nanoseconds']
-    return date_time_from_gps_s_ns(gps_t_s, gps_t_ns)
+    return GPS_Time.from_gps_s_ns(gps_t_s, gps_t_ns)
 
 
 def time_processed(tagged_packet):
-    return gps_timestamp_now()
+    return fast_gps_timestamp_now()
 
 
 utc_timestamp_now = (lambda: datetime.utcnow().strftime("%Y-%m-%d_%H-%M-%S"))
 
 gps_timestamp_now = (lambda: Time(Time.now(), format='gps', scale='tai', precision=9))
+
+
+# Fast path: GPS time as integer nanoseconds, formatted without astropy.
+# GPS time is in the TAI scale, so GPS to TAI ISO needs no leap seconds.
+# Only reading the UTC system clock needs the leap second table.
+
+NS = 1_000_000_000
+GPS_EPOCH_TAI_NS = 315964819 * NS  # 1980-01-06 00:00:19 TAI, as nanoseconds since 1970-01-01 without leap seconds
+
+_BUILTIN_LEAP_SECONDS = ((1972, 1, 10), (1972, 7, 11), (1973, 1, 12), (1974, 1, 13), (1975, 1, 14),
+                         (1976, 1, 15), (1977, 1, 16), (1978, 1, 17), (1979, 1, 18), (1980, 1, 19),
+                         (1981, 7, 20), (1982, 7, 21), (1983, 7, 22), (1985, 7, 23), (1988, 1, 24),
+                         (1990, 1, 25), (1991, 1, 26), (1992, 7, 27), (1993, 7, 28), (1994, 7, 29),
+                         (1996, 1, 30), (1997, 7, 31), (1999, 1, 32), (2006, 1, 33), (2009, 1, 34),
+                         (2012, 7, 35), (2015, 7, 36), (2017, 1, 37))
+
+
+@lru_cache(maxsize=1)
+def leap_second_table():
+    """([UTC unix seconds when TAI-UTC changes], [TAI-UTC seconds]), from erfa if possible"""
+    try:
+        import erfa
+        entries = [(int(y), int(m), int(tai_utc)) for (y, m, tai_utc) in erfa.leap_seconds.get() if y >= 1972]
+    except Exception as e:
+        from ait.core import log  # Only here, the rest of this module does not need ait
+        log.warn(f"Could not load leap seconds from erfa, using builtin table: {e}")
+        entries = _BUILTIN_LEAP_SECONDS
+    starts = [int(datetime(y, m, 1, tzinfo=timezone.utc).timestamp()) for (y, m, _) in entries]
+    offsets = [tai_utc for (_, _, tai_utc) in entries]
+    return (starts, offsets)
+
+
+def tai_minus_utc(utc_unix_s):
+    starts, offsets = leap_second_table()
+    i = bisect_right(starts, utc_unix_s) - 1
+    return offsets[i] if i >= 0 else 0
+
+
+def tai_ns_from_utc_ns(utc_ns):
+    """Vectorized: [UTC nanoseconds since 1970] -> [TAI nanoseconds since 1970, without leap seconds]"""
+    starts, offsets = leap_second_table()
+    utc_ns = np.asarray(utc_ns, dtype=np.int64)
+    i = np.searchsorted(np.array(starts, dtype=np.int64) * NS, utc_ns, side='right')
+    return utc_ns + np.array([0] + offsets, dtype=np.int64)[i] * NS
+
+
+def utc_ns_from_tai_ns(tai_ns):
+    """Vectorized: [TAI nanoseconds since 1970, without leap seconds] -> [UTC nanoseconds since 1970]"""
+    starts, offsets = leap_second_table()
+    tai_ns = np.asarray(tai_ns, dtype=np.int64)
+    tai_starts = (np.array(starts, dtype=np.int64) + np.array(offsets, dtype=np.int64)) * NS
+    i = np.searchsorted(tai_starts, tai_ns, side='right')
+    return tai_ns - np.array([0] + offsets, dtype=np.int64)[i] * NS
+
+
+def gps_ns_now():
+    utc_ns = time.time_ns()
+    tai_ns = utc_ns + tai_minus_utc(utc_ns // NS) * NS
+    return tai_ns - GPS_EPOCH_TAI_NS
+
+
+def iso_from_gps_ns(gps_ns):
+    """Vectorized: [GPS nanoseconds] -> [TAI ISO strings], same as astropy Time(format='iso', scale='tai', precision=9)"""
+    tai = np.asarray(gps_ns, dtype=np.int64) + np.int64(GPS_EPOCH_TAI_NS)
+    return np.char.replace(np.datetime_as_string(tai.astype('datetime64[ns]'), unit='ns'), 'T', ' ')
+
+
+class GPS_Time():
+    """
+    Lightweight stand in for astropy Time(format='gps', scale='tai', precision=9) on the packet path.
+    Stores integer nanoseconds since the GPS epoch.
+    Set format to 'iso' (like astropy) to get the ISO string from str().
+    """
+    __slots__ = ('gps_ns', 'format')
+
+    def __init__(self, gps_ns, format='gps'):
+        self.gps_ns = int(gps_ns)
+        self.format = format
+
+    @classmethod
+    def from_gps_s_ns(cls, gps_seconds, gps_nano_seconds):
+        return cls(int(gps_seconds) * NS + int(gps_nano_seconds))
+
+    @property
+    def iso(self):
+        return str(iso_from_gps_ns(self.gps_ns))
+
+    @property
+    def gps(self):
+        return self.gps_ns / NS
+
+    def to_astropy(self):
+        t = Time(self.gps_ns // NS, (self.gps_ns % NS) / NS, format='gps', scale='tai', precision=9)
+        t.format = self.format
+        return t
+
+    def __str__(self):
+        if self.format == 'iso':
+            return self.iso
+        return str(self.gps)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.gps_ns}, format='{self.format}')"
+
+    def __eq__(self, other):
+        return isinstance(other, GPS_Time) and self.gps_ns == other.gps_ns
+
+    def __hash__(self):
+        return hash(self.gps_ns)
+
+
+fast_gps_timestamp_now = (lambda: GPS_Time(gps_ns_now()))
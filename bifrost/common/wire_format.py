@@ -0,0 +1,29 @@
+"""
+Frames and packets are carried on the wire either as msgpack bin (binary wire format)
+or as hex strings (legacy wire format). Consumers should accept both.
+"""
+
+
+def to_bytes(value):
+    """Return the raw bytes for a field that may have been shipped as hex or as bin"""
+    if isinstance(value, str):
+        return bytes.fromhex(value)
+    return value
+
+
+def encode_bytes(value, binary=False):
+    """Encode a raw bytes field for the wire"""
+    if binary:
+        return bytes(value)
+    return value.hex()
+
+
+def hexify(message):
+    """Compatibility shim for hex consumers (JSON, web UI): convert any bytes in message to hex"""
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return bytes(message).hex()
+    if isinstance(message, dict):
+        return {k: hexify(v) for (k, v) in message.items()}
+    if isinstance(message, (list, tuple)):
+        return [hexify(v) for v in message]
+    return message
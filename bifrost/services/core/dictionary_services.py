@@ -22,6 +22,7 @@ class Command_Dictionary_Service(Service):
         self.cmd_dict = cmd.getDefaultDict(True)
         self.tlm_dict = tlm.getDefaultDict(True) # Purely for reload side effect
         log.info("Dictionaries reloaded!")
+        await self.publish('Bifrost.Dictionaries.Reloaded', None)
         return
 
     @with_loud_coroutine_exception
@@ -4,17 +4,41 @@ from ait.core import log
 import ait
 import traceback
 from bifrost.services.downlink.alarms import Alarm_State
+from bifrost.services.core.influx_writer import Influx_Batch_Writer, encode_tags, iso_to_ns
+from bifrost.common.time_utility import utc_ns_from_tai_ns
 from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS
 import urllib3
-import json
+import asyncio
+import time
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
 class Influx(Service):
+    """
+    Writes telemetry and command history to InfluxDB through a batching line protocol writer.
+    Writer metrics are published on Bifrost.Monitors.Influx every report_time seconds.
+    Packet times are TAI, they are converted to UTC for the point timestamps so they line up with wall clock queries.
+
+    - service:
+        name: bifrost.services.core.influx.Influx
+        host_url: https://localhost:8086
+        api_token: ...
+        org: bifrost
+        write_batch_size: 5000  # Points per write
+        flush_interval_s: 1  # Max time a point waits for a batch to fill
+        max_pending_points: 500000  # Points buffered while InfluxDB is slow or down, further points are dropped
+        write_retries: 3
+    """
     @with_loud_exception
     def __init__(self):
         super().__init__()
+        self.writer = None
+        self.write_batch_size = 5000  # Not batch_size, which sizes batch_streams fetches
+        self.flush_interval_s = 1
+        self.max_pending_points = 500000
+        self.write_retries = 3
+        self.report_time = 5
+        self.loop.create_task(self.periodic_writer_report())
         self.start()
 
     @with_loud_coroutine_exception
@@ -23,6 +47,16 @@ class Influx(Service):
         self.sv_name = await self.config_request_sv_name()
         await super().reconfigure(topic, message, reply)
         self.setup_connection()
+        if self.writer:
+            await self.loop.run_in_executor(None, self.writer.close)
+        self.writer = Influx_Batch_Writer(self.host_url, self.api_token, self.org, self.sv_name,
+                                          batch_size=self.write_batch_size,
+                                          flush_interval_s=self.flush_interval_s,
+                                          max_pending_points=self.max_pending_points,
+                                          retries=self.write_retries)
+        self.command_tags = encode_tags({'sv_name': self.sv_name,
+                                         'pass_id': str(self.pass_id),
+                                         'user': 'Future'})
 
     @with_loud_exception
     def setup_connection(self):
@@ -43,6 +77,13 @@ class Influx(Service):
                 log.error(traceback.print_exc())
                 raise e
 
+    @with_loud_coroutine_exception
+    async def periodic_writer_report(self):
+        while True:
+            await asyncio.sleep(self.report_time)
+            if self.writer:
+                await self.publish('Bifrost.Monitors.Influx', self.writer.marshall())
+
     @with_loud_coroutine_exception
     async def write_dataframe(self, topic, data, reply):
         def process_df(task):
@@ -66,57 +107,41 @@ class Influx(Service):
         cmd_struct.pop('processors')
         cmd_struct.pop('payload_bytes')
         fields = cmd_struct
-        t = fields['start_time_gps']
-        #t.format = 'iso'
-        #t = t.datetime.isoformat("T") + "Z"
-        d = [{'time': t,
-              'measurement': 'BIFROST_COMMAND_HISTORY',
-              'fields': fields,
-              'tags': {'sv_name': self.sv_name,
-                       'pass_id': str(self.pass_id),
-                       'user': 'Future'},
-              }]
-        with self.client.write_api(write_options=SYNCHRONOUS) as f:
-            f.write(bucket=self.sv_name, record=d)
+        try:
+            t = iso_to_ns(fields['start_time_gps'])
+        except ValueError:
+            t = time.time_ns()
+        self.writer.write_point('BIFROST_COMMAND_HISTORY', self.command_tags, fields, t)
+
+    @staticmethod
+    def alarm_tags(field_names, states, pass_id):
+        """{alarm state: 'field, field, ...', 'pass_id': pass_id}"""
+        alarm_tags = {}
+        for (field_name, c) in zip(field_names, states):
+            if c in alarm_tags:
+                alarm_tags[c] += f", {field_name}"
+            else:
+                alarm_tags[c] = f"{field_name}"
+        alarm_tags['pass_id'] = pass_id
+        return alarm_tags
 
     @with_loud_coroutine_exception
     async def write_telemetry(self, topic, data, reply):
         # Consider using Jetstream instead
-        #log.info(f'{json.dumps(data)=}')
         try:
             packet_metadata = data
             packet_name = packet_metadata['packet_name']
             decoded = packet_metadata['decoded_packet']
             alarms = packet_metadata['field_alarms']
-            gps_timestamp = packet_metadata['packet_time']
             pass_id = packet_metadata['pass_id']
-            alarm_tags = {c.name: None for c in Alarm_State}
-            fields = {}
-            tags = {}
-            alarm_tags = {c.name: None for c in Alarm_State}
-            for (field_name, value) in decoded.items():
-                val = value
-                c = alarms[field_name]['state']
-                if alarm_tags[c]:
-                    alarm_tags[c] += f", {field_name}"
-                else:
-                    alarm_tags[c] = f"{field_name}"
-
-                fields[field_name] = val
-
-            # TODO: Python 3.9 -> tags = tags | alarm_tags
-            tags = {**alarm_tags, **tags}
-            tags['pass_id'] = pass_id
-
-            #gps_timestamp.format = 'iso'
-            #time = gps_timestamp.datetime.isoformat("T") + "Z"
-            data = {"time": gps_timestamp,
-                    "measurement": packet_name,
-                    "tags": tags,
-                    "fields": fields}
-
-            with self.client.write_api(write_options=SYNCHRONOUS) as f:
-                f.write(bucket=self.sv_name, record=data)
+            field_names = tuple(decoded)
+            states = tuple(alarms[field_name]['state'] for field_name in field_names)
+            tags = self.writer.template(packet_name).tag_set((pass_id, field_names, states),
+                                                             lambda: self.alarm_tags(field_names, states, pass_id))
+            self.writer.write_point(packet_name,
+                                    tags,
+                                    decoded,
+                                    int(utc_ns_from_tai_ns(iso_to_ns(packet_metadata['packet_time']))))
 
         except Exception as e:
             log.error(f"Data archival failed with error: {e}")
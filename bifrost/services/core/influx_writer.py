@@ -0,0 +1,220 @@
+"""
+Batched InfluxDB v2 writer.
+
+Points are encoded straight to line protocol on the caller's thread, using a template per measurement
+that holds the escaped measurement name and field keys.
+Lines are buffered and posted to /api/v2/write by a background thread once batch_size lines are pending
+or flush_interval_s has passed. Failed batches are retried with backoff, 4xx responses other than 429 are not retried.
+At most max_pending_points lines are buffered, points beyond that are dropped and counted.
+
+Only the standard library is used on the write path, any HTTP server that speaks /api/v2/write can stand in for InfluxDB.
+"""
+from ait.core import log
+from collections import deque
+from dataclasses import dataclass
+from urllib.parse import urlencode
+import urllib.request
+import urllib.error
+import numpy as np
+import threading
+import math
+import time
+import ssl
+
+
+def escape_key(s):
+    """Measurement names, tag keys, tag values and field keys"""
+    return str(s).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def escape_measurement(s):
+    return str(s).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+
+
+def encode_field_value(value):
+    """Line protocol field value, None for values line protocol can not carry (NaN, +-inf)"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, np.integer)):
+        return f'{value}i'
+    if isinstance(value, (float, np.floating)):
+        if not math.isfinite(value):
+            return None
+        return repr(float(value))
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+
+def iso_to_ns(iso_time):
+    """ISO timestamp (as marshalled by Bifrost, read as UTC like the InfluxDB client does) to integer nanoseconds"""
+    return int(np.datetime64(str(iso_time).rstrip('Z').replace(' ', 'T'), 'ns').astype(np.int64))
+
+
+class Line_Protocol_Template():
+    """Precompiled line protocol for one measurement"""
+    __slots__ = ('measurement', 'field_keys', 'tag_sets')
+    max_tag_sets = 4096
+
+    def __init__(self, measurement):
+        self.measurement = escape_measurement(measurement)
+        self.field_keys = {}
+        self.tag_sets = {}
+
+    def tag_set(self, key, tags):
+        """Encoded tag set cached by key, tags() builds the {tag: value} dict on a miss"""
+        encoded = self.tag_sets.get(key)
+        if encoded is None:
+            if len(self.tag_sets) >= self.max_tag_sets:
+                self.tag_sets.clear()
+            encoded = self.tag_sets[key] = encode_tags(tags())
+        return encoded
+
+    def field_key(self, name):
+        key = self.field_keys.get(name)
+        if key is None:
+            key = self.field_keys[name] = f'{escape_key(name)}='
+        return key
+
+    def encode(self, tags, fields, timestamp_ns):
+        """
+        :param tags: Encoded tag set, ',key=value,...' or ''
+        :param fields: {name: value}, None values and values line protocol can not carry (NaN, +-inf) are skipped
+        """
+        encoded_fields = []
+        for (name, value) in fields.items():
+            if value is None:
+                continue
+            encoded = encode_field_value(value)
+            if encoded is not None:
+                encoded_fields.append(self.field_key(name) + encoded)
+        field_set = ','.join(encoded_fields)
+        if not field_set:
+            return None
+        return f'{self.measurement}{tags} {field_set} {timestamp_ns}'
+
+
+def encode_tags(tags):
+    """{key: value} to ',key=value,...' sorted by key, None and empty values are skipped"""
+    return ''.join(f',{escape_key(k)}={escape_key(v)}' for (k, v) in sorted(tags.items()) if v not in (None, ''))
+
+
+@dataclass
+class Influx_Writer_Metrics():
+    points_written: int = 0
+    points_dropped: int = 0
+    batches: int = 0
+    batch_size_max: int = 0
+    retries: int = 0
+    failed_batches: int = 0
+    last_points_written: int = 0
+    last_report: float = 0
+
+    def marshall(self, pending):
+        now = time.monotonic()
+        elapsed = now - self.last_report if self.last_report else 0
+        res = {
+            'points_written': self.points_written,
+            'points_dropped': self.points_dropped,
+            'points_pending': pending,
+            'batches': self.batches,
+            'batch_size_mean': self.points_written / self.batches if self.batches else 0,
+            'batch_size_max': self.batch_size_max,
+            'retries': self.retries,
+            'failed_batches': self.failed_batches,
+            'points_per_second': (self.points_written - self.last_points_written) / elapsed if elapsed else 0,
+        }
+        self.last_points_written = self.points_written
+        self.last_report = now
+        return res
+
+
+class Influx_Batch_Writer():
+    def __init__(self, url, token, org, bucket, batch_size=5000, flush_interval_s=1,
+                 max_pending_points=500000, retries=3, retry_backoff_s=0.5, timeout_s=10, verify_ssl=False):
+        self.write_url = f"{url.rstrip('/')}/api/v2/write?" + urlencode({'org': org, 'bucket': bucket, 'precision': 'ns'})
+        self.headers = {'Authorization': f'Token {token}', 'Content-Type': 'text/plain; charset=utf-8'}
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.max_pending_points = max_pending_points
+        self.retries = retries
+        self.retry_backoff_s = retry_backoff_s
+        self.timeout_s = timeout_s
+        self.ssl_context = None
+        if not verify_ssl:
+            self.ssl_context = ssl.create_default_context()
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.templates = {}
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.metrics = Influx_Writer_Metrics()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='Influx_Batch_Writer', daemon=True)
+        self.thread.start()
+
+    def template(self, measurement):
+        template = self.templates.get(measurement)
+        if template is None:
+            template = self.templates[measurement] = Line_Protocol_Template(measurement)
+        return template
+
+    def write_point(self, measurement, tags, fields, timestamp_ns):
+        """:param tags: Encoded tag set, see encode_tags"""
+        line = self.template(measurement).encode(tags, fields, timestamp_ns)
+        if line:
+            self.write_line(line)
+
+    def write_line(self, line):
+        with self.condition:
+            if len(self.pending) >= self.max_pending_points:
+                self.metrics.points_dropped += 1
+                return
+            self.pending.append(line)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def marshall(self):
+        return self.metrics.marshall(len(self.pending))
+
+    def close(self, timeout=None):
+        """Write everything pending and stop the writer thread"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout)
+
+    def take_batch(self):
+        with self.condition:
+            if self.running and len(self.pending) < self.batch_size:
+                self.condition.wait(self.flush_interval_s)
+            n = min(len(self.pending), self.batch_size)
+            return [self.pending.popleft() for _ in range(n)]
+
+    def run(self):
+        while self.running or self.pending:
+            batch = self.take_batch()
+            if batch:
+                self.post(batch)
+
+    def post(self, batch):
+        body = '\n'.join(batch).encode()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.metrics.retries += 1
+                time.sleep(self.retry_backoff_s * 2 ** (attempt - 1))
+            try:
+                request = urllib.request.Request(self.write_url, data=body, headers=self.headers, method='POST')
+                with urllib.request.urlopen(request, timeout=self.timeout_s, context=self.ssl_context):
+                    pass
+                self.metrics.points_written += len(batch)
+                self.metrics.batches += 1
+                self.metrics.batch_size_max = max(self.metrics.batch_size_max, len(batch))
+                return
+            except urllib.error.HTTPError as e:
+                log.error(f"InfluxDB write failed with {e.code}: {e.read()[:200]}")
+                if 400 <= e.code < 500 and e.code != 429:
+                    break
+            except Exception as e:
+                log.error(f"InfluxDB write failed: {e}")
+        self.metrics.failed_batches += 1
+        self.metrics.points_dropped += len(batch)
@@ -1,12 +1,30 @@
 from bifrost.common.service import Service
 from bifrost.common.loud_exception import with_loud_coroutine_exception, with_loud_exception
-from bifrost.common.disk_writer import Disk_Writer
+from bifrost.common.disk_writer import Disk_Writer, Fsync_Policy
 import asyncio
 
 
 class Monitor(Service):
+    """
+    Records the latest value of every monitor to disk every report_time seconds.
+
+    - service:
+        name: bifrost.services.core.monitoring.Monitor
+        fsync_policy: INTERVAL  # <NEVER|INTERVAL|BYTES|ALWAYS>
+        fsync_interval_s: 1
+        rotate_bytes: 0  # Rotate the monitor file once it exceeds this size, 0 disables
+        indented_records: False  # Write indent=4 JSON records separated by blank lines, as before NDJSON
+        topics:
+          process:
+            - 'Bifrost.Monitors.>'
+    """
     @with_loud_exception
     def __init__(self):
+        self.disk_writer = None
+        self.fsync_policy = Fsync_Policy.INTERVAL
+        self.fsync_interval_s = 1
+        self.rotate_bytes = 0
+        self.indented_records = False
         super().__init__()
         self.loop.create_task(self.periodic_report())
         self.report_time = 5
@@ -21,9 +39,9 @@ class Monitor(Service):
         while True:
             await asyncio.sleep(self.report_time)
             if not self.disk_writer:
-                return
-            self.disk_writer.write_to_disk(self.data_map)
-            
+                continue
+            self.disk_writer.write_to_disk(dict(self.data_map))
+            await self.publish('Bifrost.Monitors.Disk_Writer.Monitor', self.disk_writer.marshall())
 
     @with_loud_coroutine_exception
     async def reconfigure(self, topic, message, reply):
@@ -31,7 +49,13 @@ class Monitor(Service):
         self.pass_id = await self.config_request_value("global.mission.pass_id")
         self.downlink_path = await self.config_request_downlink_path()
         self.sv_name = await self.config_request_value('instance.space_vehicle.name')
-        self.disk_writer = Disk_Writer("../monitors", "", 'monitors',
-                                       self.pass_id, self.downlink_path, self.sv_name)
         await super().reconfigure(topic, message, reply)
+        if self.disk_writer:
+            await self.loop.run_in_executor(None, self.disk_writer.close)
+        self.disk_writer = Disk_Writer("../monitors", "", 'monitors',
+                                       self.pass_id, self.downlink_path, self.sv_name,
+                                       fsync_policy=self.fsync_policy,
+                                       fsync_interval_s=self.fsync_interval_s,
+                                       rotate_bytes=self.rotate_bytes,
+                                       indented_records=self.indented_records)
         return
@@ -11,8 +11,18 @@ from starlette.middleware.cors import CORSMiddleware
 from bifrost.common.loud_exception import with_loud_coroutine_exception, with_loud_exception
 
 from bifrost.common.service import Service
+from bifrost.common.wire_format import hexify
+from bifrost.common.downsample import downsamplers, select
+from bifrost.common.time_utility import tai_ns_from_utc_ns, utc_ns_from_tai_ns
+from bifrost.services.downlink.parquet_store import Parquet_Telemetry_Reader
+from bifrost.services.core.websocket_hub import (Websocket_Hub, Hub_Client, Display_Client, Client_Policy,
+                                                 subject_message, hex_subject_message, hex_message)
+from collections import OrderedDict
+from pathlib import Path
+import threading
+import math
+import asyncio
 import uvicorn
-import msgpack
 import ait.core.tlm
 import ait.core.cmd
 import ait.core.log as log
@@ -20,10 +30,35 @@ from colorama import Fore
 
 
 class Web_Server(Service):
+    """
+    Websocket clients share one NATS subscription per subject pattern through the hub.
+    Each client has a bounded queue, ?policy=<drop_oldest|latest_value>&queue_size=<n> on the websocket URL
+    overrides the endpoint default. Per client lag and drops are published on Bifrost.Monitors.Web_Server.Clients.
+    ?format=msgpack switches a websocket to binary frames holding the msgpack array [subject, message],
+    the NATS payload is forwarded as is with no decoding (bytes stay bytes, no hexify).
+
+    - service:
+        name: bifrost.services.core.web.Web_Server
+        client_queue_size: 1000
+        client_report_time: 5
+        max_display_rate_hz: 10
+        telemetry_stream_pattern: 'Telemetry.AOS.VCID.*.TaggedPacket.Decoded'
+        telemetry_packet_pattern: 'Telemetry.AOS.VCID.*.TaggedPacket.{packet_name}'
+    """
     @with_loud_exception
     def __init__(self):
         super().__init__()
         self.index = './gjallarhorn/simple_web_prototype/'
+        self.history_reader = None
+        self.history_cache = OrderedDict()
+        self.history_cache_size = 256
+        self.history_lock = threading.Lock()
+        self.client_queue_size = 1000
+        self.client_report_time = 5
+        self.max_display_rate_hz = 10
+        self.telemetry_packet_pattern = 'Telemetry.AOS.VCID.*.TaggedPacket.{packet_name}'
+        self.hub = Websocket_Hub(self.nc, self.serializer)
+        self.loop.create_task(self.periodic_client_report())
         self.start()
 
     @with_loud_coroutine_exception
@@ -35,7 +70,11 @@ class Web_Server(Service):
 
     @with_loud_coroutine_exception
     async def reconfigure(self, topic, message, reply):
+        self.downlink_path = await self.config_request_downlink_path()
         await super().reconfigure(topic, message, reply)
+        self.hub.serializer = self.serializer
+        self.history_reader = Parquet_Telemetry_Reader(Path(self.downlink_path) / 'telemetry')
+        self.history_cache.clear()
         self.middleware = [Middleware(CORSMiddleware, allow_origins=['*'])] # Don't do this!
         self.app = Starlette(debug=True,
                              routes=[
@@ -47,6 +86,8 @@ class Web_Server(Service):
                                  WebSocketRoute('/subscribe', endpoint=self.ws_subscribe),
                                  WebSocketRoute("/service_directive", self.ws_service_directive),
                                  Route("/dict/{dict_type:str}", self.dict),
+                                 Route("/history/{packet_name:str}/{field_name:str}", self.telemetry_history),
+                                 Route("/cvt", self.cvt_snapshot),
                                  Route("/sle/raf/{directive:str}", self.sle_raf_directive),
                                  Route("/sle/cltu/{directive:str}", self.sle_cltu_directive),
                                  Route("/config", self.config_request),
@@ -61,46 +102,171 @@ class Web_Server(Service):
         return JSONResponse(self.name)
 
     @with_loud_coroutine_exception
-    async def ws_subscribe(self, websocket):
+    async def periodic_client_report(self):
+        while True:
+            await asyncio.sleep(self.client_report_time)
+            if self.hub.clients:
+                await self.publish('Bifrost.Monitors.Web_Server.Clients', self.hub.marshall())
+
+    async def hub_client(self, websocket, endpoint, policy=Client_Policy.DROP_OLDEST, display=False):
+        """
+        Client for an accepted websocket, configured by its policy, queue_size, format and rate query params.
+        Bad params close the websocket with 1008 (policy violation) and return None.
+        """
+        q = websocket.query_params
         try:
-            await websocket.accept()
-            while True:
-                req = await websocket.receive_json()
-                topic_request = req['topic']
-                sub = await self.nc.subscribe(topic_request)
-                async for msg in sub.messages:
-                    d = msgpack.unpackb(msg.data)
-                    m = {'subject': msg.subject,
-                         'message': d}
-                    await websocket.send_json(m)
-        except WebSocketDisconnect:
-            pass
-        except TypeError:
-            print(f'{m} is not JSONable')
-        except ConnectionClosed:
+            if 'policy' in q:
+                if q['policy'].upper() not in Client_Policy.__members__:
+                    raise ValueError(f"policy {q['policy']} is not <{'|'.join(Client_Policy.__members__)}>")
+                policy = Client_Policy[q['policy'].upper()]
+            queue_size = int(q.get('queue_size', self.client_queue_size))
+            if queue_size < 1:
+                raise ValueError(f"queue_size {queue_size} is not >= 1")
+            data_format = q.get('format', 'json')
+            if data_format not in ('json', 'msgpack'):
+                raise ValueError(f"format {data_format} is not <json|msgpack>")
+            rate_hz = float(q['rate']) if display and 'rate' in q else None
+            if rate_hz is not None and not (math.isfinite(rate_hz) and rate_hz > 0):
+                raise ValueError(f"rate {q['rate']} is not a positive number")
+        except ValueError as e:
+            log.warn(f"Rejected websocket {endpoint}: {e}")
+            await websocket.close(code=1008)
+            return None
+        binary = data_format == 'msgpack'
+        if rate_hz is not None:
+            rate_hz = min(max(rate_hz, 0.1), self.max_display_rate_hz)
+            return Display_Client(websocket, endpoint, rate_hz, queue_size, binary)
+        return Hub_Client(websocket, endpoint, policy, queue_size, binary)
+
+    async def serve_hub_client(self, client, patterns, formatter=subject_message, on_message=None):
+        """Fan out patterns to client until it disconnects"""
+        try:
+            for pattern in patterns:
+                await self.hub.join(client, pattern, formatter)
+            await client.run(on_message)
+        except (WebSocketDisconnect, ConnectionClosed):
             log.info("Websocket Connection closed.")
         except Exception as e:
             log.error(e)
+        finally:
+            await self.hub.leave_all(client)
+
+    @with_loud_coroutine_exception
+    async def ws_subscribe(self, websocket):
+        await websocket.accept()
+        client = await self.hub_client(websocket, 'subscribe')
+        if client is None:
+            return
+
+        async def on_message(req):
+            await self.hub.join(client, req['topic'], hex_subject_message)
+        await self.serve_hub_client(client, [], hex_subject_message, on_message)
 
     @with_loud_coroutine_exception
     async def ws_telemetry(self, websocket):
-        try:
-            await websocket.accept()
-            if websocket.query_params.get('filter', {}):
-                subscriptions = await websocket.receive_json()
+        """
+        Without ?filter=1 every decoded packet is sent.
+        With ?filter=1 each packet the client asks for is its own NATS subscription on telemetry_packet_pattern,
+        packets nobody asked for never reach this process. The client may change its packets at any time:
+            ["Packet_A", "Packet_B"]  Subscribe to exactly these packets
+            {"add": ["Packet_C"]}
+            {"remove": ["Packet_A"]}
+        ?rate=<hz> makes it a display stream: the latest packet per (packet_name, vcid) is sent as a snapshot list
+        at most rate times a second (up to max_display_rate_hz), alarm transitions are sent at once.
+        """
+        await websocket.accept()
+        client = await self.hub_client(websocket, 'telemetry', display=True)
+        if client is None:
+            return
+        if not websocket.query_params.get('filter', {}):
+            await self.serve_hub_client(client, [self.telemetry_stream_pattern], hex_message)
+            return
+
+        packets = set()
+
+        async def on_message(req):
+            if isinstance(req, dict):
+                (add, remove) = (set(req.get('add', [])), set(req.get('remove', [])))
             else:
-                subscriptions = ait.core.tlm.getDefaultDict()
-            sub = await self.nc.subscribe(self.telemetry_stream_pattern)
-            async for msg in sub.messages:
-                d = msgpack.unpackb(msg.data)
-                if d['packet_name'] in subscriptions:
-                    await websocket.send_json(d)
-        except WebSocketDisconnect:
-            pass
-        except ConnectionClosed:
-            log.info("Websocket Connection closed.")
-        except Exception as e:
-            log.error(e)
+                (add, remove) = (set(req), packets - set(req))
+            for packet_name in remove & packets:
+                await self.hub.leave(client, self.telemetry_packet_pattern.format(packet_name=packet_name), hex_message)
+                packets.discard(packet_name)
+            tlm_dict = ait.core.tlm.getDefaultDict()
+            for packet_name in add - packets:
+                if packet_name not in tlm_dict:  # Also keeps wildcards out of the subject
+                    log.warn(f"Websocket {client.name} requested unknown packet {packet_name}")
+                    continue
+                await self.hub.join(client, self.telemetry_packet_pattern.format(packet_name=packet_name), hex_message)
+                packets.add(packet_name)
+        await self.serve_hub_client(client, [], hex_message, on_message)
+
+    @with_loud_coroutine_exception
+    async def telemetry_history(self, request):
+        """
+        /history/{packet_name}/{field_name}?start=<ms>&end=<ms>&max_points=<n>&method=<minmax|lttb|latest>
+        Times are UTC milliseconds since 1970 of the packet time, as used by OpenMCT.
+        Packet times are stored as TAI, they are converted both ways with the leap second table.
+        latest returns the last max_points points of the range instead of downsampling it.
+        """
+        if self.history_reader is None:
+            return JSONResponse("History is not available until the service is configured", status_code=503)
+        q = request.query_params
+        method = q.get('method', 'minmax')
+        if method not in downsamplers:
+            return JSONResponse(f"{method} is not <{'|'.join(downsamplers)}>", status_code=400)
+        try:
+            start_ns = int(tai_ns_from_utc_ns(int(float(q['start']) * 1e6))) if 'start' in q else None
+            end_ns = int(tai_ns_from_utc_ns(int(float(q['end']) * 1e6))) if 'end' in q else None
+            max_points = int(q.get('max_points', 2000))
+        except (ValueError, OverflowError) as e:
+            return JSONResponse(f"Bad start, end or max_points: {e}", status_code=400)
+        if max_points < 1:
+            return JSONResponse(f"max_points {max_points} is not >= 1", status_code=400)
+        if start_ns is not None and end_ns is not None and start_ns > end_ns:
+            return JSONResponse(f"start {q['start']} is after end {q['end']}", status_code=400)
+        res = await self.loop.run_in_executor(None, self.history_query,
+                                              request.path_params['packet_name'],
+                                              request.path_params['field_name'],
+                                              start_ns, end_ns, max_points, method)
+        return JSONResponse(res)
+
+    def history_query(self, packet_name, field_name, start_ns, end_ns, max_points, method):
+        key = (packet_name, field_name, start_ns, end_ns, max_points, method,
+               self.history_reader.generation(packet_name))
+        with self.history_lock:
+            if key in self.history_cache:
+                self.history_cache.move_to_end(key)
+                return self.history_cache[key]
+
+        (times, values) = self.history_reader.read(packet_name, field_name, start_ns, end_ns)
+        (selected, selected_values) = select(times, values, max_points, method)
+        res = {
+            'packet_name': packet_name,
+            'field_name': field_name,
+            'total_points': len(times),
+            'method': method,
+            'timestamps': (utc_ns_from_tai_ns(times[selected]) / 1e6).tolist(),
+            'values': selected_values,
+        }
+
+        with self.history_lock:
+            self.history_cache[key] = res
+            while len(self.history_cache) > self.history_cache_size:
+                self.history_cache.popitem(last=False)
+        return res
+
+    @with_loud_coroutine_exception
+    async def cvt_snapshot(self, request):
+        """
+        /cvt?point=<name or glob>&point=...
+        Current values from CVT_Service, every point without a point parameter.
+        """
+        points = request.query_params.getlist('point')
+        res = await self.request('Bifrost.Services.CVT.Get', points or None)
+        if not isinstance(res, dict):
+            return JSONResponse(res, status_code=503)
+        return JSONResponse(hexify(res))
 
     @with_loud_coroutine_exception
     async def tlm_dict(self, request):
@@ -149,43 +315,19 @@ class Web_Server(Service):
 
     @with_loud_coroutine_exception
     async def ws_variable_messages(self, websocket):
-        try:
-            await websocket.accept()
-            while True:
-                sub = await self.nc.subscribe('Bifrost.Messages.>')
-                async for msg in sub.messages:
-                    d = msgpack.unpackb(msg.data)
-                    m = {'topic': msg.subject,
-                         'message': d}
-                    await websocket.send_json(m)
-        except WebSocketDisconnect:
-            pass
-        except TypeError:
-            print(f'{m} is not JSONable')
-        except ConnectionClosed:
-            log.info("Websocket Connection closed.")
-        except Exception as e:
-            log.error(e)
+        await websocket.accept()
+        client = await self.hub_client(websocket, 'variable_messages')
+        if client is None:
+            return
+        await self.serve_hub_client(client, ['Bifrost.Messages.>'])
 
     @with_loud_coroutine_exception
     async def ws_monitors(self, websocket):
-        try:
-            await websocket.accept()
-            while True:
-                sub = await self.nc.subscribe('Bifrost.Monitors.>')
-                async for msg in sub.messages:
-                    d = msgpack.unpackb(msg.data)
-                    m = {'topic': msg.subject,
-                         'message': d}
-                    await websocket.send_json(m)
-        except WebSocketDisconnect:
-            pass
-        except TypeError:
-            print(f'{m} is not JSONable')
-        except ConnectionClosed:
-            log.info("Websocket Connection closed.")
-        except Exception as e:
-            log.error(e)
+        await websocket.accept()
+        client = await self.hub_client(websocket, 'monitors', Client_Policy.LATEST_VALUE)
+        if client is None:
+            return
+        await self.serve_hub_client(client, ['Bifrost.Monitors.>'])
 
     @with_loud_coroutine_exception
     async def sle_raf_directive(self, request):
@@ -217,19 +359,11 @@ class Web_Server(Service):
 
     @with_loud_coroutine_exception
     async def ws_downlink_updates(self, websocket):
-        try:
-            await websocket.accept()
-            while True:
-                sub = await self.nc.subscribe(self.downlink_update_pattern)
-                async for msg in sub.messages:
-                    d = msgpack.unpackb(msg.data)
-                    m = {'topic': msg.subject,
-                         'message': d}
-                    await websocket.send_json(m)
-        except WebSocketDisconnect:
-            pass
-        except TypeError:
-            print(f'{m} is not JSONable')
+        await websocket.accept()
+        client = await self.hub_client(websocket, 'downlink_updates')
+        if client is None:
+            return
+        await self.serve_hub_client(client, [self.downlink_update_pattern])
 
 
 # TODO: This is all junk, rewrite in golang.
@@ -0,0 +1,307 @@
+from bifrost.common.wire_format import hexify
+from ait.core import log
+from collections import deque, OrderedDict
+from dataclasses import dataclass
+from enum import Enum, auto
+import asyncio
+import json
+import msgpack
+import itertools
+import time
+
+
+class Client_Policy(Enum):
+    DROP_OLDEST = auto()  # Bounded FIFO, the oldest message is dropped when the client falls behind
+    LATEST_VALUE = auto()  # Only the latest message per subject is kept until the client catches up
+
+
+def subject_message(subject, data):
+    return {'topic': subject, 'message': data}
+
+
+def hex_subject_message(subject, data):
+    return {'subject': subject, 'message': hexify(data)}
+
+
+def hex_message(subject, data):
+    return hexify(data)
+
+
+def encode_json(message):
+    return json.dumps(message, separators=(',', ':'), ensure_ascii=False)
+
+
+MSGPACK_ARRAY_2 = b'\x92'
+
+
+def msgpack_frame(subject, payload):
+    """
+    Binary websocket frame, the msgpack array [subject, message].
+    payload is already msgpack, it is appended as is and never decoded.
+    """
+    return MSGPACK_ARRAY_2 + msgpack.packb(subject) + payload
+
+
+def alarm_summary(tagged_packet):
+    """(field, state) of every field that is not GREEN"""
+    return tuple((field, alarm['state']) for (field, alarm) in tagged_packet['field_alarms'].items()
+                 if alarm['state'] != 'GREEN')
+
+
+@dataclass
+class Client_Metrics():
+    sent: int = 0
+    dropped: int = 0
+    lag_last_s: float = 0
+    lag_max_s: float = 0
+
+    def marshall(self, queue_depth):
+        res = {
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'queue_depth': queue_depth,
+            'lag_last_ms': 1000 * self.lag_last_s,
+            'lag_max_ms': 1000 * self.lag_max_s,
+        }
+        return res
+
+
+class Hub_Client():
+    """
+    A websocket fed by the hub. Messages wait in a bounded per client queue,
+    a slow client only ever delays itself.
+    Binary clients get msgpack_frame instead of JSON text.
+    """
+    ids = itertools.count()
+    display = False
+
+    def __init__(self, websocket, endpoint, policy=Client_Policy.DROP_OLDEST, queue_size=1000, binary=False):
+        self.websocket = websocket
+        client = websocket.client
+        self.name = f'{endpoint}-{client.host if client else "unknown"}-{next(self.ids)}'
+        self.policy = policy
+        self.queue_size = queue_size
+        self.binary = binary
+        self.pending = deque(maxlen=queue_size) if policy is Client_Policy.DROP_OLDEST else OrderedDict()
+        self.ready = asyncio.Event()
+        self.metrics = Client_Metrics()
+
+    def put(self, key, message, received, alarm=None):
+        if self.policy is Client_Policy.DROP_OLDEST:
+            if len(self.pending) == self.queue_size:
+                self.metrics.dropped += 1
+            self.pending.append((message, received))
+        else:
+            if key in self.pending:
+                self.metrics.dropped += 1
+                del self.pending[key]
+            elif len(self.pending) == self.queue_size:
+                self.metrics.dropped += 1
+                self.pending.popitem(last=False)
+            self.pending[key] = (message, received)
+        self.ready.set()
+
+    def take(self):
+        if self.policy is Client_Policy.DROP_OLDEST:
+            return self.pending.popleft()
+        return self.pending.popitem(last=False)[1]
+
+    async def send_forever(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.pending:
+                (text, received) = self.take()
+                await self.send(text)
+                lag = time.monotonic() - received
+                self.metrics.sent += 1
+                self.metrics.lag_last_s = lag
+                self.metrics.lag_max_s = max(self.metrics.lag_max_s, lag)
+
+    async def send(self, message):
+        if self.binary:
+            await self.websocket.send_bytes(message)
+        else:
+            await self.websocket.send_text(message)
+
+    async def receive_forever(self, on_message=None):
+        """Returns once the client disconnects"""
+        while True:
+            message = await self.websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                return
+            if on_message and message.get('text'):
+                try:
+                    await on_message(json.loads(message['text']))
+                except (ValueError, KeyError, TypeError) as e:
+                    log.error(f"Bad request from websocket {self.name}: {e}")
+
+    async def run(self, on_message=None):
+        """Serve the client until it disconnects or a send fails"""
+        tasks = [asyncio.ensure_future(self.send_forever()),
+                 asyncio.ensure_future(self.receive_forever(on_message))]
+        try:
+            (done, _) = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception():
+                    log.info(f"Websocket {self.name} closed: {task.exception()}")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def marshall(self):
+        return self.metrics.marshall(len(self.pending))
+
+
+class Display_Client(Hub_Client):
+    """
+    Telemetry for displays. Only the latest packet per (packet_name, vcid) is kept,
+    and a snapshot of the packets updated since the last one is sent rate_hz times a second.
+    A packet whose non GREEN fields differ from the previous packet of the same (packet_name, vcid)
+    is an alarm transition and is sent at once, alarms are never decimated.
+    Every websocket message is a list: of packets in JSON, of [subject, message] in msgpack.
+    """
+    display = True
+
+    def __init__(self, websocket, endpoint, rate_hz, queue_size=1000, binary=False):
+        super().__init__(websocket, endpoint, Client_Policy.LATEST_VALUE, queue_size, binary)
+        self.period_s = 1 / rate_hz
+        self.urgent = deque(maxlen=queue_size)
+        self.alarms = {}
+
+    def put(self, key, message, received, alarm=None):
+        if alarm != self.alarms.get(key, ()):
+            self.alarms[key] = alarm
+            if len(self.urgent) == self.urgent.maxlen:
+                self.metrics.dropped += 1
+            self.urgent.append((message, received))
+            if self.pending.pop(key, None):
+                self.metrics.dropped += 1
+            self.ready.set()
+            return
+        if self.pending.pop(key, None):
+            self.metrics.dropped += 1
+        self.pending[key] = (message, received)
+
+    def snapshot(self, messages):
+        if self.binary:
+            return msgpack.Packer().pack_array_header(len(messages)) + b''.join(messages)
+        return f"[{','.join(messages)}]"
+
+    async def send_snapshot(self, pending):
+        messages = [message for (message, _) in pending]
+        await self.send(self.snapshot(messages))
+        now = time.monotonic()
+        for (_, received) in pending:
+            lag = now - received
+            self.metrics.sent += 1
+            self.metrics.lag_last_s = lag
+            self.metrics.lag_max_s = max(self.metrics.lag_max_s, lag)
+
+    async def send_forever(self):
+        next_snapshot = time.monotonic() + self.period_s
+        while True:
+            try:
+                await asyncio.wait_for(self.ready.wait(), max(next_snapshot - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self.ready.clear()
+            if self.urgent:
+                urgent = list(self.urgent)
+                self.urgent.clear()
+                await self.send_snapshot(urgent)
+            now = time.monotonic()
+            if now >= next_snapshot:
+                next_snapshot = max(next_snapshot + self.period_s, now)
+                if self.pending:
+                    pending = list(self.pending.values())
+                    self.pending.clear()
+                    await self.send_snapshot(pending)
+
+    def marshall(self):
+        return self.metrics.marshall(len(self.pending) + len(self.urgent))
+
+
+class Hub_Topic():
+    """
+    One NATS subscription for a subject pattern and message format, shared by every client.
+    Display topics also decode binary messages, to key them by (packet_name, vcid) and find alarm transitions.
+    """
+    def __init__(self, pattern, formatter, display=False):
+        self.pattern = pattern
+        self.formatter = formatter
+        self.display = display
+        self.clients = set()
+        self.subscription = None
+
+    async def on_message(self, msg, serializer):
+        received = time.monotonic()
+        data = None
+        if self.formatter is msgpack_frame:
+            message = msgpack_frame(msg.subject, msg.data)
+        else:
+            try:
+                data = serializer.unpackb(msg.data)
+                message = encode_json(self.formatter(msg.subject, data))
+            except (TypeError, ValueError) as e:
+                log.error(f"{msg.subject} is not JSONable: {e}")
+                return
+        (key, alarm) = (msg.subject, None)
+        if self.display:
+            if data is None:
+                data = serializer.unpackb(msg.data)
+            (key, alarm) = ((data['packet_name'], data['vcid']), alarm_summary(data))
+        for client in self.clients:
+            client.put(key, message, received, alarm)
+
+
+class Websocket_Hub():
+    """
+    Shares NATS subscriptions between websocket clients.
+    Every message is decoded and JSON encoded once, then fanned out to the queues of the clients that want it.
+    Binary clients share a separate subscription per pattern whose messages are never decoded.
+    Display clients share their own subscriptions too.
+    """
+    def __init__(self, nc, serializer):
+        self.nc = nc
+        self.serializer = serializer
+        self.topics = {}
+        self.clients = set()
+
+    @staticmethod
+    def topic_key(client, pattern, formatter):
+        return (pattern, msgpack_frame if client.binary else formatter, client.display)
+
+    async def join(self, client, pattern, formatter=subject_message):
+        key = self.topic_key(client, pattern, formatter)
+        topic = self.topics.get(key)
+        if topic is None:
+            topic = self.topics[key] = Hub_Topic(*key)
+
+            async def on_message(msg):
+                await topic.on_message(msg, self.serializer)
+            topic.subscription = await self.nc.subscribe(pattern, cb=on_message)
+        topic.clients.add(client)
+        self.clients.add(client)
+
+    async def leave(self, client, pattern, formatter=subject_message):
+        key = self.topic_key(client, pattern, formatter)
+        topic = self.topics.get(key)
+        if topic is None:
+            return
+        topic.clients.discard(client)
+        if not topic.clients:
+            del self.topics[key]
+            await topic.subscription.unsubscribe()
+
+    async def leave_all(self, client):
+        for (pattern, formatter, _) in [key for (key, topic) in self.topics.items() if client in topic.clients]:
+            await self.leave(client, pattern, formatter)
+        self.clients.discard(client)
+
+    def marshall(self):
+        res = {
+            'subscriptions': len(self.topics),
+            'clients': {client.name: client.marshall() for client in self.clients},
+        }
+        return res
@@ -2,12 +2,14 @@ import yaml
 from enum import Enum
 from pathlib import Path
 from collections import deque, defaultdict, namedtuple
+from bisect import bisect_right
 import itertools
 
 from ait.core import log
 import ait
 
 Alarm_Result = namedtuple('Alarm_Result', 'state threshold')
+Compiled_Alarm = namedtuple('Compiled_Alarm', 'state lows highs exact')
 
 default_yaml = ait.config.get('alarms.filename')
 
@@ -18,6 +20,18 @@ def partition(items, predicate):
             (item for pred, item in b if pred))
 
 
+def merge_intervals(intervals):
+    """Merge half open [low, high) intervals into sorted disjoint (lows, highs)"""
+    lows, highs = [], []
+    for (low, high) in sorted(i for i in intervals if i[0] < i[1]):
+        if highs and low <= highs[-1]:
+            highs[-1] = max(highs[-1], high)
+        else:
+            lows.append(low)
+            highs.append(high)
+    return (tuple(lows), tuple(highs))
+
+
 class Alarm_State(Enum):
     # Values are comments
     # Green is lowest priority, Red is highest
@@ -30,6 +44,7 @@ class Alarm_State(Enum):
 
 
 class Alarm_Check():
+    green_result = Alarm_Result(Alarm_State.GREEN, False)
 
     @classmethod
     def load_yaml(cls, yaml_filepath=None):
@@ -42,38 +57,69 @@ class Alarm_Check():
         except Exception as e:
             log.error(f"Could not open limits yaml: {cls.alarm_filepath}")
             raise e
+        cls.compile_alarm_map()
+
+    @classmethod
+    def compile_alarm_map(cls):
+        """
+        Compile alarm_map into alarm_tables: {packet_name: {field: [Compiled_Alarm]}}
+        Compiled alarms are in priority order, with merged intervals for bisection and a frozenset of exact values.
+        Fields without any alarm colors are left out.
+        """
+        cls.alarm_tables = {}
+        for (packet_name, fields) in (cls.alarm_map or {}).items():
+            packet_table = {}
+            for (packet_field, alarm_associations) in (fields or {}).items():
+                compiled = []
+                for color in Alarm_State:
+                    if color is Alarm_State.GREEN:
+                        continue  # Same as the default
+                    alarm_values = (alarm_associations or {}).get(color.name, None)
+                    if alarm_values is None:
+                        continue
+                    exact_alarms, interval_alarms = partition(alarm_values, (lambda i: isinstance(i, (tuple))))
+                    lows, highs = merge_intervals(interval_alarms)
+                    exact = frozenset(i for i in exact_alarms if i.__hash__ is not None)
+                    compiled.append(Compiled_Alarm(color, lows, highs, exact))
+                if compiled:
+                    packet_table[packet_field] = compiled
+            if packet_table:
+                cls.alarm_tables[packet_name] = packet_table
 
     def __init__(self, yaml_filepath=None):
         self.load_yaml(yaml_filepath)
+        self.reset_thresholds()
+
+    def reset_thresholds(self):
         self.threshold_tracker = defaultdict(lambda: defaultdict(dict))
 
     @classmethod
     def get_alarm_state(cls, packet_name, packet_field, value):
-        alarm_associations = cls.alarm_map.get(packet_name, {}).get(packet_field, None)
-        if alarm_associations is None:
-            # log.debug((f"could not find alarms for {packet_name}:{packet_field}"
-            #           f"check {cls.alarm_filepath}. "
-            #           f"assuming state is {Alarm_State.GREEN}"))
+        compiled_alarms = cls.alarm_tables.get(packet_name, {}).get(packet_field, None)
+        if compiled_alarms is None:
             return Alarm_State.GREEN
-
-        for color in Alarm_State:
-            alarm_values = alarm_associations.get(color.name, None)
-            if alarm_values is None:
-                continue
-
-            exact_alarms, interval_alarms = partition(alarm_values, (lambda i: isinstance(i, (tuple))))
-            f = (lambda low, high: low <= value and value < high)
-            g = (lambda i: i == value)
-            interval_results = any(f(*interval) for interval in interval_alarms)
-            exact_results = any(g(exact) for exact in exact_alarms)
-            res = interval_results or exact_results
-            if res:
-                return Alarm_State[color.name]
+        return cls.evaluate(compiled_alarms, value)
+
+    @staticmethod
+    def evaluate(compiled_alarms, value):
+        for alarm in compiled_alarms:
+            try:
+                if value in alarm.exact:
+                    return alarm.state
+            except TypeError:
+                pass  # Unhashable value
+            try:
+                i = bisect_right(alarm.lows, value) - 1
+                if i >= 0 and value < alarm.highs[i]:
+                    return alarm.state
+            except TypeError:
+                pass  # Value is not comparable with the interval bounds
         return Alarm_State.GREEN
 
     @classmethod
     def side_load_yaml(cls, yaml_str):
         cls.alarm_map = yaml.full_load(yaml_str)
+        cls.compile_alarm_map()
 
     def get_alarm_thresholds(self, packet_name, field):
         a = self.threshold_tracker[packet_name][field]
@@ -116,6 +162,14 @@ class Alarm_Check():
                 #log.warn(f"{packet_name}:{field} is in {instant_state} but has not triggered threshold")
                 return Alarm_Result(instant_state, False)
 
+    def check_packet(self, packet_name, decoded_packet):
+        """Evaluate every field of a decoded packet, returns {field: Alarm_Result}"""
+        packet_table = self.alarm_tables.get(packet_name)
+        if not packet_table:
+            return {field: self.green_result for field in decoded_packet}
+        return {field: (self.check_state(packet_name, field, value) if field in packet_table else self.green_result)
+                for (field, value) in decoded_packet.items()}
+
     def __call__(self, packet_name, field, value):
         if self.alarm_map is None:
             return Alarm_Result(Alarm_State.GREEN, False)
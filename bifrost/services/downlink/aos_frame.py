@@ -0,0 +1,132 @@
+from collections import namedtuple
+from functools import lru_cache
+import ait
+
+# CCSDS 732.0-B AOS Space Data Link Protocol
+PRIMARY_HEADER_LENGTH = 6
+FRAME_HEADER_ERROR_CONTROL_LENGTH = 2
+MPDU_HEADER_LENGTH = 2
+IDLE_VCID = 63
+MPDU_IDLE_DATA = 0x7FE  # First header pointer: Packet zone only contains idle data
+MPDU_NO_PACKET_START = 0x7FF  # First header pointer: No packet starts in this frame
+
+AOS_Frame_Layout = namedtuple('AOS_Frame_Layout',
+                              'frame_length packet_zone_start packet_zone_end data_field_end ecf_start')
+
+
+@lru_cache(maxsize=None)
+def aos_frame_layout(frame_length,
+                     frame_header_error_control=None,
+                     insert_zone_length=None,
+                     ocf_length=None,
+                     fecf_length=None):
+    """
+    Precompute the offsets of an AOS frame of frame_length bytes.
+    Options that are not given are read from the dsn.sle.aos AIT configuration.
+    """
+    def config(key, default):
+        value = ait.config.get(f'dsn.sle.aos.{key}')
+        return default if value is None else value
+
+    if frame_header_error_control is None:
+        frame_header_error_control = config('frame_header_error_control_included', False)
+    if insert_zone_length is None:
+        insert_zone_length = config('transfer_frame_insert_zone_len', 0)
+    if ocf_length is None:
+        ocf_length = 4 if config('operational_control_field_included', False) else 0
+    if fecf_length is None:
+        fecf_length = 2 if config('frame_error_control_field_included', True) else 0
+
+    header_length = PRIMARY_HEADER_LENGTH + (FRAME_HEADER_ERROR_CONTROL_LENGTH if frame_header_error_control else 0)
+    mpdu_header_start = header_length + insert_zone_length
+    data_field_end = frame_length - ocf_length - fecf_length
+    return AOS_Frame_Layout(frame_length=frame_length,
+                            packet_zone_start=mpdu_header_start + MPDU_HEADER_LENGTH,
+                            packet_zone_end=data_field_end,
+                            data_field_end=data_field_end,
+                            ecf_start=frame_length - fecf_length)
+
+
+class AOS_Frame_View():
+    """
+    Parses the AOS primary header and M_PDU header of a frame once.
+    The fields travel downstream in the marshalled TaggedFrame, use from_marshalled to rebuild the view without parsing.
+    """
+    __slots__ = ('vcid', 'spacecraft_id', 'channel_counter', 'replay',
+                 'first_header_pointer', 'packet_zone_start', 'packet_zone_end', 'data_field_end', 'ecf_start')
+
+    def __init__(self, raw_frame, layout=None):
+        if layout is None:
+            layout = aos_frame_layout(len(raw_frame))
+        self.spacecraft_id = ((raw_frame[0] & 0x3F) << 2) | (raw_frame[1] >> 6)
+        self.vcid = raw_frame[1] & 0x3F
+        self.channel_counter = int.from_bytes(raw_frame[2:5], 'big')
+        self.replay = bool(raw_frame[5] & 0x80)
+        mpdu_header_start = layout.packet_zone_start - MPDU_HEADER_LENGTH
+        self.first_header_pointer = int.from_bytes(raw_frame[mpdu_header_start:layout.packet_zone_start], 'big') & 0x7FF
+        self.packet_zone_start = layout.packet_zone_start
+        self.packet_zone_end = layout.packet_zone_end
+        self.data_field_end = layout.data_field_end
+        self.ecf_start = layout.ecf_start
+
+    @classmethod
+    def from_marshalled(cls, tagged_frame):
+        view = cls.__new__(cls)
+        view.spacecraft_id = tagged_frame.get('spacecraft_id')
+        view.vcid = tagged_frame['vcid']
+        view.channel_counter = tagged_frame['channel_counter']
+        view.replay = tagged_frame.get('replay', False)
+        view.first_header_pointer = tagged_frame['first_header_pointer']
+        view.packet_zone_start = tagged_frame['packet_zone_start']
+        view.packet_zone_end = tagged_frame['packet_zone_end']
+        view.data_field_end = tagged_frame.get('data_field_end', view.packet_zone_end)
+        view.ecf_start = tagged_frame.get('ecf_start')
+        return view
+
+    @property
+    def is_idle_frame(self):
+        return self.vcid == IDLE_VCID
+
+    @property
+    def mpdu_is_idle_data(self):
+        return self.first_header_pointer == MPDU_IDLE_DATA
+
+    def packet_zone(self, raw_frame):
+        return memoryview(raw_frame)[self.packet_zone_start:self.packet_zone_end]
+
+    def marshall(self):
+        res = {
+            'spacecraft_id': self.spacecraft_id,
+            'replay': self.replay,
+            'first_header_pointer': self.first_header_pointer,
+            'packet_zone_start': self.packet_zone_start,
+            'packet_zone_end': self.packet_zone_end,
+            'data_field_end': self.data_field_end,
+            'ecf_start': self.ecf_start,
+        }
+        return res
+
+
+if __name__ == '__main__':
+    import os
+    import timeit
+    from ait.dsn.sle.frames import AOSTransFrame
+
+    def ait_path(raw_frame):
+        frame = AOSTransFrame(raw_frame)
+        return (int(frame.virtual_channel), frame.is_idle_frame,
+                int.from_bytes(frame.get('virtual_channel_frame_count'), 'big'),
+                frame.get('mpdu_first_hdr_ptr'), frame.get('mpdu_packet_zone'))
+
+    def view_path(raw_frame):
+        frame = AOS_Frame_View(raw_frame)
+        return (frame.vcid, frame.is_idle_frame, frame.channel_counter,
+                frame.first_header_pointer, frame.packet_zone(raw_frame))
+
+    frame_length = ait.config.get('dsn.sle.aos.frame_length') or 1115
+    raw_frame = bytearray(os.urandom(frame_length))
+    raw_frame[1] = (raw_frame[1] & 0xC0) | 1  # VCID 1
+    n = 20000
+    for (name, f) in (('AIT-DSN AOSTransFrame', ait_path), ('Bifrost AOS_Frame_View', view_path)):
+        s = timeit.timeit(lambda: f(raw_frame), number=n)
+        print(f"{name:24} {n / s:12.0f} frames/s")
@@ -0,0 +1,178 @@
+from bifrost.common.service import Service
+from bifrost.common.loud_exception import with_loud_coroutine_exception, with_loud_exception
+from ait.core import log
+from collections import OrderedDict
+import fnmatch
+import re
+
+GLOB_CHARACTERS = re.compile(r'[*?\[]')
+
+
+class Packet_Values():
+    """
+    Latest value of every field of one packet definition, one slot per field.
+    Slots are created the first time a field is seen, so the table grows with the dictionary, not with traffic.
+    """
+    __slots__ = ('packet_name', 'index', 'values', 'packet_times', 'alarms', 'counts', 'vcid')
+
+    def __init__(self, packet_name):
+        self.packet_name = packet_name
+        self.index = {}
+        self.values = []
+        self.packet_times = []
+        self.alarms = []
+        self.counts = []
+        self.vcid = None
+
+    def slot(self, field_name):
+        self.index[field_name] = len(self.values)
+        self.values.append(None)
+        self.packet_times.append(None)
+        self.alarms.append(None)
+        self.counts.append(0)
+        return self.index[field_name]
+
+    def update(self, tagged_packet):
+        """Returns True if a field was seen for the first time"""
+        field_alarms = tagged_packet['field_alarms']
+        packet_time = tagged_packet['packet_time']
+        self.vcid = tagged_packet['vcid']
+        new_field = False
+        for (name, value) in tagged_packet['decoded_packet'].items():
+            i = self.index.get(name)
+            if i is None:
+                i = self.slot(name)
+                new_field = True
+            self.values[i] = value
+            self.packet_times[i] = packet_time
+            alarm = field_alarms.get(name)
+            self.alarms[i] = alarm['state'] if alarm else None
+            self.counts[i] += 1
+        return new_field
+
+    def point(self, i):
+        res = {
+            'value': self.values[i],
+            'packet_time': self.packet_times[i],
+            'alarm': self.alarms[i],
+            'count': self.counts[i],
+            'vcid': self.vcid,
+        }
+        return res
+
+
+class Current_Value_Table():
+    """
+    Latest value, packet time, alarm state and update count of every telemetry field.
+    Points are named {packet_name}.{field_name}, packet names have no dots.
+    """
+    def __init__(self, pattern_cache_size=256):
+        self.packets = {}
+        self.generation = 0  # Changes when a point is added, invalidates resolved patterns
+        self.pattern_cache = OrderedDict()
+        self.pattern_cache_size = pattern_cache_size
+
+    def clear(self):
+        self.packets = {}
+        self.generation += 1
+        self.pattern_cache.clear()
+
+    def update(self, tagged_packet):
+        packet_name = tagged_packet['packet_name']
+        packet = self.packets.get(packet_name)
+        if packet is None:
+            packet = self.packets[packet_name] = Packet_Values(packet_name)
+        if packet.update(tagged_packet):
+            self.generation += 1
+
+    def point(self, name):
+        (packet_name, _, field_name) = name.partition('.')
+        packet = self.packets.get(packet_name)
+        if packet is None:
+            return None
+        i = packet.index.get(field_name)
+        if i is None:
+            return None
+        return packet.point(i)
+
+    def resolve(self, pattern):
+        """[(point name, Packet_Values, slot)] matching the glob pattern"""
+        cached = self.pattern_cache.get(pattern)
+        if cached and cached[0] == self.generation:
+            self.pattern_cache.move_to_end(pattern)
+            return cached[1]
+        match = re.compile(fnmatch.translate(pattern)).match
+        resolved = [(f'{packet.packet_name}.{field_name}', packet, i)
+                    for packet in self.packets.values()
+                    for (field_name, i) in packet.index.items()
+                    if match(f'{packet.packet_name}.{field_name}')]
+        self.pattern_cache[pattern] = (self.generation, resolved)
+        while len(self.pattern_cache) > self.pattern_cache_size:
+            self.pattern_cache.popitem(last=False)
+        return resolved
+
+    def get(self, names=None):
+        """
+        :param names: Point name, glob pattern, or a list of them. None or '' for every point.
+        :returns: {point name: {value, packet_time, alarm, count, vcid}}, unknown points are left out
+        """
+        if not names:
+            names = ['*']
+        elif isinstance(names, str):
+            names = [names]
+        res = {}
+        for name in names:
+            if GLOB_CHARACTERS.search(name):
+                for (point_name, packet, i) in self.resolve(name):
+                    res[point_name] = packet.point(i)
+            else:
+                point = self.point(name)
+                if point is not None:
+                    res[name] = point
+        return res
+
+
+class CVT_Service(Service):
+    """
+    Current value table of every telemetry field, so new consumers do not have to wait for the next packet.
+    Requests on Bifrost.Services.CVT.Get take a point name ({packet_name}.{field_name}), a glob pattern
+    (Packet_A.*, *.Voltage_*), a list of them, or None for every point, and are answered with
+    {point name: {value, packet_time, alarm, count, vcid}}.
+    The table is cleared when the dictionaries are reloaded.
+
+    - service:
+        name: bifrost.services.downlink.cvt.CVT_Service
+        topics:
+          update:
+            - 'Telemetry.AOS.VCID.*.TaggedPacket.Decoded'
+    """
+    @with_loud_exception
+    def __init__(self):
+        self.table = Current_Value_Table()
+        super().__init__()
+        self.start()
+
+    @with_loud_coroutine_exception
+    async def update(self, topic, tagged_packet, reply):
+        self.table.update(tagged_packet)
+
+    @with_loud_coroutine_exception
+    async def get(self, topic, names, reply):
+        await self.publish(reply, self.table.get(names))
+
+    @with_loud_coroutine_exception
+    async def reconfigure(self, topic, data, reply):
+        await super().reconfigure(topic, data, reply)
+        if hasattr(self, 'get_subscription'):
+            await self.get_subscription.unsubscribe()
+            await self.dictionary_subscription.unsubscribe()
+        self.get_subscription = await self.nc.subscribe('Bifrost.Services.CVT.Get',
+                                                        cb=self.deserialize(self.get, control=True))
+        self.dictionary_subscription = await self.nc.subscribe('Bifrost.Dictionaries.Reloaded',
+                                                               cb=self.deserialize(self.reload_dictionary, control=True))
+
+    @with_loud_coroutine_exception
+    async def reload_dictionary(self, topic, data, reply):
+        """Fields may have been removed, start over"""
+        self.table.clear()
+        log.info("CVT cleared, telemetry dictionary reloaded.")
@@ -1,22 +1,36 @@
 from ait.core import log
 from ait.dsn.sle.frames import AOSTransFrame
 from colorama import Fore, Back, Style
-from bifrost.common.ccsds_packet import Packet_State, CCSDS_Packet
+from bifrost.common.ccsds_packet import Packet_State, CCSDS_Packet, PRIMARY_HEADER_LENGTH
 from bifrost.common.loud_exception import with_loud_exception
 
+
+def read_frame(data, frame_view=None):
+    """
+    (is_idle_frame, mpdu_is_idle_data, first_header_pointer, mpdu_packet_zone)
+    Uses the AOS_Frame_View parsed upstream if given, otherwise parses the frame with AIT.
+    """
+    if frame_view is not None:
+        return (frame_view.is_idle_frame, frame_view.mpdu_is_idle_data,
+                frame_view.first_header_pointer, frame_view.packet_zone(data))
+    AOS_frame_object = AOSTransFrame(data)
+    return (AOS_frame_object.is_idle_frame, AOS_frame_object.get('mpdu_is_idle_data'),
+            AOS_frame_object.get('mpdu_first_hdr_ptr'), AOS_frame_object.get('mpdu_packet_zone'))
+
 class AOS_to_CCSDS_Depacketization():
 
     @with_loud_exception
-    def __init__(self, secondary_header_length=0):
+    def __init__(self, secondary_header_length=0, binary=False):
         self.bytes_from_previous_frames = bytes()
         self.secondary_header_length = secondary_header_length
+        self.binary = binary
 
     @with_loud_exception
-    def depacketize(self, data):
+    def depacketize(self, data, frame_view=None):
 
         @with_loud_exception
         def attempt_packet(data):
-            stat, p = CCSDS_Packet.decode(data, self.secondary_header_length)
+            stat, p = CCSDS_Packet.decode(data, self.secondary_header_length, self.binary)
             if stat is Packet_State.COMPLETE:
                 log.debug(f"{Fore.GREEN} Got a packet! {Fore.RESET}")
                 accumulated_packets.append(p)
@@ -44,18 +58,17 @@ class AOS_to_CCSDS_Depacketization():
                 log.debug(f"{Fore.CYAN} Picked up a packet! {Fore.RESET}")
 
         accumulated_packets = []
-        AOS_frame_object = AOSTransFrame(data)
+        is_idle_frame, mpdu_is_idle_data, first_header_pointer, mpdu_packet_zone = read_frame(data, frame_view)
 
-        if AOS_frame_object.is_idle_frame:
+        if is_idle_frame:
             log.debug("Dropping idle frame!")
             return accumulated_packets
 
-        if AOS_frame_object.get('mpdu_is_idle_data'):
+        if mpdu_is_idle_data:
             print("Idle! Packet!")
             return accumulated_packets
 
-        first_header_pointer = AOS_frame_object.get('mpdu_first_hdr_ptr')
-        mpdu_packet_zone = AOS_frame_object.get('mpdu_packet_zone')
+        mpdu_packet_zone = bytes(mpdu_packet_zone)
 
         log.debug(f"{first_header_pointer=} ")
         if first_header_pointer != 0 and self.bytes_from_previous_frames:
@@ -74,3 +87,114 @@ class AOS_to_CCSDS_Depacketization():
             pointer += next_index
 
         return accumulated_packets
+
+
+class AOS_to_CCSDS_Zero_Copy_Depacketization():
+    """
+    Drop in replacement for AOS_to_CCSDS_Depacketization.
+    Walks the M_PDU packet zone with offsets over a single memoryview,
+    and accumulates spillover packets into a preallocated reassembly buffer.
+    Packets are only copied out of the frame when they are emitted.
+    """
+    max_packet_length = PRIMARY_HEADER_LENGTH + 0xFFFF + 1
+    idle_fill = bytes([0xE0]) * max_packet_length
+
+    @with_loud_exception
+    def __init__(self, secondary_header_length=0, binary=False):
+        self.secondary_header_length = secondary_header_length
+        self.binary = binary
+        self.reassembly_buffer = bytearray(self.max_packet_length)
+        self.reassembly_length = 0
+
+    @with_loud_exception
+    def reassemble(self, fragment, accumulated_packets):
+        """Append fragment to the reassembly buffer, and emit the packet if it has been completed."""
+        start = self.reassembly_length
+        end = start + len(fragment)
+        if end > self.max_packet_length:
+            log.error(f"{Fore.RED} Reassembly buffer overflow, dropping {end} bytes of spillover {Fore.RESET}")
+            self.reassembly_length = 0
+            return
+        self.reassembly_buffer[start:end] = fragment
+        self.reassembly_length = end
+
+        if end < PRIMARY_HEADER_LENGTH:
+            log.debug(f"{Fore.RED} UNDERFLOW: Reassembly requires more data {Fore.RESET}")
+            return
+
+        data_length = int.from_bytes(self.reassembly_buffer[4:6], 'big')
+        if not data_length:
+            log.debug(f"{Fore.RED} UNDERFLOW: Dropping spillover with no data length {Fore.RESET}")
+            self.reassembly_length = 0
+            return
+
+        packet_length = PRIMARY_HEADER_LENGTH + data_length + 1
+        if end < packet_length:
+            log.debug(f"{Fore.MAGENTA} SPILLOVER missing {packet_length - end} bytes {Fore.RESET}")
+            return
+
+        with memoryview(self.reassembly_buffer) as buffer:
+            self.emit(buffer[:packet_length], accumulated_packets)
+        self.reassembly_length = 0
+        log.debug(f"{Fore.CYAN} Picked up a packet! {Fore.RESET}")
+
+    @with_loud_exception
+    def emit(self, packet_view, accumulated_packets):
+        stat, p = CCSDS_Packet.decode(bytes(packet_view), self.secondary_header_length, self.binary)
+        if stat is Packet_State.COMPLETE:
+            log.debug(f"{Fore.GREEN} Got a packet! {Fore.RESET}")
+            accumulated_packets.append(p)
+
+    @with_loud_exception
+    def depacketize(self, data, frame_view=None):
+        accumulated_packets = []
+        is_idle_frame, mpdu_is_idle_data, first_header_pointer, mpdu_packet_zone = read_frame(data, frame_view)
+
+        if is_idle_frame:
+            log.debug("Dropping idle frame!")
+            return accumulated_packets
+
+        if mpdu_is_idle_data:
+            log.debug("Dropping idle M_PDU!")
+            return accumulated_packets
+
+        zone = memoryview(mpdu_packet_zone)
+        zone_length = len(zone)
+
+        if first_header_pointer != 0 and self.reassembly_length:
+            log.debug(f"Handling spare packet: {first_header_pointer=}")
+            self.reassemble(zone[:first_header_pointer], accumulated_packets)
+
+        if first_header_pointer < zone_length:
+            # A new packet starts in this frame, anything left in the buffer is unrecoverable
+            self.reassembly_length = 0
+
+        offset = first_header_pointer
+        while offset < zone_length:
+            remaining = zone_length - offset
+            if remaining < PRIMARY_HEADER_LENGTH:
+                log.debug(f"{Fore.RED} UNDERFLOW {remaining=} {Fore.RESET}")
+                self.reassemble(zone[offset:], accumulated_packets)
+                break
+
+            if zone[offset] == 0xE0 and zone[offset:] == self.idle_fill[:remaining]:
+                log.debug(f"{Fore.YELLOW} IDLE {Fore.RESET}")
+                break
+
+            data_length = int.from_bytes(zone[offset + 4:offset + 6], 'big')
+            if not data_length:
+                log.debug(f"{Fore.RED} UNDERFLOW {Fore.RESET}")
+                self.reassemble(zone[offset:], accumulated_packets)
+                break
+
+            packet_length = PRIMARY_HEADER_LENGTH + data_length + 1
+            if remaining < packet_length:
+                log.debug(f"{Fore.MAGENTA} SPILLOVER missing {packet_length - remaining} bytes {Fore.RESET}")
+                self.reassemble(zone[offset:], accumulated_packets)
+                break
+
+            self.emit(zone[offset:offset + packet_length], accumulated_packets)
+            offset += packet_length
+
+        zone.release()
+        return accumulated_packets
@@ -0,0 +1,297 @@
+"""
+Append only binary frame archive.
+
+An archive is a directory of segments. Each segment is a pair of files:
+
+    {name}.{segment:05d}.frames  Header, then fixed size records of record_size bytes, one frame per record.
+    {name}.{segment:05d}.index   Header, then one INDEX_DTYPE entry per record, in write order.
+
+Frames shorter than record_size are zero padded, the index keeps their actual length.
+Segments are read through mmap. Record i is at offset HEADER_SIZE + i * record_size.
+Absolute counters and receive times are not guaranteed to increase: VCIDs interleave, JetStream redelivers,
+and the absolute counter restarts with the frame checks service. The writer records in the index header
+which of the two fields ever decreased in the segment. Lookups on a field are binary searches over the mapped index
+in segments where it never decreased, and a linear mask over the mapped index otherwise, never a file scan.
+Segments are not ordered relative to each other.
+A segment cut short by a crash is readable up to the last record that has both its index entry and its frame.
+"""
+from ait.core import log
+from bifrost.common.time_utility import gps_ns_now
+from pathlib import Path
+import numpy as np
+import struct
+import mmap
+import os
+
+FRAMES_MAGIC = b'BFRF'
+INDEX_MAGIC = b'BFRI'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHII')  # magic, version, segment flags (index only), record_size, reserved
+HEADER_SIZE = HEADER.size
+
+# Segment flags, set in the index header once a field decreased within the segment
+SEGMENT_UNSORTED_COUNTER = 0x01
+SEGMENT_UNSORTED_TIME = 0x02
+SEGMENT_UNSORTED = {'absolute_counter': SEGMENT_UNSORTED_COUNTER,
+                    'receive_time_gps_ns': SEGMENT_UNSORTED_TIME}
+
+FLAG_CORRUPT = 0x01
+FLAG_OUT_OF_SEQUENCE = 0x02
+
+INDEX_DTYPE = np.dtype([('absolute_counter', '<u8'),
+                        ('offset', '<u8'),
+                        ('receive_time_gps_ns', '<i8'),
+                        ('channel_counter', '<u4'),
+                        ('length', '<u4'),
+                        ('vcid', 'u1'),
+                        ('flags', 'u1'),
+                        ('reserved', 'u1', (6,))])
+INDEX_ENTRY = struct.Struct('<QQqIIBB6x')
+assert INDEX_ENTRY.size == INDEX_DTYPE.itemsize
+
+
+def segment_paths(directory, name, segment):
+    stem = Path(directory) / f'{name}.{segment:05d}'
+    return (Path(f'{stem}.frames'), Path(f'{stem}.index'))
+
+
+class Frame_Archive_Writer():
+    """
+    Appends frames to the archive {directory}/{name}, starting a new segment every segment_records frames.
+    Appending to an existing archive continues in a new segment, numbered after the highest existing one.
+    Segment files are created exclusively, an existing segment is never overwritten.
+    """
+    def __init__(self, directory, name, record_size, segment_records=1 << 20, buffer_size=1 << 20):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.name = name
+        self.record_size = record_size
+        self.segment_records = segment_records
+        self.buffer_size = buffer_size
+        self.padding = bytes(record_size)
+        self.segment = self.next_segment()
+        self.frames_file = None
+        self.index_file = None
+        self.open_segment()
+
+    def next_segment(self):
+        """One past the highest segment number of any segment file, segments may be missing"""
+        numbers = [-1]
+        for path in self.directory.glob(f'{self.name}.*'):
+            (number, _, extension) = path.name[len(self.name) + 1:].partition('.')
+            if extension in ('frames', 'index') and number.isdigit():
+                numbers.append(int(number))
+        return max(numbers) + 1
+
+    def open_segment(self):
+        self.close()
+        while True:
+            (frames_path, index_path) = segment_paths(self.directory, self.name, self.segment)
+            try:
+                self.frames_file = open(frames_path, 'xb', buffering=self.buffer_size)
+                self.index_file = open(index_path, 'xb', buffering=self.buffer_size)
+                break
+            except FileExistsError:
+                # Another writer got there first, only remove what this one just created
+                if self.frames_file:
+                    self.frames_file.close()
+                    frames_path.unlink()
+                    self.frames_file = None
+                log.warn(f"Frame archive segment {frames_path} already exists, skipping to the next number")
+                self.segment = self.next_segment()
+        self.frames_file.write(HEADER.pack(FRAMES_MAGIC, FORMAT_VERSION, 0, self.record_size, 0))
+        self.segment_flags = 0
+        self.write_index_header()
+        self.records = 0
+        self.last_counter = None
+        self.last_time = None
+        log.info(f"Archiving frames to {frames_path}")
+
+    def write(self, frame, vcid, absolute_counter, channel_counter, receive_time_gps_ns=None, flags=0):
+        length = len(frame)
+        if length > self.record_size:
+            log.error(f"Frame of {length} bytes does not fit archive records of {self.record_size} bytes, dropped.")
+            return
+        if self.records == self.segment_records:
+            self.segment += 1
+            self.open_segment()
+        if receive_time_gps_ns is None:
+            receive_time_gps_ns = gps_ns_now()
+        if self.records:
+            flags_before = self.segment_flags
+            if absolute_counter < self.last_counter:
+                self.segment_flags |= SEGMENT_UNSORTED_COUNTER
+            if receive_time_gps_ns < self.last_time:
+                self.segment_flags |= SEGMENT_UNSORTED_TIME
+            if self.segment_flags != flags_before:
+                log.warn(f"Frame archive segment {self.segment} is no longer sorted (flags {self.segment_flags:#x}), "
+                         "lookups fall back to a linear scan of its index")
+                self.write_index_header()
+        self.last_counter = absolute_counter
+        self.last_time = receive_time_gps_ns
+        offset = HEADER_SIZE + self.records * self.record_size
+        self.frames_file.write(frame)
+        if length < self.record_size:
+            self.frames_file.write(self.padding[length:])
+        self.index_file.write(INDEX_ENTRY.pack(absolute_counter, offset, receive_time_gps_ns,
+                                               channel_counter, length, vcid, flags))
+        self.records += 1
+
+    def write_index_header(self):
+        """Written before any entry that needs the flags, so a reader never sees an unsorted entry without them"""
+        self.index_file.seek(0)
+        self.index_file.write(HEADER.pack(INDEX_MAGIC, FORMAT_VERSION, self.segment_flags, INDEX_DTYPE.itemsize, 0))
+        self.index_file.flush()
+        self.index_file.seek(0, os.SEEK_END)
+
+    def flush(self):
+        # Frames first, so a flushed index entry never points past the end of the frames file
+        self.frames_file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        if self.frames_file:
+            self.flush()
+            self.frames_file.close()
+            self.index_file.close()
+            self.frames_file = None
+            self.index_file = None
+
+
+class Frame_Archive_Segment():
+    """Read only, memory mapped view of one segment"""
+    def __init__(self, frames_path, index_path):
+        self.frames_path = Path(frames_path)
+        with open(frames_path, 'rb') as f:
+            self.frames_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(index_path, 'rb') as f:
+            self.index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, self.record_size, _) = HEADER.unpack_from(self.frames_map)
+        if magic != FRAMES_MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{frames_path} is not a version {FORMAT_VERSION} frame archive")
+        (magic, version, self.flags, entry_size, _) = HEADER.unpack_from(self.index_map)
+        if magic != INDEX_MAGIC or entry_size != INDEX_DTYPE.itemsize:
+            raise ValueError(f"{index_path} is not a version {FORMAT_VERSION} frame archive index")
+
+        entries = (len(self.index_map) - HEADER_SIZE) // INDEX_DTYPE.itemsize
+        records = (len(self.frames_map) - HEADER_SIZE) // self.record_size
+        self.index = np.frombuffer(self.index_map, dtype=INDEX_DTYPE,
+                                   count=min(entries, records), offset=HEADER_SIZE)
+        self.frames = memoryview(self.frames_map)
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, i):
+        """Frame of record i, as a memoryview into the mapped segment"""
+        entry = self.index[i]
+        offset = int(entry['offset'])
+        return self.frames[offset:offset + int(entry['length'])]
+
+    def is_sorted(self, field):
+        return not self.flags & SEGMENT_UNSORTED[field]
+
+    def select(self, ranges):
+        """
+        Records with start <= field < stop for every (field, start, stop) in ranges, start or stop may be None.
+        Binary search on fields the segment is sorted on, a mask over the index for the others.
+        """
+        (first, last) = (0, len(self.index))
+        masked = []
+        for (field, start, stop) in ranges:
+            if start is None and stop is None:
+                continue
+            if not self.is_sorted(field):
+                masked.append((field, start, stop))
+                continue
+            values = self.index[field]
+            if start is not None:
+                first = max(first, int(np.searchsorted(values, start, side='left')))
+            if stop is not None:
+                last = min(last, int(np.searchsorted(values, stop, side='left')))
+        selected = np.arange(first, max(first, last))
+        for (field, start, stop) in masked:
+            values = self.index[field][selected]
+            mask = np.ones(len(selected), dtype=bool)
+            if start is not None:
+                mask &= values >= start
+            if stop is not None:
+                mask &= values < stop
+            selected = selected[mask]
+        return selected
+
+    def close(self):
+        self.index = None
+        self.frames.release()
+        try:
+            self.frames_map.close()
+            self.index_map.close()
+        except BufferError:
+            pass  # Frames or index entries handed out are still referenced, the maps close once they are collected
+
+
+class Frame_Archive():
+    """
+    Reader for every segment of the archive {directory}/{name}.
+
+    archive = Frame_Archive('/data/42/SV/downlink/frames', 'frames')
+    for (entry, frame) in archive.scan(vcids=[1], start_time_gps_ns=t0):
+        ...
+    """
+    def __init__(self, directory, name):
+        self.segments = []
+        for frames_path in sorted(Path(directory).glob(f'{name}.*.frames')):
+            index_path = frames_path.with_suffix('.index')
+            if not index_path.exists():
+                log.error(f"{frames_path} has no index, skipped.")
+                continue
+            if min(frames_path.stat().st_size, index_path.stat().st_size) < HEADER_SIZE:
+                continue  # Segment that has not been flushed yet
+            self.segments.append(Frame_Archive_Segment(frames_path, index_path))
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def find_counter(self, absolute_counter):
+        """
+        First (entry, frame) in archive order with the given absolute counter, or None.
+        Counters restart with the frame checks service, use scan with a time range to tell passes apart.
+        """
+        for segment in self.segments:
+            selected = segment.select([('absolute_counter', absolute_counter, absolute_counter + 1)])
+            if len(selected):
+                i = selected[0]
+                return (segment.index[i], segment.frame(i))
+        return None
+
+    def find_channel_counter(self, vcid, channel_counter):
+        """Every (entry, frame) with the given VCID and channel counter, channel counters wrap"""
+        res = []
+        for segment in self.segments:
+            index = segment.index
+            for i in np.flatnonzero((index['vcid'] == vcid) & (index['channel_counter'] == channel_counter)):
+                res.append((index[i], segment.frame(i)))
+        return res
+
+    def scan(self, vcids=None, start_time_gps_ns=None, stop_time_gps_ns=None,
+             start_counter=None, stop_counter=None, include_corrupt=False):
+        """
+        Yield (entry, frame) in archive order, frames are memoryviews into the mapped segments.
+        Time and counter ranges are half open, [start, stop). Every segment is checked, segments are not ordered.
+        """
+        ranges = [('absolute_counter', start_counter, stop_counter),
+                  ('receive_time_gps_ns', start_time_gps_ns, stop_time_gps_ns)]
+        for segment in self.segments:
+            index = segment.index
+            selected = segment.select(ranges)
+            if vcids is not None:
+                selected = selected[np.isin(index['vcid'][selected], list(vcids))]
+            if not include_corrupt:
+                selected = selected[(index['flags'][selected] & FLAG_CORRUPT) == 0]
+            for i in selected:
+                yield (index[i], segment.frame(i))
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
@@ -2,12 +2,13 @@ from bifrost.common.service import Service
 from bifrost.common.loud_exception import with_loud_coroutine_exception, with_loud_exception
 import ait.core
 from ait.core import log
-from ait.dsn.sle.frames import AOSTransFrame
 from binascii import crc_hqx
 import ait
 from colorama import Fore
 import asyncio
 from bifrost.services.downlink.tagged_frame import TaggedFrame
+from bifrost.services.downlink.aos_frame import AOS_Frame_View
+from bifrost.common.time_utility import gps_ns_now
 
 
 class AOS_Tagger():
@@ -41,15 +42,10 @@ class AOS_Tagger():
     async def tag_frame(self, raw_frame):
 
         async def tag_corrupt():
-            try:
-                data_field_end_index = frame.defaultConfig.data_field_endIndex
-            except Exception as e:
-                log.error(f"Could not decode AOS Frame!: {e}")
-                log.error(f"Assuming frame is corrupted.")
-                return True
-
-            expected_ecf = raw_frame[-2:]
-            block = raw_frame[:data_field_end_index]
+            if frame.ecf_start >= len(raw_frame):
+                return  # No FECF in this layout, nothing to check
+            expected_ecf = raw_frame[frame.ecf_start:]
+            block = raw_frame[:frame.ecf_start]
             actual_ecf = self.crc_func(block, 0xFFFF).to_bytes(2, 'big')
             tagged_frame.corrupt_frame = actual_ecf != expected_ecf
 
@@ -85,14 +81,13 @@ class AOS_Tagger():
             tagged_frame.absolute_counter = self.absolute_counter
             return
 
-        frame = AOSTransFrame(raw_frame)
-        vcid = int(frame.virtual_channel)
-        idle = frame.is_idle_frame
-        channel_counter = int.from_bytes(frame.get('virtual_channel_frame_count'), 'big')
-        tagged_frame = TaggedFrame(frame=raw_frame.hex(),
-                                   vcid=vcid,
-                                   idle=idle,
-                                   channel_counter=channel_counter)
+        frame = AOS_Frame_View(raw_frame)
+        tagged_frame = TaggedFrame(frame=raw_frame,
+                                   vcid=frame.vcid,
+                                   idle=frame.is_idle_frame,
+                                   channel_counter=frame.channel_counter,
+                                   receive_time_gps_ns=gps_ns_now(),
+                                   aos_frame=frame)
 
         if self.fec_check:
             await tag_corrupt()
@@ -112,6 +107,7 @@ class AOS_Frame_Checks_Service(Service):
         super().__init__()
         self.tagger = AOS_Tagger(self.publish, True)
         self.report_time = 5
+        self.binary_wire_format = False
         self.loop.create_task(self.supervisor_tree())
         self.start()
 
@@ -127,7 +123,7 @@ class AOS_Frame_Checks_Service(Service):
             return
 
         tagged_frame = await self.tagger.tag_frame(message)
-        tagged_frame = tagged_frame.marshall()
+        tagged_frame = tagged_frame.marshall(self.binary_wire_format)
         # TODO: Goofy AOS Frame type assumes the VCID numbers, but does not give nice response when mismatch.
         # We crash whenever we do not have that VCID declared for JetStream
         # Add a guard in service.yaml
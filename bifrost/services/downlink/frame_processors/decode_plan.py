@@ -0,0 +1,91 @@
+from ait.core import log
+from ait.core import tlm, dtype
+import numpy as np
+import struct
+
+
+class Decode_Plan():
+    """
+    Compiled decoder for a single telemetry packet definition.
+
+    Fixed size primitive fields are compiled into one numpy structured dtype and decoded with a single unpack.
+    Everything else (strings, arrays, time types, dntoeu conversions, derivations) falls back to AIT.
+    The first packet decoded is checked against AIT, any compiled field that disagrees is demoted to AIT.
+    """
+
+    def __init__(self, packet_def):
+        self.packet_def = packet_def
+        self.name = packet_def.name
+        self.calibrated = False
+        self.order = []
+        self.fallback_names = []
+        self.compile([field_def for field_def in packet_def.fields if self.is_compilable(field_def)])
+
+    @staticmethod
+    def is_compilable(field_def):
+        field_type = field_def.type
+        if type(field_type) is not dtype.PrimitiveType or getattr(field_type, 'string', False):
+            return False
+        if getattr(field_def, 'dntoeu', None):
+            return False
+        try:
+            np_type = np.dtype(field_type.format)
+        except TypeError:
+            return False
+        byte_slice = field_def.slice()
+        return byte_slice.stop - byte_slice.start == np_type.itemsize
+
+    def compile(self, field_defs):
+        self.field_defs = field_defs
+        self.names = [field_def.name for field_def in field_defs]
+        slices = [field_def.slice() for field_def in field_defs]
+        self.dtype = np.dtype({'names': self.names,
+                               'formats': [np.dtype(field_def.type.format) for field_def in field_defs],
+                               'offsets': [s.start for s in slices],
+                               'itemsize': max((s.stop for s in slices), default=0)})
+        self.post_processing = [(i, field_def.mask, getattr(field_def, 'shift', 0), field_def.enum)
+                                for (i, field_def) in enumerate(field_defs)
+                                if field_def.mask is not None or field_def.enum]
+
+    def decode_compiled(self, data):
+        if not self.names:
+            return {}
+        if len(data) < self.dtype.itemsize:
+            raise struct.error(f"{self.name} requires {self.dtype.itemsize} bytes, got {len(data)}")
+        values = list(np.frombuffer(data, dtype=self.dtype, count=1)[0].tolist())
+        for (i, mask, shift, enum) in self.post_processing:
+            value = values[i]
+            if mask is not None:
+                value &= mask
+            if shift:
+                value >>= shift
+            if enum:
+                value = enum.get(value, value)
+            values[i] = value
+        return dict(zip(self.names, values))
+
+    def calibrate(self, data):
+        reference = dict(tlm.Packet(self.packet_def, data).items())
+        compiled = self.decode_compiled(data)
+        keep = {name for (name, value) in compiled.items()
+                if name in reference and reference[name] == value}
+        by_name = {field_def.name: field_def for field_def in self.field_defs}
+        self.compile([by_name[name] for name in reference if name in keep])
+        self.order = list(reference)
+        self.fallback_names = [name for name in self.order if name not in keep]
+        self.calibrated = True
+        log.debug(f"Compiled decode plan for {self.name}: {len(self.names)} compiled, {len(self.fallback_names)} AIT fields")
+        return reference
+
+    def __call__(self, data):
+        if not self.calibrated:
+            return self.calibrate(data)
+
+        decoded = self.decode_compiled(data)
+        if not self.fallback_names:
+            return decoded
+
+        packet = tlm.Packet(self.packet_def, data)
+        for name in self.fallback_names:
+            decoded[name] = getattr(packet, name)
+        return {name: decoded[name] for name in self.order}
@@ -1,6 +1,8 @@
 from bifrost.common.loud_exception import with_loud_exception
 import traceback
 from bifrost.services.downlink.tagged_frame import TaggedFrame
+from bifrost.common.wire_format import to_bytes
+from bifrost.services.downlink.aos_frame import AOS_Frame_View
 import struct
 from ait.core import log
 
@@ -9,29 +11,37 @@ class Frame_Depacketizer():
     # Add option to no drop out of sequence
     def __init__(self, depacketization_type, processor_name,
                  enforce_sequence=False,
-                 secondary_header_length=0):
+                 secondary_header_length=0,
+                 binary=False):
         self.deframer_type = depacketization_type  # Use to reinit depacketizer
         self.processor_name = processor_name
         self.enforce_sequence = enforce_sequence
         self.secondary_header_length = secondary_header_length
-        self.deframer = self.deframer_type(secondary_header_length)
+        self.binary = binary
+        self.deframer = self.new_deframer()
+
+    def new_deframer(self):
+        return self.deframer_type(self.secondary_header_length, self.binary)
 
     @with_loud_exception
     def __call__(self, tagged_frame: TaggedFrame):
         if tagged_frame['corrupt_frame']:
             log.warn(f"{self.processor_name} Dropping corrupt frame.")
-            self.deframer = self.deframer_type(self.secondary_header_length)
+            self.deframer = self.new_deframer()
             return []
         
         if self.enforce_sequence and tagged_frame['out_of_sequence']:
             log.warn(f"{self.processor_name} Dropping out of sequence frame on VCID {tagged_frame['vcid']}")
             log.warn(f"{tagged_frame}")
-            self.deframer = self.deframer_type(self.secondary_header_length)
+            self.deframer = self.new_deframer()
             return []
 
         try:
-            data = bytearray.fromhex(tagged_frame['frame'])
-            packets = self.deframer.depacketize(data)
+            data = to_bytes(tagged_frame['frame'])
+            frame_view = None
+            if 'first_header_pointer' in tagged_frame:
+                frame_view = AOS_Frame_View.from_marshalled(tagged_frame)
+            packets = self.deframer.depacketize(data, frame_view)
             return packets 
         except struct.error as e:
             log.error(f"Could not process frames: {e}")
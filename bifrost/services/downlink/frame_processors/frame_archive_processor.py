@@ -1,53 +1,86 @@
 from bifrost.common.service import Service
 from bifrost.common.loud_exception import with_loud_coroutine_exception, with_loud_exception
-from bifrost.common.disk_writer import Disk_Writer
-from bifrost.common.time_utility import utc_timestamp_now
+from bifrost.common.wire_format import to_bytes
+from bifrost.services.downlink.frame_archive import Frame_Archive_Writer, FLAG_CORRUPT, FLAG_OUT_OF_SEQUENCE
 from ait.core import log
+from pathlib import Path
+import asyncio
+import ait
 
 
 class Frame_Archive_Processor(Service):
     """
-    Calls stored file processor object and stores frames
+    Archives tagged frames of the VCIDs of interest into an indexed binary frame archive,
+    {downlink_path}/FrameArchive/frames_{sv_name}_{pass_id}, see bifrost.services.downlink.frame_archive.
+    Corrupt and out of sequence frames are archived with a flag in the index.
+    record_size defaults to dsn.sle.aos.frame_length from the AIT configuration.
+
+    - service:
+        name: bifrost.services.downlink.frame_processors.frame_archive_processor.Frame_Archive_Processor
+        record_size: 1115
+        segment_records: 1048576  # Frames per segment
+        flush_interval_s: 1
+        vcid_interests:
+          1: True
+          2: True
+          63: False
+        streams:
+          process:
+            - 'Telemetry.AOS.VCID.1.TaggedFrame'
+            - 'Telemetry.AOS.VCID.2.TaggedFrame'
     """
     @with_loud_exception
     def __init__(self):
         self.vcid_interests = {}
+        self.writer = None
         super().__init__()
+        self.record_size = ait.config.get('dsn.sle.aos.frame_length')
+        self.segment_records = 1 << 20
+        self.flush_interval_s = 1
+        self.loop.create_task(self.periodic_archive_flush())
         self.start()
         return
 
     @with_loud_coroutine_exception
     async def process(self, topic, tagged_frame, reply):
-        if tagged_frame.vcid not in self.vcid_interests.keys():
-            log.error(f"Unexpected VCID {tagged_frame.vcid},"
+        vcid = tagged_frame['vcid']
+        if vcid not in self.vcid_interests.keys():
+            log.error(f"Unexpected VCID {vcid},"
                       f"expected interest in one of {self.vcid_interests}.")
-        else:
-            frame_map = tagged_frame.subset_map()
-            if tagged_frame.corrupt_frame:
-                self.corrupt_writers[tagged_frame.vcid].write_to_disk(frame_map, utc_timestamp_now())
-            else:
-                if tagged_frame.vcid in self.writers:
-                    self.writers[tagged_frame.vcid].write_to_disk(frame_map, utc_timestamp_now())
+        elif vcid in self.vcids and self.writer:
+            flags = 0
+            if tagged_frame['corrupt_frame']:
+                flags |= FLAG_CORRUPT
+            if tagged_frame['out_of_sequence']:
+                flags |= FLAG_OUT_OF_SEQUENCE
+            self.writer.write(to_bytes(tagged_frame['frame']),
+                              vcid,
+                              tagged_frame['absolute_counter'],
+                              tagged_frame['channel_counter'],
+                              tagged_frame.get('receive_time_gps_ns') or None,
+                              flags)
         return
 
+    @with_loud_coroutine_exception
+    async def periodic_archive_flush(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_s)
+            if self.writer:
+                self.writer.flush()
+
     @with_loud_coroutine_exception
     async def reconfigure(self, topic, data, reply):
         self.downlink_path = await self.config_request_downlink_path()
         self.pass_id = await self.config_request_pass_id()
         self.sv_name = await self.config_request_sv_name()
         await super().reconfigure(topic, data, reply)
-        path = "FrameArchive"
-        self.frame_ext = '.AOS_TF'
 
         self.vcids = [vcid for (vcid, interested)
                       in self.vcid_interests.items() if interested]
 
-        self.writers = {vcid: Disk_Writer(f"{path}", self.frame_ext, f"{vcid}",
-                                          self.pass_id, self.downlink_path,
-                                          self.sv_name)
-                        for vcid in self.vcids}
-
-        self.corrupt_writers = {vcid: Disk_Writer(f"{path}", self.frame_ext,
-                                                  f"{vcid}/corrupt", self.sv_name,
-                                                  self.downlink_path, self.sv_name)
-                                for vcid in self.vcids}
+        if self.writer:
+            self.writer.close()
+        self.writer = Frame_Archive_Writer(Path(self.downlink_path) / 'FrameArchive',
+                                           f'frames_{self.sv_name}_{self.pass_id}',
+                                           self.record_size,
+                                           self.segment_records)
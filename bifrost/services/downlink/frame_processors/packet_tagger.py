@@ -2,13 +2,13 @@ from ait.core import log
 from ait.core import tlm
 from bifrost.services.downlink.alarms import Alarm_Check
 from bifrost.services.downlink.tagged_packet import TaggedPacket
+from bifrost.services.downlink.frame_processors.decode_plan import Decode_Plan
 from bifrost.common.time_utility import utc_timestamp_now
+from bifrost.common.wire_format import to_bytes
 import struct
 import sys
 from colorama import Fore
 
-tlm_dict = tlm.getDefaultDict()  # Call to AIT, use dictionary services to do a batch decode instead
-
 
 class CCSDS_Packet_Tagger:
     """Timestamp is a function that provides a datetime like object whenever a packet is passed into it"""
@@ -21,7 +21,28 @@ class CCSDS_Packet_Tagger:
         self.timestamp_from_packet = timestamp_from_packet
         self.pass_id = pass_id
         self.sv_identifier = sv_identifier
-        
+        self.tlm_dict = tlm.getDefaultDict()  # Cached by AIT, the latest reload
+        self.decode_plans = {}
+
+    def get_decode_plan(self, apid):
+        plan = self.decode_plans.get(apid)
+        if plan is None:
+            packet_def = self.tlm_dict.lookup_by_opcode(apid)
+            if not packet_def:
+                return None
+            plan = Decode_Plan(packet_def)
+            self.decode_plans[apid] = plan
+        return plan
+
+    def reload_dictionary(self, tlm_dict):
+        """
+        Use a reloaded telemetry dictionary, decode plans are recompiled on demand.
+        Alarm thresholds start over, the caller reloads the (class wide) alarm tables once for every tagger.
+        """
+        self.tlm_dict = tlm_dict
+        self.decode_plans = {}
+        self.alarm_check.reset_thresholds()
+
     def __call__(self, packets):
         tagged_packets = []
         for packet in packets:
@@ -32,15 +53,14 @@ class CCSDS_Packet_Tagger:
 
                 # Decoding
                 apid = packet['primary_header']['APPLICATION_PROCESS_IDENTIFIER']
-                packet_def = tlm_dict.lookup_by_opcode(apid)  # Call to AIT, need to find a way to make call to dict service
-                if not packet_def:
+                decode_plan = self.get_decode_plan(apid)
+                if not decode_plan:
                     log.error(f"Could not lookup apid/opcode/{apid=}, {self.processor_name=}, {self.vcid=}, {packet=}")
                     continue
                     
                 log.debug(f"{Fore.GREEN} OK! {apid=} {Fore.RESET}")
-                tagged_packet = TaggedPacket(packet, packet_def.name, apid)
-                decoded_map = tlm.Packet(packet_def, bytearray.fromhex(packet['data']))  # Call to AIT
-                tagged_packet.decoded_packet = dict(decoded_map.items())
+                tagged_packet = TaggedPacket(packet, decode_plan.name, apid)
+                tagged_packet.decoded_packet = decode_plan(to_bytes(packet['data']))
 
                 # Alarms Stamping
                 tagged_packet.field_alarms = self.get_alarm_map(tagged_packet)
@@ -49,7 +69,7 @@ class CCSDS_Packet_Tagger:
                 tagged_packet.packet_time = self.timestamp_from_packet(tagged_packet)
                 
                 # Metadata Stamping  #TODO: What's the best way to clean this up?
-                tagged_packet.packet_name = packet_def.name
+                tagged_packet.packet_name = decode_plan.name
                 tagged_packet.processor_name = self.processor_name
                 tagged_packet.processor_counter = self.counter
                 tagged_packet.vcid = self.vcid
@@ -73,10 +93,9 @@ class CCSDS_Packet_Tagger:
         return tagged_packets
 
     def get_alarm_map(self, tagged_packet: TaggedPacket):
-        field_alarms = {}
-        for (packet_field, value) in tagged_packet.decoded_packet.items():
-            alarm_state, threshold = self.alarm_check(tagged_packet.packet_name,
-                                                      packet_field, value)
-            field_alarms[packet_field] = {'state': alarm_state.name,
-                                          'threshold': threshold}
+        alarm_results = self.alarm_check.check_packet(tagged_packet.packet_name,
+                                                      tagged_packet.decoded_packet)
+        field_alarms = {packet_field: {'state': alarm_state.name,
+                                       'threshold': threshold}
+                        for (packet_field, (alarm_state, threshold)) in alarm_results.items()}
         return field_alarms
@@ -1,38 +1,90 @@
 from bifrost.common.service import Service
 from bifrost.common.loud_exception import with_loud_exception, with_loud_coroutine_exception
 from bifrost.services.downlink.frame_processors.depacketizer import Frame_Depacketizer
-from ait.core import log
+from ait.core import log, tlm
+from collections import namedtuple
+import multiprocessing
+import asyncio
 import traceback
+import time
+import os
 
-from bifrost.services.downlink.depacketizers.aos_to_ccsds import AOS_to_CCSDS_Depacketization
+from bifrost.services.downlink.depacketizers.aos_to_ccsds import AOS_to_CCSDS_Depacketization, AOS_to_CCSDS_Zero_Copy_Depacketization
 from bifrost.services.downlink.frame_processors.packet_tagger import CCSDS_Packet_Tagger
+from bifrost.services.downlink.alarms import Alarm_Check
 from bifrost.common.time_utility import time_processed
 
+VCID_Pipeline = namedtuple('VCID_Pipeline', 'frame_depacketizer packet_tagger')
+
 
 class RealTime_Telemetry_Frame_Processor(Service):
     """
     Depacketize frames
     Tag packets
+
+    Depacketizer and tagger state is kept independently for each VCID seen.
+
+    Batch mode: Subscribe process_batch through batch_streams instead of process through streams.
+    Frames are fetched from a pull consumer in batches of up to batch_size, or whatever arrived in batch_latency_ms.
+    Packets for the whole batch are published with a single flush.
+    A batch that fails is dropped, and the pipelines of its VCIDs restart with the next frame.
+
+    - service:
+        name: bifrost.services.downlink.frame_processors.real_time_processor.RealTime_Telemetry_Frame_Processor
+        batch_size: 64
+        batch_latency_ms: 50
+        batch_streams:
+          process_batch:
+            - 'Telemetry.AOS.VCID.1.TaggedFrame'
     """
     @with_loud_exception
     def __init__(self):
         Service.__init__(self)
-        self.vcid = 0
+        self.setup_defaults()
+        self.start()
+
+    @with_loud_exception
+    def setup_defaults(self):
         self.processor_name = "Real Time Telemetry"
         self.enforce_sequence = False
         self.secondary_header_length = 6 # Length of CCSDS Space Packet Secondary Header
-        self.frame_depacketizer = Frame_Depacketizer(AOS_to_CCSDS_Depacketization,
-                                                     self.processor_name,
-                                                     self.enforce_sequence,
-                                                     self.secondary_header_length)
-        self.start()
+        self.zero_copy_depacketization = False
+        self.binary_wire_format = False
+        self.vcid_pipelines = {}
+
+    @with_loud_exception
+    def vcid_pipeline(self, vcid):
+        pipeline = self.vcid_pipelines.get(vcid)
+        if pipeline is None:
+            if self.zero_copy_depacketization:
+                depacketization_type = AOS_to_CCSDS_Zero_Copy_Depacketization
+            else:
+                depacketization_type = AOS_to_CCSDS_Depacketization
+            frame_depacketizer = Frame_Depacketizer(depacketization_type,
+                                                    self.processor_name,
+                                                    self.enforce_sequence,
+                                                    self.secondary_header_length,
+                                                    self.binary_wire_format)
+            packet_tagger = CCSDS_Packet_Tagger(vcid,
+                                                self.processor_name,
+                                                time_processed,
+                                                self.pass_id,
+                                                self.sv_identifier)
+            pipeline = VCID_Pipeline(frame_depacketizer, packet_tagger)
+            self.vcid_pipelines[vcid] = pipeline
+        return pipeline
+
+    @with_loud_exception
+    def tag_frame(self, data):
+        pipeline = self.vcid_pipeline(data['vcid'])
+        ccsds_packets = pipeline.frame_depacketizer(data) or [] # Can be a lot of nones, fix in depacketizer
+        return pipeline.packet_tagger(ccsds_packets)
 
     @with_loud_coroutine_exception
     async def process(self, topic, data, reply):
         log.debug(f"REAL TIME! {data['channel_counter']}")
         try:
-            ccsds_packets = self.frame_depacketizer(data) # Can be a lot of nones, fix in depacketizer
-            tagged_packets = self.packet_tagger(ccsds_packets)
+            tagged_packets = self.tag_frame(data)
             for tagged_packet in tagged_packets:
                 vcid = tagged_packet['vcid']
                 packet_name = tagged_packet['packet_name']
@@ -45,14 +97,242 @@ class RealTime_Telemetry_Frame_Processor(Service):
             traceback.print_exc()
             raise e
 
+    @with_loud_coroutine_exception
+    async def process_batch(self, topic, frames, reply):
+        tagged_packets = []
+        for data in frames:
+            tagged_packets.extend(self.tag_frame(data) or [])
+
+        streamed = []
+        for tagged_packet in tagged_packets:
+            vcid = tagged_packet['vcid']
+            packet_name = tagged_packet['packet_name']
+            subj = f"Telemetry.AOS.VCID.{vcid}.TaggedPacket"
+            await self.publish(f'{subj}.{packet_name}', tagged_packet, flush=False)
+            streamed.append((f'{subj}.Decoded', tagged_packet))
+        await self.flush()
+        await self.stream_many(streamed)
+
+    async def batch_failed(self, subject, frames):
+        """The batch left its VCID pipelines partway through, start them over rather than resume mid packet"""
+        for vcid in {data.get('vcid') for data in frames}:
+            if self.vcid_pipelines.pop(vcid, None):
+                log.warn(f"{self.processor_name}: Reset VCID {vcid} pipeline after a failed batch")
+
     @with_loud_coroutine_exception
     async def reconfigure(self, topic, data, reply):
         self.pass_id = await self.config_request_pass_id()
         self.sv_identifier = await self.config_request_value('instance.space_vehicle.identifier')
         await super().reconfigure(topic, data, reply)
-        self.packet_tagger = CCSDS_Packet_Tagger(self.vcid,
-                                                 self.processor_name,
-                                                 time_processed,
-                                                 self.pass_id,
-                                                 self.sv_identifier)
+        self.vcid_pipelines = {}
+        if hasattr(self, 'dictionary_subscription'):
+            await self.dictionary_subscription.unsubscribe()
+        self.dictionary_subscription = await self.nc.subscribe('Bifrost.Dictionaries.Reloaded',
+                                                               cb=self.deserialize(self.reload_dictionary, control=True))
+
+    @with_loud_coroutine_exception
+    async def reload_dictionary(self, topic, data, reply):
+        """Command_Dictionary_Service reloaded the dictionaries, reload them and the alarm limits once for every VCID"""
+        tlm_dict = tlm.getDefaultDict(True)
+        Alarm_Check.load_yaml(Alarm_Check.alarm_filepath)
+        for pipeline in self.vcid_pipelines.values():
+            pipeline.packet_tagger.reload_dictionary(tlm_dict)
+        log.info(f"{self.processor_name}: Telemetry dictionary and alarms reloaded, decode plans invalidated.")
+
+
+class RealTime_Telemetry_Shard(RealTime_Telemetry_Frame_Processor):
+    """
+    Worker process of Sharded_RealTime_Telemetry_Frame_Processor.
+    Owns the VCIDs in shard_vcids, with one durable JetStream consumer per VCID.
+    With batch_mode, each is a pull consumer feeding process_batch (batch_size, batch_latency_ms).
+    Configured once by its parent at startup, the parent restarts it on reconfiguration.
+    When the parent sets stop_event, the worker drains: its consumers stop taking frames, the frames in hand are
+    processed and acked, and pending publishes are acked before it exits. Nothing is left to be redelivered
+    behind the stream of the next worker.
+    Frame and packet rates and CPU time are published on Bifrost.Monitors.Frames.Shards.{name} every report_time,
+    to measure how throughput scales with the number of shards.
+    """
+    @with_loud_exception
+    def __init__(self, shard_vcids, shard_config, stop_event=None):
+        Service.__init__(self)
+        self.setup_defaults()
+        self.shard_vcids = shard_vcids
+        self.vcid_subscriptions = []
+        self.batch_mode = False
+        self.report_time = 5
+        self.frame_count = 0
+        self.packet_count = 0
+        self.name = f"{self.name}.VCID_{'_'.join(str(vcid) for vcid in shard_vcids)}"
+        self.loop.create_task(self.reconfigure(None, shard_config, None))
+        self.loop.create_task(self.periodic_shard_report())
+        if stop_event is not None:
+            self.loop.create_task(self.stop_when_set(stop_event))
+        self.start()
+
+    def tag_frame(self, data):
+        tagged_packets = super().tag_frame(data) or []
+        self.frame_count += 1
+        self.packet_count += len(tagged_packets)
+        return tagged_packets
 
+    @with_loud_coroutine_exception
+    async def periodic_shard_report(self):
+        (last_time, last_frames, last_packets, last_cpu) = (time.monotonic(), 0, 0, time.process_time())
+        while True:
+            await asyncio.sleep(self.report_time)
+            (now, cpu) = (time.monotonic(), time.process_time())
+            elapsed = now - last_time
+            report = {
+                'vcids': self.shard_vcids,
+                'frames': self.frame_count,
+                'packets': self.packet_count,
+                'frames_per_s': (self.frame_count - last_frames) / elapsed,
+                'packets_per_s': (self.packet_count - last_packets) / elapsed,
+                'cpu_utilization': (cpu - last_cpu) / elapsed,
+            }
+            (last_time, last_frames, last_packets, last_cpu) = (now, self.frame_count, self.packet_count, cpu)
+            await self.publish(f'Bifrost.Monitors.Frames.Shards.{self.name}', report)
+
+    @with_loud_coroutine_exception
+    async def stop_when_set(self, stop_event):
+        await self.loop.run_in_executor(None, stop_event.wait)
+        log.info(f"{self.name}: Draining before exit")
+        self.batch_draining = True
+        for subscription in self.vcid_subscriptions:
+            await subscription.drain()  # Frames already delivered are processed and acked first
+        if self.batch_tasks:
+            await asyncio.wait(self.batch_tasks)
+        if self.stream_tasks:
+            await asyncio.gather(*self.stream_tasks)
+        await self.flush()
+        await self.nc.drain()
+        log.info(f"{self.name}: Drained, exiting")
+        os._exit(0)
+
+    @with_loud_coroutine_exception
+    async def reconfigure(self, topic, data, reply):
+        await super().reconfigure(topic, data, reply)
+        for subscription in self.vcid_subscriptions:
+            await subscription.unsubscribe()
+        self.vcid_subscriptions = []
+        for vcid in self.shard_vcids:
+            subject = f'Telemetry.AOS.VCID.{vcid}.TaggedFrame'
+            if self.batch_mode:
+                # Runs until the next reconfigure cancels batch_tasks
+                self.loop.create_task(self.subscribe_jetstream_batch(subject, self.process_batch,
+                                                                     durable=f'Bifrost-RealTime-VCID-{vcid}-Batch'))
+                continue
+            subscription = await self.subscribe_jetstream(subject,
+                                                          self.process,
+                                                          durable=f'Bifrost-RealTime-VCID-{vcid}')
+            self.vcid_subscriptions.append(subscription)
+        log.info(f"{self.name}: Processing VCIDs {self.shard_vcids}")
+
+
+def run_shard(shard_vcids, shard_config, stop_event=None):
+    """Entry point for shard worker processes"""
+    RealTime_Telemetry_Shard(shard_vcids, shard_config, stop_event)
+
+
+class Sharded_RealTime_Telemetry_Frame_Processor(Service):
+    """
+    Real time frame processing for many VCIDs, sharded across a pool of worker processes.
+    Each worker keeps independent depacketizer and tagger state per VCID,
+    and consumes Telemetry.AOS.VCID.{n}.TaggedFrame with a durable consumer per VCID.
+    Add a VCID to vcids to add a shard. Workers are restarted whenever this service is reconfigured:
+    they are asked to drain and exit, and only killed if they are still running after stop_timeout_s.
+    Each worker reports its frame rate and CPU utilization (see RealTime_Telemetry_Shard). To measure scaling,
+    replay a pass at full rate (Archive_Replay_Service) with shards: 1, then with more shards,
+    and compare the summed frames_per_s.
+    Every other option is passed on to the workers (see RealTime_Telemetry_Frame_Processor),
+    except topics, streams and batch_streams: workers pick their subjects from vcids.
+    Set batch_mode to have workers use batch pull consumers, as with batch_streams.
+
+    - service:
+        name: bifrost.services.downlink.frame_processors.real_time_processor.Sharded_RealTime_Telemetry_Frame_Processor
+        vcids: [1, 2, 3, 4]
+        shards: 2  # Number of worker processes, defaults to one per VCID
+        zero_copy_depacketization: True
+        batch_mode: True
+        batch_size: 64
+        batch_latency_ms: 50
+        stop_timeout_s: 10
+    """
+    shard_options = ('topics', 'streams', 'batch_streams', 'vcids', 'shards', 'stop_timeout_s')
+
+    @with_loud_exception
+    def __init__(self):
+        super().__init__()
+        self.vcids = []
+        self.shards = None
+        self.workers = {}
+        self.stop_events = {}
+        self.stop_timeout_s = 10
+        self.report_time = 5
+        self.loop.create_task(self.supervisor_tree())
+        self.start()
+
+    @with_loud_exception
+    def assign_shards(self):
+        vcids = sorted(self.vcids or [])
+        n = min(self.shards or len(vcids), len(vcids))
+        return [tuple(vcids[i::n]) for i in range(n)]
+
+    @with_loud_exception
+    def start_worker(self, shard_vcids):
+        context = multiprocessing.get_context('spawn')
+        stop_event = context.Event()
+        worker = context.Process(target=run_shard,
+                                 args=(list(shard_vcids), self.shard_config, stop_event),
+                                 name=f'{self.name}.VCID_{shard_vcids}')
+        worker.start()
+        self.workers[shard_vcids] = worker
+        self.stop_events[shard_vcids] = stop_event
+        log.info(f"{self.name}: Started worker for VCIDs {list(shard_vcids)}")
+
+    async def wait_for_exit(self, workers, timeout_s):
+        """Poll rather than join, so the event loop keeps running"""
+        deadline = time.monotonic() + timeout_s
+        while any(worker.is_alive() for worker in workers) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    @with_loud_coroutine_exception
+    async def stop_workers(self, kill_timeout_s=5):
+        """Ask every worker to drain and exit, kill those still running after stop_timeout_s"""
+        workers = list(self.workers.values())
+        stop_events = list(self.stop_events.values())  # Held until the workers exit, a worker still starting opens its event
+        for stop_event in stop_events:
+            stop_event.set()
+        self.workers = {}
+        self.stop_events = {}
+        await self.wait_for_exit(workers, self.stop_timeout_s)
+        for worker in workers:
+            if worker.is_alive():
+                log.warn(f"{self.name}: Worker {worker.name} did not drain within {self.stop_timeout_s}s, killing it")
+                worker.kill()  # Don't SIGTERM, Service.shutdown takes every Bifrost process down with it
+        await self.wait_for_exit(workers, kill_timeout_s)
+        for worker in workers:
+            if worker.is_alive():
+                log.error(f"{self.name}: Worker {worker.name} did not exit within {kill_timeout_s}s")
+            else:
+                worker.join()  # Reap
+
+    @with_loud_coroutine_exception
+    async def reconfigure(self, topic, data, reply):
+        await super().reconfigure(topic, data, reply)
+        await self.stop_workers()
+        self.shard_config = {k: v for (k, v) in (data or {}).items() if k not in self.shard_options}
+        for shard_vcids in self.assign_shards():
+            self.start_worker(shard_vcids)
+
+    @with_loud_coroutine_exception
+    async def supervisor_tree(self):
+        while True:
+            await asyncio.sleep(self.report_time)
+            for (shard_vcids, worker) in list(self.workers.items()):
+                if not worker.is_alive():
+                    log.error(f"{self.name}: Worker for VCIDs {list(shard_vcids)} died with {worker.exitcode}, restarting.")
+                    self.start_worker(shard_vcids)
+            status = {f"vcid_{'_'.join(str(vcid) for vcid in shard_vcids)}": worker.is_alive()
+                      for (shard_vcids, worker) in self.workers.items()}
+            await self.publish('Bifrost.Monitors.Frames.Shards', status)
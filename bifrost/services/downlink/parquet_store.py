@@ -0,0 +1,234 @@
+from bifrost.common.service import Service
+from bifrost.common.loud_exception import with_loud_coroutine_exception, with_loud_exception
+from ait.core import log
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import asyncio
+import time
+import os
+
+ALARM_SUFFIX = '__alarm'
+TIME_RANGE_KEYS = (b'packet_time_min_ns', b'packet_time_max_ns')
+
+
+def column_array(values):
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed types, keep the column readable
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+class Packet_Column_Buffer():
+    """
+    Decoded packets of one packet definition, buffered column wise.
+    A field missing from some rows (dictionary reload) is null in those rows.
+    """
+    def __init__(self, packet_name):
+        self.packet_name = packet_name
+        self.clear()
+
+    def clear(self):
+        self.rows = 0
+        self.first_append = None  # time.monotonic() of the oldest buffered row
+        self.packet_time = []
+        self.vcid = []
+        self.fields = {}
+        self.alarms = {}
+
+    def take(self):
+        """Move the buffered rows to a new buffer and clear this one"""
+        taken = Packet_Column_Buffer(self.packet_name)
+        (taken.rows, taken.first_append, taken.packet_time, taken.vcid, taken.fields, taken.alarms) = \
+            (self.rows, self.first_append, self.packet_time, self.vcid, self.fields, self.alarms)
+        self.clear()
+        return taken
+
+    def append(self, tagged_packet):
+        decoded = tagged_packet['decoded_packet']
+        field_alarms = tagged_packet['field_alarms']
+        if not self.rows:
+            self.first_append = time.monotonic()
+        for (name, value) in decoded.items():
+            column = self.fields.get(name)
+            if column is None:
+                column = self.fields[name] = [None] * self.rows
+                self.alarms[name] = [None] * self.rows
+            column.append(value)
+            alarm = field_alarms.get(name)
+            self.alarms[name].append(alarm['state'] if alarm else None)
+        self.packet_time.append(tagged_packet['packet_time'])
+        self.vcid.append(tagged_packet['vcid'])
+        self.rows += 1
+        if len(decoded) != len(self.fields):
+            for (name, column) in self.fields.items():
+                if len(column) < self.rows:
+                    column.append(None)
+                    self.alarms[name].append(None)
+
+    def to_table(self):
+        """Rows sorted by packet time. Alarm states are dictionary encoded, one {field}__alarm column per field."""
+        packet_time = np.array(self.packet_time, dtype='datetime64[ns]')
+        order = np.argsort(packet_time, kind='stable')
+        indices = pa.array(order)
+        columns = {
+            'packet_time': pa.array(packet_time[order]),
+            'vcid': pa.array(np.asarray(self.vcid, dtype=np.uint8)[order]),
+        }
+        for (name, values) in self.fields.items():
+            columns[name] = column_array(values).take(indices)
+            columns[f'{name}{ALARM_SUFFIX}'] = pa.array(self.alarms[name], type=pa.string()).take(indices).dictionary_encode()
+        time_range = packet_time[order][[0, -1]].astype(np.int64)
+        return pa.table(columns, metadata={k: str(v) for (k, v) in zip(TIME_RANGE_KEYS, time_range)})
+
+
+class Parquet_Telemetry_Reader():
+    """
+    Reads one field of the Parquet telemetry store over a time range.
+    Parts record their packet time range in the file metadata,
+    parts outside the range or without the field are skipped after reading only their footer.
+    """
+    def __init__(self, store_path):
+        self.store_path = Path(store_path)
+        self.part_metadata = {}  # Parts are immutable once renamed into place
+
+    def parts(self, packet_name):
+        return sorted((self.store_path / f'packet_name={packet_name}').glob('part-*.parquet'))
+
+    def generation(self, packet_name):
+        """Changes whenever a part is added to packet_name"""
+        return len(self.parts(packet_name))
+
+    def metadata(self, part):
+        metadata = self.part_metadata.get(part)
+        if metadata is None:
+            schema = pq.read_schema(part)
+            (start, end) = (int(schema.metadata[k]) for k in TIME_RANGE_KEYS)
+            metadata = self.part_metadata[part] = (start, end, frozenset(schema.names))
+        return metadata
+
+    def read(self, packet_name, field_name, start_ns=None, end_ns=None):
+        """(packet times as int64 nanoseconds, values), sorted by packet time, start and end inclusive"""
+        tables = []
+        for part in self.parts(packet_name):
+            (part_start, part_end, names) = self.metadata(part)
+            if field_name not in names:
+                continue
+            if (start_ns is not None and part_end < start_ns) or (end_ns is not None and part_start > end_ns):
+                continue
+            tables.append(pq.read_table(part, columns=['packet_time', field_name]))
+        if not tables:
+            return (np.empty(0, dtype=np.int64), np.empty(0))
+
+        times = np.concatenate([t['packet_time'].to_numpy().astype(np.int64) for t in tables])
+        values = np.concatenate([t[field_name].to_numpy(zero_copy_only=False) for t in tables])
+        mask = np.ones(len(times), dtype=bool)
+        if start_ns is not None:
+            mask &= times >= start_ns
+        if end_ns is not None:
+            mask &= times <= end_ns
+        (times, values) = (times[mask], values[mask])
+        if len(tables) > 1:
+            order = np.argsort(times, kind='stable')
+            (times, values) = (times[order], values[order])
+        return (times, values)
+
+
+class Parquet_Telemetry_Store(Service):
+    """
+    Archives decoded telemetry into Parquet, one directory per packet definition:
+        {downlink_path}/telemetry/packet_name={packet_name}/part-{n:05d}.parquet
+    Each file holds one row group of up to row_group_rows packets sorted by packet time (TAI).
+    Buffers are written when full and on reconfiguration (end of pass). Every flush_interval_s,
+    buffers holding at least min_part_rows rows, or rows older than max_buffer_age_s, are written too,
+    so low rate packets make a few larger files per pass rather than one tiny file per interval.
+    Files are written under a temporary name and renamed, readers never see a partial file.
+
+    - service:
+        name: bifrost.services.downlink.parquet_store.Parquet_Telemetry_Store
+        row_group_rows: 65536
+        flush_interval_s: 60
+        min_part_rows: 4096
+        max_buffer_age_s: 900  # Bounds how long rows wait in memory, and out of the history endpoint
+        compression: zstd
+        streams:
+          archive:
+            - 'Telemetry.AOS.VCID.*.TaggedPacket.Decoded'
+    """
+    @with_loud_exception
+    def __init__(self):
+        self.buffers = {}
+        self.part_counters = {}
+        self.store_path = None
+        super().__init__()
+        self.row_group_rows = 65536
+        self.flush_interval_s = 60
+        self.min_part_rows = 4096
+        self.max_buffer_age_s = 900
+        self.compression = 'zstd'
+        self.loop.create_task(self.periodic_store_flush())
+        self.start()
+
+    @with_loud_coroutine_exception
+    async def archive(self, topic, tagged_packet, reply):
+        packet_name = tagged_packet['packet_name']
+        buffer = self.buffers.get(packet_name)
+        if buffer is None:
+            buffer = self.buffers[packet_name] = Packet_Column_Buffer(packet_name)
+        buffer.append(tagged_packet)
+        if buffer.rows >= self.row_group_rows:
+            await self.write_buffer(buffer)
+
+    @with_loud_coroutine_exception
+    async def write_buffer(self, buffer):
+        if not buffer.rows or not self.store_path:
+            return
+        snapshot = buffer.take()
+        path = self.next_part_path(buffer.packet_name)
+        await self.loop.run_in_executor(None, self.write_table, snapshot, path, self.compression)
+
+    @staticmethod
+    def write_table(buffer, path, compression):
+        try:
+            table = buffer.to_table()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = path.with_name(f'.{path.name}.tmp')
+            pq.write_table(table, temporary_path, row_group_size=len(table), compression=compression)
+            os.replace(temporary_path, path)
+            log.debug(f"Wrote {len(table)} rows to {path}")
+        except Exception as e:
+            log.error(f"Could not write {path}: {e}")
+
+    def next_part_path(self, packet_name):
+        directory = self.store_path / f'packet_name={packet_name}'
+        n = self.part_counters.get(packet_name)
+        if n is None:
+            n = len(list(directory.glob('part-*.parquet'))) if directory.exists() else 0
+        self.part_counters[packet_name] = n + 1
+        return directory / f'part-{n:05d}.parquet'
+
+    @with_loud_coroutine_exception
+    async def flush_buffers(self, force=True):
+        """force=False only writes buffers of at least min_part_rows rows or older than max_buffer_age_s"""
+        now = time.monotonic()
+        for buffer in list(self.buffers.values()):
+            if not buffer.rows:
+                continue
+            if force or buffer.rows >= self.min_part_rows or now - buffer.first_append >= self.max_buffer_age_s:
+                await self.write_buffer(buffer)
+
+    @with_loud_coroutine_exception
+    async def periodic_store_flush(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_s)
+            await self.flush_buffers(force=False)
+
+    @with_loud_coroutine_exception
+    async def reconfigure(self, topic, data, reply):
+        await self.flush_buffers()  # Into the previous pass
+        self.downlink_path = await self.config_request_downlink_path()
+        await super().reconfigure(topic, data, reply)
+        self.store_path = Path(self.downlink_path) / 'telemetry'
+        self.part_counters = {}
@@ -1,4 +1,6 @@
 from dataclasses import dataclass
+from bifrost.common.wire_format import encode_bytes
+from bifrost.services.downlink.aos_frame import AOS_Frame_View
 
 @dataclass
 class TaggedFrame:
@@ -9,18 +11,23 @@ class TaggedFrame:
     corrupt_frame: bool = False
     out_of_sequence: bool = False
     idle: bool = False
+    receive_time_gps_ns: int = 0
+    aos_frame: AOS_Frame_View = None  # Parsed once, rebuild downstream with AOS_Frame_View.from_marshalled
 
-    def marshall(self):
+    def marshall(self, binary=False):
         res = {
             'data_type': type(self).__name__,
-            'frame': self.frame,
+            'frame': encode_bytes(self.frame, binary),
             'channel_counter': self.channel_counter,
             'absolute_counter': self.absolute_counter,
             'vcid': self.vcid,
             'corrupt_frame': self.corrupt_frame,
             'out_of_sequence': self.out_of_sequence,
             'is_idle': self.idle,
+            'receive_time_gps_ns': self.receive_time_gps_ns,
         }
+        if self.aos_frame is not None:
+            res.update(self.aos_frame.marshall())
         return res
 
     def __repr__(self):
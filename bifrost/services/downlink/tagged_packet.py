@@ -1,5 +1,6 @@
 from dataclasses import dataclass, field
 import astropy.time
+from bifrost.common.time_utility import GPS_Time
 
 
 @dataclass
@@ -8,7 +9,7 @@ class TaggedPacket:
     Represents a packet and associated metadata.
     This data contains additional components necessary for Influx and OpenMCT.
 
-    :param packet: Raw packet in hex.
+    :param packet: Marshalled CCSDS packet, raw fields in hex or bytes depending on the wire format.
     :param packet_name: Packet's name
     :param uid: AIT dictionary index (kind of useless)
     :param pass_id: The pass id for this Bifrost instance.
@@ -34,7 +35,7 @@ class TaggedPacket:
     processor_name: str = ""
     processor_counter: int = -1
     decoded_packet: map = field(init=False)
-    packet_time: astropy.time.core.Time = field(init=False) # Change varname to spacecraft_time_gps
+    packet_time: GPS_Time = field(init=False) # Change varname to spacecraft_time_gps
     time_processed_utc: astropy.time.core.Time = field(init=False)
     field_alarms: dict = field(default_factory=dict)
 
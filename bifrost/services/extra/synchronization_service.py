@@ -1,25 +1,10 @@
 from bifrost.common.service import Service
 from bifrost.common.loud_exception import with_loud_coroutine_exception, with_loud_exception
 from ait.core import log
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from colorama import Fore
-
-
-@dataclass
-class DeSyncResult():
-    lead_fragment: bytes = b''  # Missed frame data, always useless other than debugging
-    frames: list = field(default_factory=list)
-    rear_fragment: bytes = b''  # Spanning Frame
-    rear_fragment_required_length: int = 0
-    rear_fragment_actual_length: int = 0
-
-    def isNoBeefFound(self):
-        res = all([self.lead_fragment, len(self.frames), self.rear_fragment])
-        return res
-
-    def __str__(self):
-        s = f'{self.__class__.__name__} {Fore.RED} lead_fragment={self.lead_fragment}, {Fore.RESET} frames={self.frames},  {Fore.CYAN} rear_fragment={self.rear_fragment} {Fore.RESET} rear_fragment_actual_length={self.rear_fragment_actual_length}, rear_fragment_required_length={self.rear_fragment_actual_length}'
-        return s
+from enum import Enum, auto
+import ait
 
 
 class SyncByte():
@@ -52,143 +37,315 @@ class Synchronization_Service(Service):
 
 
 class DeSyncByte():
-    def __int__(self):
-        return
-
-    @staticmethod
-    def desync(data: bytes):
-        data = bytearray(data)
-        lead_fragment = None
-        rear_fragment = None
-        accum = []
-
-        next_index = data.find(b'\xbe\xef')
-        data = memoryview(data)
-        if next_index == -1:
-            return DeSyncResult(data, [], None)
-
-        elif next_index != 0:
-            lead_fragment = data[next_index:]
-
-        data = data[next_index:]
-        while data:
-            data = data[2:]
-            packet_length_bytes = data[:4]
-            packet_length = int.from_bytes(data[0:4], 'big')
-            data = data[4:]
-            p = bytes(data[:packet_length])
-            actual_length = len(p)
-
-            if actual_length == packet_length:
-                accum.append(p)
-                data = data[actual_length:]
-
-            elif actual_length < packet_length:
-                rear_fragment = b'\xbe\xef' + packet_length_bytes + data
-                break
+    """
+    Incremental parser for frames prefixed by a delimiter and a big endian length of length_size bytes.
+    Unconsumed bytes are kept between feeds in a buffer that is compacted in place, or reallocated when a frame outgrows it.
+    A length of zero or above max_length is taken as a false delimiter, parsing resumes at the next delimiter.
+
+    Frames are yielded as memoryviews into the buffer, they are only valid until the generator is resumed.
+    """
+    def __init__(self, delimiter=b'\xbe\xef', length_size=4, max_length=1 << 20, buffer_size=1 << 16):
+        self.delimiter = bytes(delimiter)
+        self.length_size = length_size
+        self.header_length = len(self.delimiter) + length_size
+        self.max_length = max_length
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.read_index = 0
+        self.write_index = 0
+        self.synchronized = False
+        self.sync_lost_count = 0
+        self.bytes_discarded = 0
+
+    def feed(self, data):
+        """Add a chunk and yield every frame it completes"""
+        self.append(data)
+        yield from self.parse()
+
+    def append(self, data):
+        n = len(data)
+        if self.write_index + n > len(self.buffer):
+            pending = self.write_index - self.read_index
+            if pending + n > len(self.buffer):
+                # Never resize in place, yielded frames may still reference the old buffer
+                buffer = bytearray(max(2 * len(self.buffer), pending + n))
+                buffer[:pending] = self.view[self.read_index:self.write_index]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
             else:
-                exit()
-                pass
-
-        res = DeSyncResult(lead_fragment, accum, rear_fragment)
-        if rear_fragment:
-            res.rear_fragment_required_length = packet_length
-            res.rear_fragment_actual_length = actual_length - 4 - 2
-        return res
+                self.buffer[:pending] = self.buffer[self.read_index:self.write_index]
+            self.read_index = 0
+            self.write_index = pending
+        self.buffer[self.write_index:self.write_index + n] = data
+        self.write_index += n
+
+    def discard(self, index):
+        self.bytes_discarded += index - self.read_index
+        self.read_index = index
+        if self.synchronized:
+            log.error(f"{Fore.RED}Synchronization was lost?{Fore.RESET}")
+            self.synchronized = False
+            self.sync_lost_count += 1
+
+    def parse(self):
+        while True:
+            i = self.read_index
+            if self.write_index - i < self.header_length:
+                return
+
+            if not self.buffer.startswith(self.delimiter, i):
+                found = self.buffer.find(self.delimiter, i, self.write_index)
+                if found == -1:
+                    self.discard(max(i, self.write_index - len(self.delimiter) + 1))
+                    return
+                self.discard(found)
+                continue
+
+            start = i + self.header_length
+            length = int.from_bytes(self.buffer[i + len(self.delimiter):start], 'big')
+            if not 0 < length <= self.max_length:
+                log.error(f"{Fore.RED}Frame length {length} out of range, resynchronizing.{Fore.RESET}")
+                self.discard(i + 1)
+                continue
+
+            end = start + length
+            if end > self.write_index:
+                return
+            if not self.synchronized:
+                log.info(f"{Fore.GREEN}Synchronized{Fore.RESET}")
+                self.synchronized = True
+            self.read_index = end
+            yield self.view[start:end]
 
 
 class Desynchronization_Service(Service):
+    """
+    Extracts frames delimited by 0xBEEF and a 4 byte length from a byte stream.
+    Frames longer than max_length are treated as a loss of synchronization.
+    With strict, the service exits when synchronization is lost.
+
+    - service:
+        name: bifrost.services.extra.synchronization_service.Desynchronization_Service
+        max_length: 65536
+        strict: False
+        streams:
+          desynchronize:
+            - 'Telemetry.AOS.Stream'
+    """
+    @with_loud_exception
     def __init__(self):
         super().__init__()
         self.desync_byte = DeSyncByte()
-        self.rear_fragment = None
-        self.synchronized = False
+        self.max_length = self.desync_byte.max_length
         self.strict = False
-        self.last_rear_fragment_required_size = 0
-        self.reset_counter = 0
         self.start()
 
+    @with_loud_coroutine_exception
     async def reconfigure(self, topic, message, reply):
         await super().reconfigure(topic, message, reply)
+        self.desync_byte.max_length = self.max_length
         return
 
+    @with_loud_coroutine_exception
     async def desynchronize(self, topic, data, reply):
-        def monotonically_increasing_guard():
-            if (self.last_rear_fragment_required_size and self.last_rear_fragment_required_size < res.rear_fragment_actual_length):
-                # rear fragment definitely monotonically increasing
-                self.reset_counter += 1
-                if self.reset_counter == 2:
-                    self.rear_fragment = None
-                    self.reset_counter = 0
-                    self.synchronized = False
-            return
-            
-        if self.rear_fragment:
-            data = self.rear_fragment + data
-            self.rear_fragment = None
-            #log.info(f"RESTORED FRAGMENTED FRAME!")
-
-        res = self.desync_byte.desync(data)
-        self.rear_fragment = res.rear_fragment
-        monotonically_increasing_guard()
-        self.last_rear_fragment_required_size = res.rear_fragment_actual_length
-        
-        if res.frames and not self.synchronized:
-            log.info(f"{Fore.GREEN} Synchronized {Fore.RESET}")
-            self.synchronized = True
-
-        elif res.isNoBeefFound() and self.synchronized:
-            log.error(f"No beef was found in data. What gives?")
-            log.error(f"Synchronization was lost?")
-            self.synchronized = False
-            self.rear_fragment = None
-            if self.strict:
-                exit()
+        sync_lost_count = self.desync_byte.sync_lost_count
+        for frame in self.desync_byte.feed(data):
+            await self.stream('Telemetry.AOS.Raw', frame)
+        if self.strict and self.desync_byte.sync_lost_count != sync_lost_count:
+            exit()
 
-        elif res.lead_fragment and self.synchronized:
-            log.error(f"Synchronization was lost?")
-            self.rear_fragment = None
-            self.synchronized = False
-            data = None
-            if self.strict:
-                exit()
 
-        elif self.synchronized:
-            for i in res.frames:
-                self.reset_counter = 0
-                res = await self.stream('Telemetry.AOS.Raw', i)
-        else:
-            #self.rear_fragment = None
-            #self.synchronized = False
-            pass
+class Sync_State(Enum):
+    SEARCH = auto()  # Looking for an exact ASM
+    CHECK = auto()  # Candidate ASM found, confirming it repeats every frame
+    LOCK = auto()  # Synchronized
+    FLYWHEEL = auto()  # Synchronized, but the ASM was missed at the expected position
+
+
+@dataclass
+class Sync_Statistics():
+    frames: int = 0
+    flywheel_frames: int = 0
+    lock_count: int = 0
+    lock_lost_count: int = 0
+    bytes_discarded: int = 0
+
+    def marshall(self):
+        return dict(self.__dict__)
+
+
+class ASM_Frame_Synchronizer():
+    """
+    Stateful fixed length frame synchronizer.
+    Chunks may split markers and frames anywhere, bytes are kept in a preallocated buffer between feeds.
+
+    SEARCH looks for an exact ASM. CHECK confirms check_count further markers at the frame stride,
+    LOCK then accepts markers with up to bit_error_tolerance bit errors.
+    A missed marker enters FLYWHEEL, which keeps emitting frames at the predicted positions,
+    lock is lost after flywheel_count consecutive misses.
+
+    Frames are yielded as memoryviews into the buffer, they are only valid until the generator is resumed.
+    """
+    def __init__(self, frame_length, asm=b'\x1a\xcf\xfc\x1d', bit_error_tolerance=0,
+                 check_count=1, flywheel_count=3, buffer_frames=64):
+        self.frame_length = frame_length
+        self.asm = bytes(asm)
+        self.asm_length = len(self.asm)
+        self.asm_int = int.from_bytes(self.asm, 'big')
+        self.stride = self.asm_length + frame_length
+        self.bit_error_tolerance = bit_error_tolerance
+        self.check_count = check_count
+        self.flywheel_count = flywheel_count
+        self.buffer = bytearray(self.stride * max(buffer_frames, 2) + self.asm_length)
+        self.view = memoryview(self.buffer)
+        self.statistics = Sync_Statistics()
+        self.reset()
+
+    def reset(self):
+        self.state = Sync_State.SEARCH
+        self.read_index = 0
+        self.write_index = 0
+        self.checks = 0
+        self.misses = 0
+
+    def asm_exact(self, index):
+        return self.buffer[index:index + self.asm_length] == self.asm
+
+    def asm_matches(self, index):
+        """Within bit_error_tolerance, only used in LOCK and FLYWHEEL"""
+        candidate = self.buffer[index:index + self.asm_length]
+        if candidate == self.asm:
+            return True
+        if not self.bit_error_tolerance:
+            return False
+        errors = bin(int.from_bytes(candidate, 'big') ^ self.asm_int).count('1')
+        return errors <= self.bit_error_tolerance
+
+    def frame(self, index):
+        return self.view[index + self.asm_length:index + self.stride]
+
+    def lose_lock(self):
+        log.error(f"{Fore.RED}Synchronization was lost{Fore.RESET}")
+        self.statistics.lock_lost_count += 1
+        self.state = Sync_State.SEARCH
+        self.checks = 0
+        self.misses = 0
+
+    def feed(self, data):
+        """Add a chunk and yield every frame it completes"""
+        data = memoryview(data)
+        while data:
+            self.compact()
+            n = min(len(data), len(self.buffer) - self.write_index)
+            self.buffer[self.write_index:self.write_index + n] = data[:n]
+            self.write_index += n
+            data = data[n:]
+            yield from self.synchronize()
+
+    def compact(self):
+        pending = self.write_index - self.read_index
+        if self.read_index:
+            self.buffer[:pending] = self.buffer[self.read_index:self.write_index]
+            self.read_index = 0
+            self.write_index = pending
+
+    def synchronize(self):
+        while True:
+            i = self.read_index
+            available = self.write_index - i
+
+            if self.state is Sync_State.SEARCH:
+                found = self.buffer.find(self.asm, i, self.write_index)
+                if found == -1:
+                    keep = min(available, self.asm_length - 1)
+                    self.statistics.bytes_discarded += available - keep
+                    self.read_index = self.write_index - keep
+                    return
+                self.statistics.bytes_discarded += found - i
+                self.read_index = found
+                self.state = Sync_State.CHECK
+                self.checks = 0
+
+            elif self.state is Sync_State.CHECK:
+                # The frame is confirmed by the marker that follows it
+                if available < self.stride + self.asm_length:
+                    return
+                if not self.asm_exact(i + self.stride):
+                    self.statistics.bytes_discarded += 1
+                    self.read_index = i + 1
+                    self.state = Sync_State.SEARCH
+                    continue
+                self.checks += 1
+                if self.checks >= self.check_count:
+                    log.info(f"{Fore.GREEN}Synchronized{Fore.RESET}")
+                    self.statistics.lock_count += 1
+                    self.state = Sync_State.LOCK
+                self.read_index = i + self.stride
+                self.statistics.frames += 1
+                yield self.frame(i)
+
+            else:
+                if available < self.stride:
+                    return
+                if self.asm_matches(i):
+                    self.state = Sync_State.LOCK
+                    self.misses = 0
+                else:
+                    self.misses += 1
+                    if self.misses > self.flywheel_count:
+                        self.lose_lock()
+                        continue
+                    self.state = Sync_State.FLYWHEEL
+                    self.statistics.flywheel_frames += 1
+                self.read_index = i + self.stride
+                self.statistics.frames += 1
+                yield self.frame(i)
 
 
 class ASM_Desynchronization_Service(Service):
+    """
+    Extracts fixed length frames from a byte stream delimited by attached sync markers.
+    frame_length defaults to dsn.sle.aos.frame_length from the AIT configuration, the ASM is given in hex.
+
+    - service:
+        name: bifrost.services.extra.synchronization_service.ASM_Desynchronization_Service
+        frame_length: 1115
+        asm: '1ACFFC1D'
+        bit_error_tolerance: 2  # Tolerated ASM bit errors once locked
+        check_count: 1  # Markers to confirm before locking
+        flywheel_count: 3  # Missed markers tolerated before lock is lost
+        streams:
+          desynchronize:
+            - 'Telemetry.AOS.Stream'
+    """
     @with_loud_exception
     def __init__(self):
         super().__init__()
+        self.frame_length = ait.config.get('dsn.sle.aos.frame_length')
+        self.asm = '1ACFFC1D'
+        self.bit_error_tolerance = 0
+        self.check_count = 1
+        self.flywheel_count = 3
+        self.synchronizer = None
         self.start()
 
     @with_loud_coroutine_exception
     async def reconfigure(self, topic, message, reply):
         await super().reconfigure(topic, message, reply)
-        self.synchronized = False
+        if not self.frame_length:
+            log.error(f"{Fore.RED}{self.name}: frame_length is not configured, can not synchronize.{Fore.RESET}")
+            self.synchronizer = None
+            return
+        self.synchronizer = ASM_Frame_Synchronizer(self.frame_length,
+                                                   bytes.fromhex(self.asm),
+                                                   self.bit_error_tolerance,
+                                                   self.check_count,
+                                                   self.flywheel_count)
         return
 
     @with_loud_coroutine_exception
     async def desynchronize(self, topic, data, reply):
-        #print(self.synchronized, data)
-        data = data.split(b'\x1a\xcf\xfc\x1d')
-
-        if not data and self.synchronized:
-            log.error(f"{Fore.RED}Synchronization was lost?{Fore.RESET}")
-            self.synchronized = False
+        if not self.synchronizer:
             return
-
-        if not self.synchronized:
-            log.info(f"{Fore.GREEN}Synchronized{Fore.RESET}")
-            self.synchronized = True
-
-        if self.synchronized:
-            for i in data[1:]:
-                await self.stream('Telemetry.AOS.Raw', i)
+        for frame in self.synchronizer.feed(data):
+            await self.stream('Telemetry.AOS.Raw', frame)
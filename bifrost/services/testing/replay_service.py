@@ -0,0 +1,207 @@
+from bifrost.common.service import Service
+from bifrost.common.loud_exception import with_loud_exception, with_loud_coroutine_exception
+from bifrost.common.time_utility import NS
+from bifrost.services.extra.synchronization_service import DeSyncByte
+from bifrost.services.downlink.frame_archive import Frame_Archive, FLAG_CORRUPT, FLAG_OUT_OF_SEQUENCE
+from bifrost.services.downlink.aos_frame import AOS_Frame_View
+from bifrost.services.downlink.tagged_frame import TaggedFrame
+from ait.core import log
+from colorama import Fore
+from dataclasses import dataclass
+from pathlib import Path
+import asyncio
+import time
+
+
+@dataclass
+class Replay_Statistics():
+    source: str = ''
+    frames: int = 0
+    bytes: int = 0
+    skipped: int = 0
+    start: float = 0
+    finish: float = 0
+    running: bool = False
+
+    def marshall(self):
+        elapsed = (self.finish or time.monotonic()) - self.start if self.start else 0
+        res = {
+            'source': self.source,
+            'running': self.running,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'skipped': self.skipped,
+            'elapsed_s': elapsed,
+            'frames_per_second': self.frames / elapsed if elapsed else 0,
+            'megabits_per_second': 8 * self.bytes / elapsed / 1e6 if elapsed else 0,
+        }
+        return res
+
+
+class Replay_Pacer():
+    """
+    Releases frames at (receive time - first receive time) / speed after the first frame.
+    speed None replays as fast as possible, the JetStream publish window is the only limit.
+    """
+    def __init__(self, speed):
+        self.speed = speed
+        self.first_time_ns = None
+        self.start = None
+
+    async def wait(self, receive_time_ns):
+        if self.speed is None:
+            return
+        if self.first_time_ns is None:
+            self.first_time_ns = receive_time_ns
+            self.start = time.monotonic()
+            return
+        due = self.start + (receive_time_ns - self.first_time_ns) / NS / self.speed
+        lead = due - time.monotonic()
+        if lead > 0.001:
+            await asyncio.sleep(lead)
+
+
+class Archive_Replay_Service(Service):
+    """
+    Replays a frame archive into the downlink pipeline.
+    Sources are indexed archives (bifrost.services.downlink.frame_archive) or raw 0xBEEF delimited frame files.
+    Raw files carry no receive time, frames are assumed to have arrived at realtime_frame_rate frames per second.
+
+    Request on Bifrost.Replay.Start, the reply is sent once the replay finishes:
+        archive: /data/42/SV/downlink/FrameArchive  # Directory of an indexed archive, or a raw frame file
+        name: frames_SV_42  # Indexed archive name
+        target: raw  # <raw|tagged> Telemetry.AOS.Raw, or Telemetry.AOS.VCID.{n}.TaggedFrame
+        rate: 10  # <original|max|N>, N times realtime
+        vcids: [1, 2]  # Optional
+        start_time_gps_ns: 1000000000  # Optional, indexed archives only
+        stop_time_gps_ns: 2000000000  # Optional, indexed archives only
+        include_corrupt: False
+
+    Progress is published on Bifrost.Monitors.Replay every report_time seconds.
+
+    - service:
+        name: bifrost.services.testing.replay_service.Archive_Replay_Service
+        realtime_frame_rate: 1000
+        stream_window: 256
+        topics:
+          start_replay:
+            - 'Bifrost.Replay.Start'
+          stop_replay:
+            - 'Bifrost.Replay.Stop'
+    """
+    @with_loud_exception
+    def __init__(self):
+        super().__init__()
+        self.realtime_frame_rate = 1000
+        self.read_size = 1 << 20
+        self.report_time = 5
+        self.binary_wire_format = False
+        self.replay_task = None
+        self.statistics = Replay_Statistics()
+        self.loop.create_task(self.periodic_replay_report())
+        self.start()
+
+    @with_loud_coroutine_exception
+    async def reconfigure(self, topic, message, reply):
+        await super().reconfigure(topic, message, reply)
+
+    @with_loud_coroutine_exception
+    async def start_replay(self, topic, message, reply):
+        if self.replay_task and not self.replay_task.done():
+            log.error(f"{Fore.RED}A replay of {self.statistics.source} is already running.{Fore.RESET}")
+            if reply:
+                await self.publish(reply, {'error': 'Replay already running', **self.statistics.marshall()})
+            return
+        self.replay_task = self.loop.create_task(self.replay(message, reply))
+
+    @with_loud_coroutine_exception
+    async def stop_replay(self, topic, message, reply):
+        if self.replay_task and not self.replay_task.done():
+            self.replay_task.cancel()
+        if reply:
+            await self.publish(reply, self.statistics.marshall())
+
+    @with_loud_coroutine_exception
+    async def periodic_replay_report(self):
+        while True:
+            await asyncio.sleep(self.report_time)
+            if self.statistics.running:
+                await self.publish('Bifrost.Monitors.Replay', self.statistics.marshall())
+
+    @with_loud_exception
+    def parse_speed(self, rate):
+        if rate in (None, 'max'):
+            return None
+        if rate == 'original':
+            return 1.0
+        return float(rate)
+
+    def indexed_frames(self, message):
+        archive = Frame_Archive(message['archive'], message['name'])
+        try:
+            for (entry, frame) in archive.scan(vcids=message.get('vcids'),
+                                               start_time_gps_ns=message.get('start_time_gps_ns'),
+                                               stop_time_gps_ns=message.get('stop_time_gps_ns'),
+                                               include_corrupt=message.get('include_corrupt', False)):
+                yield (int(entry['vcid']), int(entry['absolute_counter']), int(entry['channel_counter']),
+                       int(entry['receive_time_gps_ns']), int(entry['flags']), frame)
+        finally:
+            archive.close()
+
+    def raw_frames(self, message):
+        if message.get('start_time_gps_ns') or message.get('stop_time_gps_ns'):
+            log.warn("Raw frame files have no receive time, time range ignored.")
+        vcids = message.get('vcids')
+        period_ns = int(NS / self.realtime_frame_rate)
+        desync = DeSyncByte()
+        n = 0
+        with open(message['archive'], 'rb') as f:
+            while (data := f.read(self.read_size)):
+                for frame in desync.feed(data):
+                    n += 1
+                    vcid = frame[1] & 0x3F
+                    if vcids is not None and vcid not in vcids:
+                        self.statistics.skipped += 1
+                        continue
+                    channel_counter = int.from_bytes(frame[2:5], 'big')
+                    yield (vcid, n, channel_counter, n * period_ns, 0, frame)
+
+    @with_loud_coroutine_exception
+    async def replay(self, message, reply):
+        source = Path(message['archive'])
+        frames = self.raw_frames(message) if source.is_file() else self.indexed_frames(message)
+        tagged = message.get('target', 'raw') == 'tagged'
+        pacer = Replay_Pacer(self.parse_speed(message.get('rate', 'max')))
+        self.statistics = Replay_Statistics(source=str(source), start=time.monotonic(), running=True)
+        log.info(f"{Fore.CYAN}Replaying {source} at {message.get('rate', 'max')}{Fore.RESET}")
+        try:
+            for (vcid, absolute_counter, channel_counter, receive_time_ns, flags, frame) in frames:
+                await pacer.wait(receive_time_ns)
+                if tagged:
+                    aos_frame = AOS_Frame_View(frame)
+                    tagged_frame = TaggedFrame(frame=frame,
+                                               vcid=vcid,
+                                               channel_counter=channel_counter,
+                                               absolute_counter=absolute_counter,
+                                               corrupt_frame=bool(flags & FLAG_CORRUPT),
+                                               out_of_sequence=bool(flags & FLAG_OUT_OF_SEQUENCE),
+                                               idle=aos_frame.is_idle_frame,
+                                               receive_time_gps_ns=receive_time_ns,
+                                               aos_frame=aos_frame)
+                    await self.stream(f'Telemetry.AOS.VCID.{vcid}.TaggedFrame',
+                                      tagged_frame.marshall(self.binary_wire_format))
+                else:
+                    await self.stream('Telemetry.AOS.Raw', frame)
+                self.statistics.frames += 1
+                self.statistics.bytes += len(frame)
+            await asyncio.gather(*self.stream_tasks)
+        finally:
+            frames.close()
+            self.statistics.finish = time.monotonic()
+            self.statistics.running = False
+            report = self.statistics.marshall()
+            log.info(f"{Fore.CYAN}Replay of {source} finished: {report['frames']} frames "
+                     f"at {report['frames_per_second']:.0f} frames/s{Fore.RESET}")
+            await self.publish('Bifrost.Monitors.Replay', report)
+            if reply:
+                await self.publish(reply, report)
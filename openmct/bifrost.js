@@ -1,3 +1,90 @@
+// Decoder for the binary websocket format (?format=msgpack): each frame is the msgpack array [subject, message]
+function decodeMsgpack(buffer) {
+	const view = new DataView(buffer)
+	const bytes = new Uint8Array(buffer)
+	const text = new TextDecoder()
+	let offset = 0
+
+	function str(length) {
+		const s = text.decode(bytes.subarray(offset, offset + length))
+		offset += length
+		return s
+	}
+	function bin(length) {
+		const b = bytes.slice(offset, offset + length)
+		offset += length
+		return b
+	}
+	function array(length) {
+		const a = new Array(length)
+		for (let i = 0; i < length; i++) {
+			a[i] = decode()
+		}
+		return a
+	}
+	function map(length) {
+		const m = {}
+		for (let i = 0; i < length; i++) {
+			const key = decode()
+			m[key] = decode()
+		}
+		return m
+	}
+	function ext(length) {
+		const type = view.getInt8(offset)
+		offset += 1
+		return {type: type, data: bin(length)}
+	}
+	function read(size, getter) {
+		const value = getter.call(view, offset)
+		offset += size
+		return value
+	}
+	function decode() {
+		const b = bytes[offset++]
+		if (b <= 0x7f) return b
+		if (b <= 0x8f) return map(b & 0x0f)
+		if (b <= 0x9f) return array(b & 0x0f)
+		if (b <= 0xbf) return str(b & 0x1f)
+		if (b >= 0xe0) return b - 0x100
+		switch (b) {
+			case 0xc0: return null
+			case 0xc2: return false
+			case 0xc3: return true
+			case 0xc4: return bin(read(1, view.getUint8))
+			case 0xc5: return bin(read(2, view.getUint16))
+			case 0xc6: return bin(read(4, view.getUint32))
+			case 0xc7: return ext(read(1, view.getUint8))
+			case 0xc8: return ext(read(2, view.getUint16))
+			case 0xc9: return ext(read(4, view.getUint32))
+			case 0xca: return read(4, view.getFloat32)
+			case 0xcb: return read(8, view.getFloat64)
+			case 0xcc: return read(1, view.getUint8)
+			case 0xcd: return read(2, view.getUint16)
+			case 0xce: return read(4, view.getUint32)
+			case 0xcf: return Number(read(8, view.getBigUint64))
+			case 0xd0: return read(1, view.getInt8)
+			case 0xd1: return read(2, view.getInt16)
+			case 0xd2: return read(4, view.getInt32)
+			case 0xd3: return Number(read(8, view.getBigInt64))
+			case 0xd4: return ext(1)
+			case 0xd5: return ext(2)
+			case 0xd6: return ext(4)
+			case 0xd7: return ext(8)
+			case 0xd8: return ext(16)
+			case 0xd9: return str(read(1, view.getUint8))
+			case 0xda: return str(read(2, view.getUint16))
+			case 0xdb: return str(read(4, view.getUint32))
+			case 0xdc: return array(read(2, view.getUint16))
+			case 0xdd: return array(read(4, view.getUint32))
+			case 0xde: return map(read(2, view.getUint16))
+			case 0xdf: return map(read(4, view.getUint32))
+		}
+		throw new Error(`Bad msgpack type 0x${b.toString(16)}`)
+	}
+	return decode()
+}
+
 class Bifrost{
 	constructor(config){
 		this.config = config
@@ -231,13 +318,38 @@ class Bifrost{
 	}
 
 	RealtimeTelemetry() {
+		const history_endpoint = this.config.bifrost_endpoints.telemetry_history
+		const binary = this.config.realtime_format === 'msgpack'
+		const rate = this.config.realtime_rate_hz
 		return function (openmct) {
-			const socket = new WebSocket("ws://localhost:8000/telemetry")
+			// Filtered: the server only forwards packets with a subscribed field
+			// With a rate, the server sends snapshots of the latest packets (alarm transitions at once)
+			const socket = new WebSocket(`ws://localhost:8000/telemetry?filter=1${binary ? '&format=msgpack' : ''}${rate ? `&rate=${rate}` : ''}`)
+			socket.binaryType = 'arraybuffer'
 			var listener = {};
+			var packet_subscribers = {};
+
+			function packet_request(request) {
+				if (socket.readyState === WebSocket.OPEN) {
+					socket.send(JSON.stringify(request))
+				}
+			}
+
+			socket.onopen = function () {
+				socket.send(JSON.stringify(Object.keys(packet_subscribers)))
+			}
 			
 			socket.onmessage = function (event) {
 				//console.log("Got message")
-				const bifrost_packet = JSON.parse(event.data)
+				// [subject, message] in binary mode, the server does not decode or re-encode the packet
+				const message = binary ? decodeMsgpack(event.data) : JSON.parse(event.data)
+				const packets = rate ? message : [message]
+				packets.forEach(function (m) {
+					dispatch(binary ? m[1] : m)
+				})
+			}
+
+			function dispatch(bifrost_packet) {
 				const decoded_map = bifrost_packet.decoded_packet
 				//console.log(decoded_map)
 				// Need to unpack field: value?
@@ -273,15 +385,61 @@ class Bifrost{
 				},
 				
 				supportsRequest: function (domainObject, options){
-					return false },
+					return domainObject.type === 'bifrost.telemetry.packet.field'
+				},
+
+				request: function (domainObject, options) {
+					// Key is {packet_name}.{field_name}, packet names have no dots
+					const key = domainObject.identifier.key
+					const split = key.indexOf('.')
+					const packet_name = key.slice(0, split)
+					const field_name = key.slice(split + 1)
+					// 'latest' asks for the last size points (one by default), not the whole range downsampled
+					const latest = options.strategy === 'latest'
+					const params = new URLSearchParams({
+						max_points: options.size || (latest ? 1 : 2000),
+						method: latest ? 'latest' : options.strategy === 'minmax' ? 'minmax' : 'lttb',
+					})
+					if (options.start !== undefined) {
+						params.set('start', options.start)
+					}
+					if (options.end !== undefined) {
+						params.set('end', options.end)
+					}
+					const url = `${history_endpoint}/${encodeURIComponent(packet_name)}/${encodeURIComponent(field_name)}?${params}`
+					return fetch(url, {method: "GET"}).then(async resp => {
+						const history = await resp.json()
+						if (!resp.ok) {
+							throw new Error(history)
+						}
+						return history.timestamps.map(function (timestamp, i) {
+							return {
+								id: key,
+								timestamp: timestamp,
+								RE: history.values[i],
+							}
+						})
+					})
+				},
 				
 				subscribe: function (domainObject, callback) {
-					listener[domainObject.identifier.key] = callback
+					const key = domainObject.identifier.key
+					const packet_name = key.slice(0, key.indexOf('.'))
+					listener[key] = callback
+					packet_subscribers[packet_name] = (packet_subscribers[packet_name] || 0) + 1
+					if (packet_subscribers[packet_name] === 1) {
+						packet_request({add: [packet_name]})
+					}
 					//console.log("NICO NICO")
 					//console.log(domainObject.identifier.key)
 					//console.log(listener)
 					return function unsubscribe() {
-						delete listener[domainObject.identifier.key]
+						delete listener[key]
+						packet_subscribers[packet_name] -= 1
+						if (packet_subscribers[packet_name] === 0) {
+							delete packet_subscribers[packet_name]
+							packet_request({remove: [packet_name]})
+						}
 					}
 				}
 			}
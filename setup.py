@@ -19,8 +19,10 @@ setup(
         'inotify',
         'jsonschema',
         'nats-py',
+        'numpy',
         'pandas',
         'portion',
+        'pyarrow',
         'pyasn1',
         'pyyaml',
         'requests',  # junk this
@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip('ait.core')
+
+from bifrost.services.downlink.alarms import Alarm_Check, Alarm_State, merge_intervals  # noqa: E402
+
+
+@pytest.fixture
+def compile_map(monkeypatch):
+    def compile_map(alarm_map):
+        monkeypatch.setattr(Alarm_Check, 'alarm_map', alarm_map, raising=False)
+        monkeypatch.setattr(Alarm_Check, 'alarm_tables', {}, raising=False)
+        Alarm_Check.compile_alarm_map()
+        return Alarm_Check.alarm_tables
+    return compile_map
+
+
+def test_merge_intervals():
+    assert merge_intervals([(5, 7), (0, 2), (1, 3), (3, 4), (9, 9)]) == ((0, 5), (4, 7))
+    assert merge_intervals([]) == ((), ())
+
+
+def test_compile_alarm_map_merges_intervals(compile_map):
+    tables = compile_map({
+        'Packet_A': {
+            'Voltage': {
+                'RED': [(-100, 0), (-5, 1), (50, 60), (55, 100)],
+                'YELLOW': [(1, 5), 'OFF'],
+            },
+        },
+    })
+    (red, yellow) = tables['Packet_A']['Voltage']
+    assert red.state is Alarm_State.RED
+    assert (red.lows, red.highs) == ((-100, 50), (1, 100))
+    assert red.exact == frozenset()
+    assert yellow.state is Alarm_State.YELLOW
+    assert (yellow.lows, yellow.highs) == ((1,), (5,))
+    assert yellow.exact == frozenset({'OFF'})
+
+
+def test_compile_alarm_map_priority_and_lookup(compile_map):
+    compile_map({
+        'Packet_A': {
+            'Voltage': {
+                'YELLOW': [(0, 10)],
+                'RED': [(5, 10)],
+                'BLUE': [42],
+            },
+        },
+    })
+    (red, yellow, blue) = Alarm_Check.alarm_tables['Packet_A']['Voltage']
+    assert [red.state, yellow.state, blue.state] == [Alarm_State.RED, Alarm_State.YELLOW, Alarm_State.BLUE]
+    assert Alarm_Check.get_alarm_state('Packet_A', 'Voltage', 7) is Alarm_State.RED
+    assert Alarm_Check.get_alarm_state('Packet_A', 'Voltage', 2) is Alarm_State.YELLOW
+    assert Alarm_Check.get_alarm_state('Packet_A', 'Voltage', 10) is Alarm_State.GREEN
+    assert Alarm_Check.get_alarm_state('Packet_A', 'Voltage', 42) is Alarm_State.BLUE
+    assert Alarm_Check.get_alarm_state('Packet_A', 'Voltage', 'text') is Alarm_State.GREEN
+    assert Alarm_Check.get_alarm_state('Packet_B', 'Voltage', 7) is Alarm_State.GREEN
+
+
+def test_compile_alarm_map_skips_empty(compile_map):
+    tables = compile_map({
+        'Packet_A': {'Voltage': {'THRESHOLD': 3}, 'Current': None},
+        'Packet_B': None,
+    })
+    assert tables == {}
@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+pytest.importorskip('ait.core')
+
+from bifrost.services.extra.synchronization_service import (  # noqa: E402
+    ASM_Frame_Synchronizer, Sync_State)
+
+ASM = b'\x1a\xcf\xfc\x1d'
+
+
+def chunked(data, sizes):
+    i = 0
+    for size in sizes:
+        yield data[i:i + size]
+        i += size
+    if i < len(data):
+        yield data[i:]
+
+
+def feed_all(parser, chunks):
+    # Frames are views into the parser's buffer, copy them before resuming
+    return [bytes(frame) for chunk in chunks for frame in parser.feed(chunk)]
+
+
+def make_frames(count, length):
+    return [bytes((i + j) % 256 for j in range(length)) for i in range(count)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 4, 5, 13, 1000])
+def test_asm_synchronizer_chunk_split(chunk_size):
+    frames = make_frames(40, 17)
+    stream = b'junk' + b''.join(ASM + frame for frame in frames) + ASM
+    synchronizer = ASM_Frame_Synchronizer(17, buffer_frames=2)
+    assert feed_all(synchronizer, chunked(stream, [chunk_size] * len(stream))) == frames
+    assert synchronizer.state is Sync_State.LOCK
+    assert synchronizer.statistics.bytes_discarded == len(b'junk')
+
+
+def test_asm_synchronizer_random_chunks():
+    rng = random.Random(1)
+    frames = [rng.randbytes(31) for _ in range(300)]
+    stream = rng.randbytes(50) + b''.join(ASM + frame for frame in frames) + ASM
+    sizes = [rng.randint(1, 90) for _ in range(len(stream))]
+    assert feed_all(ASM_Frame_Synchronizer(31, buffer_frames=3), chunked(stream, sizes)) == frames
+
+
+def test_asm_synchronizer_flywheel_tolerates_corrupt_marker():
+    frames = make_frames(6, 9)
+    markers = [ASM] * 6
+    markers[3] = b'\x00\x00\x00\x00'
+    stream = b''.join(marker + frame for (marker, frame) in zip(markers, frames)) + ASM
+    synchronizer = ASM_Frame_Synchronizer(9)
+    assert feed_all(synchronizer, chunked(stream, [5] * len(stream))) == frames
+    assert synchronizer.statistics.flywheel_frames == 1
+    assert synchronizer.statistics.lock_lost_count == 0
+
+
+def test_asm_synchronizer_check_requires_exact_marker():
+    # One bit error in the confirming marker: tolerated once locked, but not while checking
+    near_asm = bytes([ASM[0] ^ 0x01]) + ASM[1:]
+    stream = ASM + bytes(9) + near_asm + bytes(9)
+    synchronizer = ASM_Frame_Synchronizer(9, bit_error_tolerance=2)
+    assert feed_all(synchronizer, [stream]) == []
+    assert synchronizer.state is Sync_State.SEARCH
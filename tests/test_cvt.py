@@ -0,0 +1,61 @@
+import pytest
+
+pytest.importorskip('ait.core')
+
+from bifrost.services.downlink.cvt import Current_Value_Table  # noqa: E402
+
+
+def tagged_packet(packet_name, fields, packet_time=0, alarms=None, vcid=1):
+    return {
+        'packet_name': packet_name,
+        'decoded_packet': fields,
+        'field_alarms': {name: {'state': state} for (name, state) in (alarms or {}).items()},
+        'packet_time': packet_time,
+        'vcid': vcid,
+    }
+
+
+@pytest.fixture
+def table():
+    table = Current_Value_Table()
+    table.update(tagged_packet('Packet_A', {'Voltage_1': 1.0, 'Voltage_2': 2.0, 'Current': 0.5}, 10,
+                               {'Voltage_1': 'RED'}))
+    table.update(tagged_packet('Packet_B', {'Voltage_1': 3.0, 'Mode': 'SAFE'}, 20, vcid=2))
+    return table
+
+
+def test_point(table):
+    assert table.get('Packet_A.Voltage_1') == {
+        'Packet_A.Voltage_1': {'value': 1.0, 'packet_time': 10, 'alarm': 'RED', 'count': 1, 'vcid': 1}}
+    assert table.get('Packet_A.Missing') == {}
+    assert table.get('Missing.Voltage_1') == {}
+
+
+def test_glob_resolution(table):
+    assert set(table.get('Packet_A.*')) == {'Packet_A.Voltage_1', 'Packet_A.Voltage_2', 'Packet_A.Current'}
+    assert set(table.get('*.Voltage_1')) == {'Packet_A.Voltage_1', 'Packet_B.Voltage_1'}
+    assert set(table.get('Packet_?.Voltage_[2-9]')) == {'Packet_A.Voltage_2'}
+    assert set(table.get(['Packet_B.*', 'Packet_A.Current'])) == {'Packet_B.Voltage_1', 'Packet_B.Mode',
+                                                                  'Packet_A.Current'}
+    assert len(table.get()) == len(table.get('*')) == 5
+
+
+def test_glob_sees_new_fields(table):
+    assert set(table.get('Packet_B.*')) == {'Packet_B.Voltage_1', 'Packet_B.Mode'}
+    table.update(tagged_packet('Packet_B', {'Temperature': 21.0}, 30, vcid=2))
+    assert set(table.get('Packet_B.*')) == {'Packet_B.Voltage_1', 'Packet_B.Mode', 'Packet_B.Temperature'}
+    table.update(tagged_packet('Packet_C', {'Voltage_1': 4.0}, 40))
+    assert set(table.get('*.Voltage_1')) == {'Packet_A.Voltage_1', 'Packet_B.Voltage_1', 'Packet_C.Voltage_1'}
+
+
+def test_updates_values_and_counts(table):
+    table.update(tagged_packet('Packet_A', {'Voltage_1': 1.5}, 50))
+    point = table.get('Packet_A.*')['Packet_A.Voltage_1']
+    assert (point['value'], point['packet_time'], point['alarm'], point['count']) == (1.5, 50, None, 2)
+    assert table.get('Packet_A.Voltage_2')['Packet_A.Voltage_2']['count'] == 1
+
+
+def test_clear(table):
+    table.get('*')
+    table.clear()
+    assert table.get('*') == {}
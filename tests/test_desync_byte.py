@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+pytest.importorskip('ait.core')
+
+from bifrost.services.extra.synchronization_service import SyncByte, DeSyncByte  # noqa: E402
+
+
+def chunked(data, sizes):
+    i = 0
+    for size in sizes:
+        yield data[i:i + size]
+        i += size
+    if i < len(data):
+        yield data[i:]
+
+
+def feed_all(parser, chunks):
+    # Frames are views into the parser's buffer, copy them before resuming
+    return [bytes(frame) for chunk in chunks for frame in parser.feed(chunk)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64, 1 << 16])
+def test_desync_byte_chunk_split(chunk_size):
+    frames = [bytes([i]) * (i + 1) for i in range(50)]
+    sync = SyncByte(b'\xbe\xef', 4)
+    stream = b''.join(sync(frame) for frame in frames)
+    parser = DeSyncByte(buffer_size=16)
+    assert feed_all(parser, chunked(stream, [chunk_size] * len(stream))) == frames
+    assert parser.bytes_discarded == 0
+
+
+def test_desync_byte_random_chunks_and_garbage():
+    rng = random.Random(0)
+    frames = [rng.randbytes(rng.randint(1, 300)) for _ in range(200)]
+    sync = SyncByte(b'\xbe\xef', 4)
+    stream = b'\x00\x01garbage' + b''.join(sync(frame) for frame in frames)
+    sizes = [rng.randint(1, 100) for _ in range(len(stream))]
+    parser = DeSyncByte(buffer_size=64)
+    assert feed_all(parser, chunked(stream, sizes)) == frames
+    assert parser.bytes_discarded == len(b'\x00\x01garbage')
+
+
+def test_desync_byte_false_delimiter_length():
+    sync = SyncByte(b'\xbe\xef', 4)
+    stream = b'\xbe\xef\x00\x00\x00\x00' + sync(b'frame')
+    assert feed_all(DeSyncByte(), [stream]) == [b'frame']
@@ -0,0 +1,72 @@
+import numpy as np
+
+from bifrost.common.downsample import downsamplers, latest, lttb, min_max, select, stride
+
+
+def test_short_series_is_kept():
+    values = np.arange(10.0)
+    assert min_max(values, 10).tolist() == list(range(10))
+    assert lttb(np.arange(10), values, 20).tolist() == list(range(10))
+    assert stride(10, 10).tolist() == list(range(10))
+
+
+def test_min_max_keeps_spikes():
+    values = np.zeros(10_000)
+    values[1234] = 100
+    values[8765] = -100
+    selected = min_max(values, 100)
+    assert len(selected) <= 100
+    assert 1234 in selected and 8765 in selected
+    assert np.all(np.diff(selected) > 0)
+
+
+def test_min_max_ignores_nan():
+    values = np.full(1000, np.nan)
+    values[10] = 1.0
+    values[900] = 2.0
+    selected = min_max(values, 10)
+    assert 10 in selected and 900 in selected
+    assert not np.any(np.isnan(values[selected]))
+
+
+def test_lttb_keeps_ends_and_peak():
+    times = np.arange(1000)
+    values = np.sin(times / 50.0)
+    values[500] = 10
+    selected = lttb(times, values, 50)
+    assert len(selected) == 50
+    assert selected[0] == 0 and selected[-1] == 999
+    assert 500 in selected
+    assert np.all(np.diff(selected) > 0)
+
+
+def test_lttb_few_points_falls_back_to_stride():
+    assert lttb(np.arange(100), np.arange(100.0), 2).tolist() == [0, 99]
+
+
+def test_latest():
+    assert latest(10, 3).tolist() == [7, 8, 9]
+    assert latest(2, 3).tolist() == [0, 1]
+    assert downsamplers['latest'](np.arange(5), np.arange(5.0), 1).tolist() == [4]
+
+
+def test_select_latest_strings():
+    values = np.array(['OFF', 'ON', 'SAFE', 'ON'], dtype=object)
+    (selected, selected_values) = select(np.arange(4), values, 2, 'latest')
+    assert selected.tolist() == [2, 3]
+    assert selected_values == ['SAFE', 'ON']
+
+
+def test_select_strides_strings_and_bools():
+    (selected, selected_values) = select(np.arange(5), np.array([True, False, True, False, True]), 3, 'lttb')
+    assert selected.tolist() == [0, 2, 4]
+    assert selected_values == [True, True, True]
+    (_, selected_values) = select(np.arange(2), np.array([b'\x01', None], dtype=object), 2, 'minmax')
+    assert selected_values == ["b'\\x01'", None]
+
+
+def test_select_numbers_as_json():
+    values = np.array([1, np.nan, 3.5])
+    (selected, selected_values) = select(np.arange(3), values, 10, 'latest')
+    assert selected.tolist() == [0, 1, 2]
+    assert selected_values == [1.0, None, 3.5]
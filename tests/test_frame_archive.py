@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip('ait.core')
+
+from bifrost.services.downlink.frame_archive import Frame_Archive, Frame_Archive_Writer  # noqa: E402
+
+
+def write_segment(directory, frames):
+    writer = Frame_Archive_Writer(directory, 'frames', 16)
+    for (counter, frame) in frames:
+        writer.write(frame, 1, counter, counter, receive_time_gps_ns=1000 + counter)
+    writer.close()
+    return writer.segment
+
+
+def test_appending_continues_after_the_highest_segment(tmp_path):
+    assert [write_segment(tmp_path, [(i, b'frame %d' % i)]) for i in range(3)] == [0, 1, 2]
+    for extension in ('frames', 'index'):
+        (tmp_path / f'frames.00001.{extension}').unlink()
+    existing = {path.name: path.read_bytes() for path in tmp_path.iterdir()}
+    assert write_segment(tmp_path, [(3, b'frame 3')]) == 3
+    assert all((tmp_path / name).read_bytes() == data for (name, data) in existing.items())
+    archive = Frame_Archive(tmp_path, 'frames')
+    assert [bytes(frame) for (_, frame) in archive.scan()] == [b'frame 0', b'frame 2', b'frame 3']
+    archive.close()
+
+
+def test_orphan_index_is_not_reused(tmp_path):
+    (tmp_path / 'frames.00007.index').write_bytes(b'')
+    assert write_segment(tmp_path, [(1, b'frame')]) == 8
+
+
+def test_unsorted_counters(tmp_path):
+    write_segment(tmp_path, [(5, b'a'), (6, b'b'), (1, b'c'), (2, b'd')])
+    archive = Frame_Archive(tmp_path, 'frames')
+    assert bytes(archive.find_counter(1)[1]) == b'c'
+    assert [bytes(frame) for (_, frame) in archive.scan(start_counter=2, stop_counter=6)] == [b'a', b'd']
+    archive.close()
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from astropy.time import Time
+
+from bifrost.common.time_utility import GPS_Time, NS, iso_from_gps_ns, tai_ns_from_utc_ns, utc_ns_from_tai_ns
+
+GPS_NS = [
+    0,
+    1,
+    999_999_999,
+    123_456_789_012_345_678,
+    1_000_000_000 * NS + 500_000_000,
+    1_400_000_000 * NS + 7,
+]
+
+
+def astropy_iso(gps_ns):
+    return Time(gps_ns // NS, (gps_ns % NS) / NS, format='gps', scale='tai', precision=9).iso
+
+
+@pytest.mark.parametrize('gps_ns', GPS_NS)
+def test_iso_from_gps_ns_matches_astropy(gps_ns):
+    assert str(iso_from_gps_ns(gps_ns)) == astropy_iso(gps_ns)
+
+
+def test_iso_from_gps_ns_vectorized():
+    assert iso_from_gps_ns(np.array(GPS_NS)).tolist() == [astropy_iso(gps_ns) for gps_ns in GPS_NS]
+
+
+def test_gps_time_round_trip():
+    t = GPS_Time.from_gps_s_ns(1_400_000_000, 123_456_789)
+    assert t.gps_ns == 1_400_000_000 * NS + 123_456_789
+    assert t.iso == astropy_iso(t.gps_ns)
+    assert t.to_astropy().iso == t.iso
+
+
+def test_tai_utc_conversion():
+    utc_ns = np.array([0, 1_483_228_799 * NS, 1_483_228_800 * NS, 1_700_000_000 * NS + 5])
+    tai_ns = tai_ns_from_utc_ns(utc_ns)
+    assert ((tai_ns - utc_ns) // NS).tolist() == [0, 36, 37, 37]
+    assert utc_ns_from_tai_ns(tai_ns).tolist() == utc_ns.tolist()
+    assert int(tai_ns_from_utc_ns(1_700_000_000 * NS)) == 1_700_000_037 * NS